@@ -0,0 +1,208 @@
+'''
+Business: Per-user dashboard cache with an in-process LRU tier and an optional shared tier
+Entries are keyed by a per-user version. Writers call invalidate(user_id),
+which bumps the version, so stale entries are never read again. With a shared
+tier (REDIS_URL, or CACHE_BACKEND=memory for the local stand-in) the version
+lives there and invalidations from any function reach every container;
+without it each container only sees its own invalidations and relies on
+CACHE_TTL. An invalidation also marks the users as written for db, so their
+reads stay on the primary until a replica catches up.
+Every cloud function directory ships an identical copy.
+'''
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import db
+
+CACHE_TTL = float(os.environ.get('CACHE_TTL', '10'))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '2048'))
+LOG_STATS = os.environ.get('CACHE_STATS') == '1'
+
+
+class LocalLRU:
+    '''
+    Business: Thread-safe LRU dict with per-entry expiry
+    Args: max_entries - entries kept before the least recently used is dropped
+          ttl - seconds an entry stays valid
+    '''
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class MemoryStore:
+    '''
+    Business: In-process stand-in for the Redis commands the cache uses (get, set, incr)
+    '''
+
+    def __init__(self) -> None:
+        self._data: Dict[str, Tuple[Optional[float], Any]] = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key: str) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] is not None and entry[0] < time.time():
+            del self._data[key]
+            return None
+        return entry[1]
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            value = self._live(key)
+        return None if value is None else str(value).encode()
+
+    def set(self, key: str, value: Any, ex: Optional[float] = None) -> bool:
+        with self._lock:
+            self._data[key] = (time.time() + ex if ex else None, value)
+        return True
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            value = int(self._live(key) or 0) + 1
+            self._data[key] = (None, value)
+        return value
+
+
+def _shared_store() -> Any:
+    if os.environ.get('CACHE_BACKEND') == 'memory':
+        return MemoryStore()
+    url = os.environ.get('REDIS_URL')
+    if not url:
+        return None
+    try:
+        import redis
+    except ImportError:
+        return None
+    return redis.Redis.from_url(url, socket_timeout=0.05, socket_connect_timeout=0.05)
+
+
+class UserCache:
+    '''
+    Business: Versioned per-user cache for dashboard sections (cards, requests, transactions)
+    Args: local - in-process tier
+          shared - Redis-compatible client or None
+    '''
+
+    def __init__(self, local: Optional[LocalLRU] = None, shared: Any = None) -> None:
+        self.local = local or LocalLRU()
+        self.shared = shared
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            'local_hits': 0,
+            'shared_hits': 0,
+            'misses': 0,
+            'invalidations': 0,
+            'shared_errors': 0,
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def _version(self, user_id: str) -> str:
+        if self.shared is not None:
+            try:
+                value = self.shared.get(f'dash:{user_id}:v')
+                return value.decode() if value is not None else '0'
+            except Exception:
+                self._count('shared_errors')
+        return str(self._versions.get(user_id, 0))
+
+    def key(self, user_id: Any, section: str) -> str:
+        '''
+        Business: Versioned key for a user's section; take it before reading the
+        database and store under the same key, so a write that lands in between
+        leaves the fresh version empty instead of filling it with stale data
+        '''
+        user_id = str(user_id)
+        return f'dash:{user_id}:{self._version(user_id)}:{section}'
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.local.get(key)
+        if value is not None:
+            self._count('local_hits')
+            return value
+        if self.shared is not None:
+            try:
+                raw = self.shared.get(key)
+            except Exception:
+                raw = None
+                self._count('shared_errors')
+            if raw is not None:
+                value = raw.decode()
+                self.local.set(key, value)
+                self._count('shared_hits')
+                return value
+        self._count('misses')
+        return None
+
+    def set(self, key: str, value: str) -> None:
+        self.local.set(key, value)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, ex=max(1, int(self.local.ttl * 6)))
+            except Exception:
+                self._count('shared_errors')
+
+    def invalidate(self, *user_ids: Any) -> None:
+        db.mark_written(*user_ids)
+        for user_id in {str(u) for u in user_ids if u is not None}:
+            with self._lock:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+                self.stats['invalidations'] += 1
+            if self.shared is not None:
+                try:
+                    self.shared.incr(f'dash:{user_id}:v')
+                except Exception:
+                    self._count('shared_errors')
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        hits = stats['local_hits'] + stats['shared_hits']
+        total = hits + stats['misses']
+        stats['hit_ratio'] = round(hits / total, 4) if total else 0.0
+        return stats
+
+    def log_stats(self) -> None:
+        if LOG_STATS:
+            print(json.dumps({'dashboard_cache': self.snapshot()}))
+
+
+dashboard = UserCache(shared=_shared_store())
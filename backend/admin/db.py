@@ -0,0 +1,400 @@
+'''
+Business: Process-level PostgreSQL connection pool shared by warm invocations
+psycopg2 is imported on the first connection, not with this module, so cold
+starts that never reach the database do not pay for loading the driver.
+With DATABASE_REPLICA_URL set, read-only actions may borrow from a streaming
+replica instead (acquire_for_read). A user's reads stay on the primary until
+the replica has replayed the WAL position of that user's latest write, and
+a replica that fails to connect is skipped for DB_REPLICA_RETRY_INTERVAL.
+Every cloud function directory ships an identical copy of this module,
+because each function is deployed on its own.
+'''
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import tracing
+
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_HEALTH_CHECK_INTERVAL', '30'))
+MAX_CONNECTION_AGE = float(os.environ.get('DB_MAX_CONNECTION_AGE', '1800'))
+LOG_STATS = os.environ.get('DB_POOL_STATS') == '1'
+REPLICA_RETRY_INTERVAL = float(os.environ.get('DB_REPLICA_RETRY_INTERVAL', '30'))
+WRITE_POSITION_TTL = float(os.environ.get('DB_WRITE_POSITION_TTL', '300'))
+
+# psycopg2 connection class for new connections; benchmarks swap in a subclass
+# that counts round trips. None means the tracing class under TRACE=1, else the default
+connection_factory: Optional[type] = None
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class Pool:
+    '''
+    Business: Bounded pool of psycopg2 connections kept alive between invocations
+    Args: dsn - PostgreSQL connection string
+          max_size - maximum number of open connections in this container
+    '''
+
+    def __init__(self, dsn: str, max_size: int = POOL_MAX_SIZE) -> None:
+        self.dsn = dsn
+        self.max_size = max_size
+        self._idle: List[Tuple[Any, float, float]] = []
+        self._created: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self.stats: Dict[str, int] = {
+            'hits': 0,
+            'misses': 0,
+            'reconnects': 0,
+            'discarded': 0,
+            'in_use': 0,
+        }
+
+    def _connect(self) -> Any:
+        import psycopg2
+        factory = connection_factory or (tracing.connection_class() if tracing.ENABLED else None)
+        conn = psycopg2.connect(self.dsn, connection_factory=factory)
+        self._created[id(conn)] = time.monotonic()
+        return conn
+
+    def _discard(self, conn: Any) -> None:
+        self._created.pop(id(conn), None)
+        self.stats['discarded'] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn: Any, idle_since: float, created_at: float) -> bool:
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - created_at > MAX_CONNECTION_AGE:
+            return False
+        if now - idle_since < HEALTH_CHECK_INTERVAL:
+            return True
+        import psycopg2
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire(self, timeout: Optional[float] = None) -> Any:
+        if not self._slots.acquire(timeout=POOL_TIMEOUT if timeout is None else timeout):
+            raise PoolExhausted(f'All {self.max_size} database connections are busy')
+
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    conn = self._connect()
+                    with self._lock:
+                        self.stats['misses'] += 1
+                    break
+                conn, idle_since, created_at = entry
+                if self._is_healthy(conn, idle_since, created_at):
+                    with self._lock:
+                        self.stats['hits'] += 1
+                    break
+                with self._lock:
+                    self._discard(conn)
+                    self.stats['reconnects'] += 1
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.stats['in_use'] += 1
+        return conn
+
+    def release(self, conn: Any, discard: bool = False) -> None:
+        import psycopg2.extensions
+        if not discard and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+
+        with self._lock:
+            self.stats['in_use'] -= 1
+            if discard or conn.closed:
+                self._discard(conn)
+            else:
+                created_at = self._created.get(id(conn), time.monotonic())
+                self._idle.append((conn, time.monotonic(), created_at))
+        self._slots.release()
+
+        if LOG_STATS:
+            print(json.dumps({'db_pool': self.snapshot()}))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['idle'] = len(self._idle)
+        total = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / total, 4) if total else 0.0
+        return stats
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+            for conn, _, _ in idle:
+                self._discard(conn)
+
+
+_pools: Dict[str, Pool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(dsn: str) -> Pool:
+    pool = _pools.get(dsn)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(dsn)
+            if pool is None:
+                pool = Pool(dsn)
+                _pools[dsn] = pool
+    return pool
+
+
+def acquire(dsn: str) -> Any:
+    with tracing.span('acquire'):
+        return get_pool(dsn).acquire()
+
+
+def release(dsn: str, conn: Any, discard: bool = False) -> None:
+    get_pool(dsn).release(conn, discard=discard)
+
+
+def pool_stats() -> Dict[str, Dict[str, Any]]:
+    return {str(index): pool.snapshot() for index, pool in enumerate(_pools.values())}
+
+
+def replica_url() -> Optional[str]:
+    return os.environ.get('DATABASE_REPLICA_URL') or None
+
+
+def parse_lsn(text: str) -> int:
+    high, low = text.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def is_disconnect(error: BaseException) -> bool:
+    import psycopg2
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+
+class WritePositions:
+    '''
+    Business: WAL position of each user's latest write, for read-your-writes routing
+    Kept in process and, with REDIS_URL, in Redis as well, so a write served by
+    one container keeps the user's reads in another on the primary.
+    Args: ttl - seconds after which a position is forgotten
+          shared - Redis-compatible client or None
+    '''
+
+    def __init__(self, ttl: float = WRITE_POSITION_TTL, shared: Any = None) -> None:
+        self.ttl = ttl
+        self.shared = shared
+        self._local: Dict[str, Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, user_ids: Any, lsn: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if len(self._local) > 10000:
+                self._local = {key: entry for key, entry in self._local.items() if entry[1] > now}
+            for user_id in user_ids:
+                key = str(user_id)
+                current = self._local.get(key)
+                if current is None or current[1] <= now or current[0] < lsn:
+                    self._local[key] = (lsn, now + self.ttl)
+        if self.shared is not None:
+            try:
+                for user_id in user_ids:
+                    self.shared.set(f'lsn:{user_id}', lsn, ex=max(1, int(self.ttl)))
+            except Exception:
+                pass
+
+    def latest(self, keys: Any) -> Optional[int]:
+        '''
+        Business: Highest recorded position among keys, None when none of them wrote
+        '''
+        positions = [lsn for lsn in (self.get(key) for key in keys) if lsn is not None]
+        return max(positions) if positions else None
+
+    def get(self, user_id: Any) -> Optional[int]:
+        key = str(user_id)
+        with self._lock:
+            entry = self._local.get(key)
+        lsn = entry[0] if entry is not None and entry[1] > time.monotonic() else None
+        if self.shared is not None:
+            try:
+                raw = self.shared.get(f'lsn:{key}')
+            except Exception:
+                raw = None
+            if raw is not None:
+                lsn = max(lsn or 0, int(raw))
+        return lsn
+
+
+def _shared_store() -> Any:
+    url = os.environ.get('REDIS_URL')
+    if not url:
+        return None
+    try:
+        import redis
+    except ImportError:
+        return None
+    return redis.Redis.from_url(url, socket_timeout=0.05, socket_connect_timeout=0.05)
+
+
+write_positions = WritePositions(shared=_shared_store())
+_written = threading.local()
+
+
+def mark_written(*user_ids: Any) -> None:
+    '''
+    Business: Note users whose data the current thread has just changed;
+    record_writes() stores the primary's WAL position for them. A no-op
+    without a replica, where nothing would ever read the positions.
+    '''
+    if replica_url() is None:
+        return
+    pending = getattr(_written, 'users', None)
+    if pending is None:
+        pending = _written.users = set()
+    pending.update(str(user_id) for user_id in user_ids if user_id is not None)
+
+
+def forget_writes() -> None:
+    '''
+    Business: Drop the users mark_written() noted in this thread without recording them
+    '''
+    _written.users = None
+
+
+def record_writes(conn: Any, *user_ids: Any) -> None:
+    '''
+    Business: Pin the marked users (and user_ids) to the primary until a replica replays this position
+    Args: conn - primary connection the writes were committed on, outside a transaction
+          user_ids - further position keys: user ids or session keys
+    '''
+    pending = getattr(_written, 'users', None) or set()
+    _written.users = None
+    users = pending | {str(user_id) for user_id in user_ids if user_id is not None}
+    if not users or replica_url() is None:
+        return
+    conn.rollback()
+    # one round trip: no transaction to open and roll back around the query
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_current_wal_lsn()::text')
+            lsn = parse_lsn(cursor.fetchone()[0])
+    finally:
+        conn.autocommit = False
+    write_positions.record(users, lsn)
+
+
+class Replica:
+    '''
+    Business: Health and replay progress of one read replica
+    '''
+
+    def __init__(self) -> None:
+        self.replayed = 0
+        self.down_until = 0.0
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {'reads': 0, 'lagging': 0, 'failovers': 0}
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def mark_down(self) -> None:
+        with self._lock:
+            self.down_until = time.monotonic() + REPLICA_RETRY_INTERVAL
+            self.stats['failovers'] += 1
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def caught_up(self, conn: Any, lsn: Optional[int]) -> bool:
+        if lsn is None or lsn <= self.replayed:
+            return True
+        with conn.cursor() as cursor:
+            # a promoted replica is no longer in recovery and has everything it ever wrote
+            cursor.execute('SELECT COALESCE(pg_last_wal_replay_lsn(), pg_current_wal_lsn())::text')
+            replayed = parse_lsn(cursor.fetchone()[0])
+        conn.rollback()
+        with self._lock:
+            self.replayed = max(self.replayed, replayed)
+        return lsn <= replayed
+
+
+_replicas: Dict[str, Replica] = {}
+
+
+def get_replica(dsn: str) -> Replica:
+    replica = _replicas.get(dsn)
+    if replica is None:
+        with _pools_lock:
+            replica = _replicas.setdefault(dsn, Replica())
+    return replica
+
+
+def acquire_for_read(dsn: str, replica_dsn: Optional[str], keys: Sequence[Any] = ()) -> Tuple[Any, str]:
+    '''
+    Business: Borrow a connection for a read-only action
+    Args: dsn - primary connection string
+          replica_dsn - replica connection string or None
+          keys - position keys (user id, session) whose writes must be visible
+    Returns: (connection, dsn to release it to): the replica when it is up and
+             has replayed the reader's latest write, the primary otherwise
+    '''
+    if replica_dsn:
+        replica = get_replica(replica_dsn)
+        if replica.available():
+            try:
+                conn = acquire(replica_dsn)
+            except PoolExhausted:
+                conn = None
+            except Exception as e:
+                if not is_disconnect(e):
+                    raise
+                replica.mark_down()
+                conn = None
+            if conn is not None:
+                try:
+                    caught_up = replica.caught_up(conn, write_positions.latest(keys))
+                except Exception as e:
+                    release(replica_dsn, conn, discard=True)
+                    if not is_disconnect(e):
+                        raise
+                    replica.mark_down()
+                else:
+                    if caught_up:
+                        replica.count('reads')
+                        return conn, replica_dsn
+                    release(replica_dsn, conn)
+                    replica.count('lagging')
+    return acquire(dsn), dsn
+
+
+def replica_stats() -> Dict[str, Dict[str, int]]:
+    return {str(index): dict(replica.stats) for index, replica in enumerate(_replicas.values())}
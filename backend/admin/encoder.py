@@ -0,0 +1,173 @@
+'''
+Business: Fast JSON encoding of cursor rows for API responses
+Output is byte-for-byte what json.dumps(..., default=str) produced for the
+same rows. Setting JSON_ENCODER=orjson switches row encoding to orjson when
+it is installed; that output is compact and not ASCII-escaped.
+Every cloud function directory ships an identical copy of this module.
+'''
+import json
+import os
+from datetime import date, datetime, time
+from decimal import Decimal
+from json.encoder import encode_basestring_ascii
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import tracing
+
+# orjson is only imported when selected, it costs several milliseconds of cold start
+orjson: Any = None
+if os.environ.get('JSON_ENCODER') == 'orjson':
+    try:
+        import orjson
+    except ImportError:
+        pass
+
+USE_ORJSON = orjson is not None
+
+
+def _quoted_str(value: Any) -> str:
+    return '"' + str(value) + '"'
+
+
+def _float(value: float) -> str:
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return 'Infinity' if value > 0 else '-Infinity'
+    return float.__repr__(value)
+
+
+def _fallback(value: Any) -> str:
+    return json.dumps(value, default=str)
+
+
+def encode_value(value: Any) -> str:
+    return (VALUE_ENCODERS.get(type(value)) or _fallback)(value)
+
+
+VALUE_ENCODERS: Dict[type, Callable[[Any], str]] = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    bool: lambda value: 'true' if value else 'false',
+    float: _float,
+    type(None): lambda value: 'null',
+    Decimal: _quoted_str,
+    datetime: _quoted_str,
+    date: _quoted_str,
+    time: _quoted_str,
+}
+
+
+class RawJSON:
+    '''
+    Business: Already-encoded JSON fragment that dumps() inserts verbatim
+    '''
+    __slots__ = ('text',)
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+
+class Layout:
+    '''
+    Business: Precomputed key prefixes and a compiled row encoder for a fixed column list
+    Args: columns - column names in cursor order
+    The row encoder is generated on first use, specialised to the value types
+    of that row; every column still falls back to generic encoding when a
+    later row carries a different type (NULLs included).
+    '''
+
+    def __init__(self, columns: Sequence[str]) -> None:
+        self.columns = tuple(columns)
+        self.prefixes = tuple(
+            ('{' if index == 0 else ', ') + encode_basestring_ascii(name) + ': '
+            for index, name in enumerate(self.columns)
+        )
+        self._encode: Optional[Callable[[Sequence[Any]], str]] = None
+
+    def _compile(self, sample: Sequence[Any]) -> Callable[[Sequence[Any]], str]:
+        if not self.columns:
+            return lambda values: '{}'
+        namespace: Dict[str, Any] = {'esc': encode_basestring_ascii, 'generic': encode_value}
+        terms = []
+        for index, (prefix, value) in enumerate(zip(self.prefixes, sample)):
+            name = f'v{index}'
+            kind = type(value)
+            if kind is str:
+                term = f'(esc({name}) if {name}.__class__ is str else generic({name}))'
+            elif kind is int:
+                term = f'(str({name}) if {name}.__class__ is int else generic({name}))'
+            elif kind is bool:
+                term = f"('true' if {name} is True else 'false' if {name} is False else generic({name}))"
+            elif kind in (Decimal, datetime, date, time):
+                namespace[f't{index}'] = kind
+                term = f"('\"' + str({name}) + '\"' if {name}.__class__ is t{index} else generic({name}))"
+            else:
+                term = f'generic({name})'
+            terms.append(f'{prefix!r} + {term}')
+        names = ', '.join(f'v{index}' for index in range(len(self.columns)))
+        source = f"def encode(values):\n    {names}, = values\n    return {' + '.join(terms)} + '}}'\n"
+        exec(source, namespace)
+        return namespace['encode']
+
+    def encode_row(self, row: Any) -> str:
+        values = tuple(row.values()) if isinstance(row, dict) else row
+        if self._encode is None:
+            self._encode = self._compile(values)
+        return self._encode(values)
+
+    def encode_rows(self, rows: Iterable[Any]) -> str:
+        if USE_ORJSON:
+            return orjson.dumps(
+                [dict(zip(self.columns, row.values() if isinstance(row, dict) else row)) for row in rows],
+                default=str,
+                option=orjson.OPT_PASSTHROUGH_DATETIME,
+            ).decode()
+        values = [tuple(row.values()) if isinstance(row, dict) else row for row in rows]
+        if not values:
+            return '[]'
+        if self._encode is None:
+            self._encode = self._compile(values[0])
+        return '[' + ', '.join(list(map(self._encode, values))) + ']'
+
+
+_layouts: Dict[Tuple[str, ...], Layout] = {}
+
+
+def layout_for(description: Sequence[Any]) -> Layout:
+    columns = tuple(column[0] for column in description)
+    layout = _layouts.get(columns)
+    if layout is None:
+        layout = Layout(columns)
+        _layouts[columns] = layout
+    return layout
+
+
+def rows(description: Sequence[Any], data: Iterable[Any]) -> RawJSON:
+    '''
+    Business: Encode cursor rows (tuples or RealDictRows) as a JSON array
+    Args: description - cursor.description of the query that produced the rows
+          data - fetched rows
+    Returns: RawJSON fragment for dumps()
+    '''
+    with tracing.span('serialize'):
+        return RawJSON(layout_for(description).encode_rows(data))
+
+
+def row(description: Sequence[Any], data: Any) -> RawJSON:
+    with tracing.span('serialize'):
+        return RawJSON(layout_for(description).encode_row(data))
+
+
+def dumps(payload: Dict[str, Any]) -> str:
+    '''
+    Business: Serialize a response dict whose values may be RawJSON fragments
+    Args: payload - top-level response object
+    Returns: JSON text identical to json.dumps(payload, default=str)
+    '''
+    with tracing.span('serialize'):
+        parts: List[str] = []
+        for key, value in payload.items():
+            text = value.text if isinstance(value, RawJSON) else json.dumps(value, default=str)
+            parts.append(encode_basestring_ascii(key) + ': ' + text)
+        return '{' + ', '.join(parts) + '}'
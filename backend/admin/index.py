@@ -1,10 +1,362 @@
-import json
-import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from datetime import datetime
 from typing import Dict, Any
 import random
 
+import admission
+import cache
+import encoder
+import idempotency
+import issuance
+import ledger
+import listings
+import overview
+import partitions
+import runtime
+import search
+import sessions
+import tracing
+
+PREFLIGHT = runtime.preflight(
+    'GET, POST, PUT, DELETE, OPTIONS', 'Content-Type, Authorization, X-Auth-Token, X-User-Id, X-Is-Admin, Idempotency-Key'
+)
+
+
+def listing(request: runtime.Request) -> Dict[str, Any]:
+    action = request.action
+    params = request.params
+    export_format = params.get('format')
+    
+    try:
+        if export_format:
+            if export_format not in listings.EXPORT_FORMATS:
+                raise listings.InvalidFilter('Invalid format')
+            export = listings.export_page(request.conn, action, params, export_format)
+            request.conn.rollback()
+            
+            headers = {
+                'Content-Type': listings.EXPORT_FORMATS[export_format],
+                'Content-Disposition': f'attachment; filename="{action}.{export_format}"',
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Expose-Headers': 'X-Next-Cursor'
+            }
+            if export['next_cursor']:
+                headers['X-Next-Cursor'] = export['next_cursor']
+            return runtime.respond(200, export['body'], headers)
+        
+        page = listings.fetch_page(request.conn, action, params)
+    except listings.InvalidFilter as e:
+        return runtime.error(400, str(e))
+    
+    key = listings.LISTINGS[action]['key']
+    return runtime.respond(200, encoder.dumps({
+        key: encoder.rows(page['description'], page['rows']),
+        'next_cursor': page['next_cursor']
+    }))
+
+
+def balance_at(request: runtime.Request) -> Dict[str, Any]:
+    params = request.params
+    card_id = params.get('card_id')
+    try:
+        at = datetime.fromisoformat(params['at']) if params.get('at') else None
+    except ValueError:
+        at = None
+        card_id = None
+    
+    if not card_id or not str(card_id).isdigit():
+        return runtime.error(400, 'Invalid card_id or at')
+    
+    return runtime.ok({
+        'card_id': int(card_id),
+        'at': params.get('at'),
+        'balance': ledger.balance_at(request.cursor, card_id, at)
+    })
+
+
+def search_users(request: runtime.Request) -> Dict[str, Any]:
+    try:
+        query = search.parse(request.params)
+    except listings.InvalidFilter as e:
+        return runtime.error(400, str(e))
+    
+    return runtime.respond(200, encoder.dumps({
+        'query': query['text'],
+        'results': search.run(request.cursor, query)
+    }))
+
+
+def bank_overview(request: runtime.Request) -> Dict[str, Any]:
+    return runtime.ok(overview.read(request.cursor))
+
+
+def check_overview(request: runtime.Request) -> Dict[str, Any]:
+    compacted = overview.compact(request.cursor)
+    mismatches = overview.check(request.cursor)
+    repaired = bool(mismatches) and bool(request.params.get('repair'))
+    if repaired:
+        overview.repair(request.cursor)
+    request.commit()
+    
+    return runtime.ok({'success': not mismatches, 'mismatches': mismatches, 'repaired': repaired,
+                      'compacted': compacted})
+
+
+def approve_card(request: runtime.Request) -> Dict[str, Any]:
+    request_id = request.params.get('request_id')
+    card_number = request.params.get('card_number')
+    
+    if not request_id:
+        return runtime.error(400, 'Missing required fields')
+    
+    conn = request.conn
+    cursor = request.cursor
+    # the lock keeps a concurrent approval from issuing a second card
+    cursor.execute("SELECT * FROM card_requests WHERE id = %s FOR UPDATE", (request_id,))
+    card_request = cursor.fetchone()
+    
+    if not card_request:
+        conn.rollback()
+        return runtime.error(404, 'Request not found')
+    
+    if card_request['status'] != 'pending':
+        conn.rollback()
+        return runtime.error(409, f"Request already {card_request['status']}")
+    
+    if not card_number:
+        # a generated number that collides is regenerated
+        with conn.cursor() as issue_cursor:
+            issuance.issue_cards(issue_cursor, [(card_request['id'], card_request['user_id'],
+                                                 card_request['card_category'])])
+    else:
+        cursor.execute(
+            """INSERT INTO cards (user_id, card_number, masked_number, card_type, card_category, balance, color_scheme, status)
+               VALUES (%s, %s, %s, 'virtual', %s, 0, %s, 'active')
+               ON CONFLICT (card_number) DO NOTHING
+               RETURNING id""",
+            (card_request['user_id'], card_number, issuance.mask_card_number(card_number),
+             card_request['card_category'], random.choice(issuance.COLOR_SCHEMES))
+        )
+        
+        if not cursor.fetchone():
+            conn.rollback()
+            return runtime.error(409, 'Card number already issued')
+    
+    cursor.execute(
+        "UPDATE card_requests SET status = 'approved', processed_at = CURRENT_TIMESTAMP WHERE id = %s",
+        (request_id,)
+    )
+    
+    request.commit(lambda: cache.dashboard.invalidate(card_request['user_id']))
+    
+    return runtime.ok({'success': True, 'message': 'Card approved and issued'})
+
+
+def process_requests(request: runtime.Request) -> Dict[str, Any]:
+    body_data = request.params
+    conn = request.conn
+    try:
+        outcome = issuance.process_requests(
+            conn,
+            body_data.get('decision'),
+            request_ids=body_data.get('request_ids'),
+            selection=body_data.get('filter'),
+            limit=body_data.get('limit'),
+            comment=body_data.get('comment', '')
+        )
+    except issuance.InvalidSelection as e:
+        conn.rollback()
+        return runtime.error(400, str(e))
+    request.commit()
+    cache.dashboard.invalidate(*outcome['user_ids'])
+    
+    return runtime.ok({
+        'success': True,
+        'processed': outcome['processed'],
+        'skipped': outcome['skipped'],
+        'results': outcome['results']
+    })
+
+
+def reject_card(request: runtime.Request) -> Dict[str, Any]:
+    request_id = request.params.get('request_id')
+    comment = request.params.get('comment', '')
+    
+    cursor = request.cursor
+    cursor.execute(
+        """UPDATE card_requests
+           SET status = 'rejected', admin_comment = %s, processed_at = CURRENT_TIMESTAMP
+           WHERE id = %s
+           RETURNING user_id""",
+        (comment, request_id)
+    )
+    rejected = cursor.fetchone()
+    request.commit()
+    if rejected:
+        cache.dashboard.invalidate(rejected['user_id'])
+    
+    return runtime.ok({'success': True, 'message': 'Card request rejected'})
+
+
+def update_card_status(request: runtime.Request) -> Dict[str, Any]:
+    card_id = request.params.get('card_id')
+    status = request.params.get('status')
+    
+    if status not in ['active', 'blocked', 'frozen']:
+        return runtime.error(400, 'Invalid status')
+    
+    cursor = request.cursor
+    cursor.execute("UPDATE cards SET status = %s WHERE id = %s RETURNING user_id", (status, card_id))
+    card = cursor.fetchone()
+    request.commit()
+    if card:
+        cache.dashboard.invalidate(card['user_id'])
+    
+    return runtime.ok({'success': True, 'message': f'Card {status}'})
+
+
+def add_balance(request: runtime.Request) -> Dict[str, Any]:
+    card_id = request.params.get('card_id')
+    amount = ledger.parse_adjustment(request.params.get('amount', 0))
+    
+    if not card_id or amount is None:
+        return runtime.error(400, 'Invalid amount')
+    
+    try:
+        owner_id = ledger.post_adjustment(request.cursor, card_id, amount)
+    except ledger.InsufficientFunds as e:
+        request.conn.rollback()
+        return runtime.error(409, str(e))
+    if owner_id is None:
+        request.conn.rollback()
+        return runtime.error(404, 'Card not found')
+    request.commit(lambda: cache.dashboard.invalidate(owner_id))
+    
+    return runtime.ok({'success': True, 'message': 'Balance updated'})
+
+
+def reconcile_ledger(request: runtime.Request) -> Dict[str, Any]:
+    grace_seconds = str(request.params.get('grace_seconds', 60))
+    
+    if not grace_seconds.isdigit():
+        return runtime.error(400, 'Invalid grace_seconds')
+    
+    problems = ledger.reconcile(request.cursor, int(grace_seconds))
+    request.commit()
+    
+    return runtime.ok({'success': not problems, 'problems': problems})
+
+
+def maintain_partitions(request: runtime.Request) -> Dict[str, Any]:
+    retention_months = str(request.params.get('retention_months', partitions.RETENTION_MONTHS))
+    archive_limit = request.params.get('archive_limit')
+    
+    if not retention_months.isdigit() or int(retention_months) < 1:
+        return runtime.error(400, 'Invalid retention_months')
+    if archive_limit is not None and not str(archive_limit).isdigit():
+        return runtime.error(400, 'Invalid archive_limit')
+    
+    outcome = partitions.maintain(
+        request.conn,
+        retention_months=int(retention_months),
+        archive_limit=int(archive_limit) if archive_limit is not None else None
+    )
+    
+    return runtime.ok({'success': True, **outcome})
+
+
+def revoke_sessions(request: runtime.Request) -> Dict[str, Any]:
+    user_id = str(request.params.get('user_id', ''))
+    
+    if not user_id.isdigit():
+        return runtime.error(400, 'Invalid user_id')
+    
+    sessions.revoke(request.cursor, int(user_id))
+    request.commit()
+    sessions.revocations.refresh(request.database_url, force=True)
+    
+    return runtime.ok({'success': True, 'message': 'Sessions revoked'})
+
+
+def block_user(request: runtime.Request) -> Dict[str, Any]:
+    user_id = str(request.params.get('user_id', ''))
+    blocked = request.params.get('blocked', True)
+    
+    if not user_id.isdigit():
+        return runtime.error(400, 'Invalid user_id')
+    if not isinstance(blocked, bool):
+        return runtime.error(400, 'Invalid blocked')
+    
+    if not sessions.block(request.cursor, int(user_id), blocked):
+        request.conn.rollback()
+        return runtime.error(404, 'User not found')
+    request.commit()
+    sessions.revocations.refresh(request.database_url, force=True)
+    
+    return runtime.ok({'success': True, 'message': 'User blocked' if blocked else 'User unblocked'})
+
+
+def update_user(request: runtime.Request) -> Dict[str, Any]:
+    user_id = request.params.get('user_id')
+    updates = request.params.get('updates', {})
+    
+    allowed_fields = ['first_name', 'last_name', 'phone', 'email', 'birth_year']
+    update_parts = []
+    values = []
+    
+    for field, value in updates.items():
+        if field in allowed_fields:
+            update_parts.append(f"{field} = %s")
+            values.append(value)
+    
+    if update_parts:
+        values.append(user_id)
+        query = f"UPDATE users SET {', '.join(update_parts)} WHERE id = %s"
+        request.cursor.execute(query, values)
+        request.commit()
+        cache.dashboard.invalidate(user_id)
+    
+    return runtime.ok({'success': True, 'message': 'User updated'})
+
+
+def delete_card(request: runtime.Request) -> Dict[str, Any]:
+    card_id = request.params.get('card_id')
+    cursor = request.cursor
+    cursor.execute("UPDATE cards SET is_active = FALSE WHERE id = %s RETURNING user_id", (card_id,))
+    card = cursor.fetchone()
+    request.commit()
+    if card:
+        cache.dashboard.invalidate(card['user_id'])
+    
+    return runtime.ok({'success': True, 'message': 'Card deleted'})
+
+
+ROUTES = admission.guard({
+    'GET': {
+        **{name: listing for name in listings.LISTINGS},
+        'balance_at': balance_at,
+        'overview': bank_overview,
+        'search': search_users,
+    },
+    'POST': {
+        'approve_card': idempotency.keyed(approve_card),
+        'process_requests': process_requests,
+        'reject_card': reject_card,
+        'update_card_status': update_card_status,
+        'add_balance': idempotency.keyed(add_balance),
+        'reconcile_ledger': reconcile_ledger,
+        'check_overview': check_overview,
+        'maintain_partitions': maintain_partitions,
+        'revoke_sessions': revoke_sessions,
+        'block_user': block_user,
+        'update_user': update_user,
+    },
+    'DELETE': {
+        'delete_card': delete_card,
+    },
+})
+
+
+@tracing.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Admin panel API for managing users and cards
@@ -12,250 +364,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
           context - object with attributes: request_id, function_name
     Returns: HTTP response dict with admin data
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Is-Admin',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    database_url = os.environ.get('DATABASE_URL')
-    if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'})
-        }
-    
-    headers = event.get('headers', {})
-    is_admin = headers.get('X-Is-Admin') or headers.get('x-is-admin')
-    
-    if is_admin != 'true':
-        return {
-            'statusCode': 403,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Access denied'})
-        }
-    
-    conn = psycopg2.connect(database_url)
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    try:
-        if method == 'GET':
-            action = event.get('queryStringParameters', {}).get('action', 'users')
-            
-            if action == 'users':
-                cursor.execute(
-                    """SELECT id, username, email, first_name, last_name, phone, birth_year, is_admin, created_at 
-                       FROM users 
-                       ORDER BY created_at DESC"""
-                )
-                users = cursor.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'users': [dict(u) for u in users]}, default=str)
-                }
-            
-            elif action == 'card_requests':
-                cursor.execute(
-                    """SELECT cr.*, u.username, u.first_name, u.last_name, u.phone 
-                       FROM card_requests cr 
-                       JOIN users u ON cr.user_id = u.id 
-                       ORDER BY cr.created_at DESC"""
-                )
-                requests = cursor.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'requests': [dict(r) for r in requests]}, default=str)
-                }
-            
-            elif action == 'all_cards':
-                cursor.execute(
-                    """SELECT c.*, u.username, u.first_name, u.last_name 
-                       FROM cards c 
-                       JOIN users u ON c.user_id = u.id 
-                       ORDER BY c.created_at DESC"""
-                )
-                cards = cursor.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'cards': [dict(c) for c in cards]}, default=str)
-                }
-        
-        elif method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            action = body_data.get('action')
-            
-            if action == 'approve_card':
-                request_id = body_data.get('request_id')
-                card_number = body_data.get('card_number')
-                
-                if not request_id or not card_number:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Missing required fields'})
-                    }
-                
-                cursor.execute("SELECT * FROM card_requests WHERE id = %s", (request_id,))
-                request = cursor.fetchone()
-                
-                if not request:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Request not found'})
-                    }
-                
-                cursor.execute("SELECT first_name, last_name FROM users WHERE id = %s", (request['user_id'],))
-                user = cursor.fetchone()
-                owner_name = f"{user['first_name']} {user['last_name']}"
-                
-                masked = f"{card_number[:4]} •••• •••• {card_number[-4:]}"
-                colors = ['from-purple-500 to-pink-500', 'from-blue-500 to-cyan-500', 
-                          'from-orange-500 to-red-500', 'from-green-500 to-emerald-500']
-                
-                cursor.execute(
-                    """INSERT INTO cards (user_id, card_number, masked_number, card_type, card_category, balance, color_scheme, status) 
-                       VALUES (%s, %s, %s, 'virtual', %s, 0, %s, 'active')""",
-                    (request['user_id'], card_number, masked, request['card_category'], random.choice(colors))
-                )
-                
-                cursor.execute(
-                    "UPDATE card_requests SET status = 'approved', processed_at = CURRENT_TIMESTAMP WHERE id = %s",
-                    (request_id,)
-                )
-                
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'message': 'Card approved and issued'})
-                }
-            
-            elif action == 'reject_card':
-                request_id = body_data.get('request_id')
-                comment = body_data.get('comment', '')
-                
-                cursor.execute(
-                    """UPDATE card_requests 
-                       SET status = 'rejected', admin_comment = %s, processed_at = CURRENT_TIMESTAMP 
-                       WHERE id = %s""",
-                    (comment, request_id)
-                )
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'message': 'Card request rejected'})
-                }
-            
-            elif action == 'update_card_status':
-                card_id = body_data.get('card_id')
-                status = body_data.get('status')
-                
-                if status not in ['active', 'blocked', 'frozen']:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid status'})
-                    }
-                
-                cursor.execute("UPDATE cards SET status = %s WHERE id = %s", (status, card_id))
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'message': f'Card {status}'})
-                }
-            
-            elif action == 'add_balance':
-                card_id = body_data.get('card_id')
-                amount = float(body_data.get('amount', 0))
-                
-                cursor.execute(
-                    "UPDATE cards SET balance = balance + %s WHERE id = %s",
-                    (amount, card_id)
-                )
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'message': 'Balance updated'})
-                }
-            
-            elif action == 'update_user':
-                user_id = body_data.get('user_id')
-                updates = body_data.get('updates', {})
-                
-                allowed_fields = ['first_name', 'last_name', 'phone', 'email', 'birth_year']
-                update_parts = []
-                values = []
-                
-                for field, value in updates.items():
-                    if field in allowed_fields:
-                        update_parts.append(f"{field} = %s")
-                        values.append(value)
-                
-                if update_parts:
-                    values.append(user_id)
-                    query = f"UPDATE users SET {', '.join(update_parts)} WHERE id = %s"
-                    cursor.execute(query, values)
-                    conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'message': 'User updated'})
-                }
-        
-        elif method == 'DELETE':
-            body_data = json.loads(event.get('body', '{}'))
-            action = body_data.get('action')
-            
-            if action == 'delete_card':
-                card_id = body_data.get('card_id')
-                cursor.execute("UPDATE cards SET is_active = FALSE WHERE id = %s", (card_id,))
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'message': 'Card deleted'})
-                }
-        
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
-    
-    finally:
-        cursor.close()
-        conn.close()
+    return runtime.dispatch(event, context, ROUTES, PREFLIGHT, auth='admin', default_action='users')
@@ -0,0 +1,207 @@
+'''
+Business: Card issuance for approved requests: Luhn-valid card numbers generated
+server-side and bulk approve/reject of card requests in set-based statements
+'''
+import random
+import secrets
+from datetime import datetime
+from typing import Any, Dict, List, Sequence, Tuple
+
+CARD_PREFIXES = {'debit': '4532', 'credit': '5421'}
+CARD_NUMBER_LENGTH = 16
+COLOR_SCHEMES = ['from-purple-500 to-pink-500', 'from-blue-500 to-cyan-500',
+                 'from-orange-500 to-red-500', 'from-green-500 to-emerald-500']
+MAX_BULK_REQUESTS = 5000
+MAX_NUMBER_ATTEMPTS = 5
+DECISIONS = ('approve', 'reject')
+
+
+class InvalidSelection(ValueError):
+    pass
+
+
+def luhn_check_digit(partial: str) -> str:
+    total = 0
+    for index, char in enumerate(reversed(partial)):
+        digit = int(char)
+        if index % 2 == 0:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return str((10 - total % 10) % 10)
+
+
+def is_luhn_valid(number: str) -> bool:
+    return number.isdigit() and len(number) > 1 and luhn_check_digit(number[:-1]) == number[-1]
+
+
+def generate_card_number(category: str) -> str:
+    prefix = CARD_PREFIXES[category]
+    body = prefix + ''.join(str(secrets.randbelow(10)) for _ in range(CARD_NUMBER_LENGTH - len(prefix) - 1))
+    return body + luhn_check_digit(body)
+
+
+def mask_card_number(number: str) -> str:
+    return f"{number[:4]} •••• •••• {number[-4:]}"
+
+
+def select_requests(cursor: Any, request_ids: Any, selection: Any, limit: Any) -> List[Tuple[int, int, str, str]]:
+    '''
+    Business: Lock the card requests a bulk decision applies to
+    Args: cursor - open tuple cursor inside the bulk transaction
+          request_ids - explicit list of ids, or None
+          selection - filter dict (category, user_id, from_date, to_date) over pending
+                      requests when no ids are given; locked rows of a concurrent
+                      run are skipped
+          limit - cap for filter selections, at most MAX_BULK_REQUESTS
+    Returns: (id, user_id, card_category, status) tuples ordered by id
+    Raises: InvalidSelection for malformed input
+    '''
+    if request_ids is not None:
+        if not isinstance(request_ids, list) or not request_ids or len(request_ids) > MAX_BULK_REQUESTS:
+            raise InvalidSelection('Invalid request_ids')
+        if not all(str(request_id).isdigit() for request_id in request_ids):
+            raise InvalidSelection('Invalid request_ids')
+        cursor.execute(
+            """SELECT id, user_id, card_category, status FROM card_requests
+               WHERE id = ANY(%s)
+               ORDER BY id
+               FOR UPDATE""",
+            (sorted({int(request_id) for request_id in request_ids}),)
+        )
+        return cursor.fetchall()
+
+    if not isinstance(selection, dict):
+        raise InvalidSelection('Provide request_ids or filter')
+    conditions = ["status = 'pending'"]
+    values: List[Any] = []
+    if selection.get('category') not in (None, ''):
+        if selection['category'] not in CARD_PREFIXES:
+            raise InvalidSelection('Invalid category')
+        conditions.append('card_category = %s')
+        values.append(selection['category'])
+    if selection.get('user_id') not in (None, ''):
+        if not str(selection['user_id']).isdigit():
+            raise InvalidSelection('Invalid user_id')
+        conditions.append('user_id = %s')
+        values.append(int(selection['user_id']))
+    for field, operator in (('from_date', '>='), ('to_date', '<')):
+        if selection.get(field) not in (None, ''):
+            try:
+                values.append(datetime.fromisoformat(str(selection[field])))
+            except ValueError:
+                raise InvalidSelection(f'Invalid {field}')
+            conditions.append(f'created_at {operator} %s')
+    limit = str(limit if limit is not None else MAX_BULK_REQUESTS)
+    if not limit.isdigit() or not 1 <= int(limit) <= MAX_BULK_REQUESTS:
+        raise InvalidSelection('Invalid limit')
+    values.append(int(limit))
+    cursor.execute(
+        f"""SELECT id, user_id, card_category, status FROM card_requests
+            WHERE {' AND '.join(conditions)}
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED""",
+        values
+    )
+    return cursor.fetchall()
+
+
+def issue_cards(cursor: Any, requests: Sequence[Tuple[int, int, str]]) -> Dict[int, Tuple[int, str]]:
+    '''
+    Business: Insert one active virtual card per request with fresh card numbers
+    Numbers that collide with an existing card (unique index) are regenerated
+    and only those rows are inserted again.
+    Args: cursor - open tuple cursor; the caller commits
+          requests - (request_id, user_id, card_category) tuples
+    Returns: dict request_id -> (card_id, masked_number)
+    '''
+    issued: Dict[int, Tuple[int, str]] = {}
+    pending = list(requests)
+    for _ in range(MAX_NUMBER_ATTEMPTS):
+        if not pending:
+            break
+        numbers: Dict[str, Tuple[int, int, str]] = {}
+        for request in pending:
+            number = generate_card_number(request[2])
+            while number in numbers:
+                number = generate_card_number(request[2])
+            numbers[number] = request
+        cursor.execute(
+            """INSERT INTO cards (user_id, card_number, masked_number, card_type, card_category, balance, color_scheme, status)
+               SELECT user_id, card_number, masked_number, 'virtual', card_category, 0, color_scheme, 'active'
+               FROM unnest(%s::int[], %s::varchar[], %s::varchar[], %s::varchar[], %s::varchar[])
+                    AS r(user_id, card_number, masked_number, card_category, color_scheme)
+               ON CONFLICT (card_number) DO NOTHING
+               RETURNING id, card_number""",
+            (
+                [request[1] for request in numbers.values()],
+                list(numbers),
+                [mask_card_number(number) for number in numbers],
+                [request[2] for request in numbers.values()],
+                [random.choice(COLOR_SCHEMES) for _ in numbers],
+            )
+        )
+        for card_id, number in cursor.fetchall():
+            issued[numbers[number][0]] = (card_id, mask_card_number(number))
+        pending = [request for request in pending if request[0] not in issued]
+    if pending:
+        raise RuntimeError('Could not allocate unique card numbers')
+    return issued
+
+
+def process_requests(conn: Any, decision: str, request_ids: Any = None, selection: Any = None,
+                     limit: Any = None, comment: str = '') -> Dict[str, Any]:
+    '''
+    Business: Approve or reject many card requests in one transaction
+    Args: conn - open connection; the caller commits
+          decision - 'approve' issues a card per pending request, 'reject' marks them rejected
+          request_ids / selection / limit - see select_requests
+          comment - admin comment stored on rejected requests
+    Returns: dict with per-request 'results', 'processed' / 'skipped' counts and
+             the 'user_ids' whose requests changed
+    Raises: InvalidSelection for malformed input
+    '''
+    if decision not in DECISIONS:
+        raise InvalidSelection('Invalid decision')
+    with conn.cursor() as cursor:
+        rows = select_requests(cursor, request_ids, selection, limit)
+        found = {row[0]: row for row in rows}
+        results: Dict[int, Dict[str, Any]] = {}
+        for request_id in (sorted({int(r) for r in request_ids}) if request_ids is not None else sorted(found)):
+            row = found.get(request_id)
+            if row is None:
+                results[request_id] = {'request_id': request_id, 'status': 'failed', 'error': 'Request not found'}
+            elif row[3] != 'pending':
+                results[request_id] = {'request_id': request_id, 'status': 'failed',
+                                       'error': f'Request already {row[3]}'}
+        pending = [row for row in rows if row[3] == 'pending']
+        ids = [row[0] for row in pending]
+
+        if decision == 'approve':
+            issued = issue_cards(cursor, [row[:3] for row in pending])
+            for request_id, (card_id, masked) in issued.items():
+                results[request_id] = {'request_id': request_id, 'status': 'approved',
+                                       'card_id': card_id, 'masked_number': masked}
+            cursor.execute(
+                """UPDATE card_requests SET status = 'approved', processed_at = CURRENT_TIMESTAMP
+                   WHERE id = ANY(%s)""",
+                (ids,)
+            )
+        else:
+            cursor.execute(
+                """UPDATE card_requests
+                   SET status = 'rejected', admin_comment = %s, processed_at = CURRENT_TIMESTAMP
+                   WHERE id = ANY(%s)""",
+                (comment, ids)
+            )
+            for request_id in ids:
+                results[request_id] = {'request_id': request_id, 'status': 'rejected'}
+
+    return {
+        'results': [results[request_id] for request_id in sorted(results)],
+        'processed': len(ids),
+        'skipped': len(results) - len(ids),
+        'user_ids': sorted({row[1] for row in pending}),
+    }
@@ -0,0 +1,70 @@
+'''
+Business: Admin access to the double-entry ledger: balance adjustments,
+historical balances and incremental reconciliation
+'''
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, List, Optional
+
+CENT = Decimal('0.01')
+MAX_AMOUNT = Decimal('9999999999999.99')
+
+
+class InsufficientFunds(ValueError):
+    pass
+
+
+def parse_adjustment(raw: Any) -> Optional[Decimal]:
+    '''
+    Business: Validate an admin balance change; negative values withdraw money
+    Args: raw - amount from the request body
+    Returns: non-zero Decimal with two fraction digits, or None if invalid
+    '''
+    if raw is None or isinstance(raw, bool):
+        return None
+    try:
+        amount = Decimal(str(raw))
+    except (InvalidOperation, ValueError):
+        return None
+    if not amount.is_finite() or amount == 0 or abs(amount) > MAX_AMOUNT or amount != amount.quantize(CENT):
+        return None
+    return amount.quantize(CENT)
+
+
+def post_adjustment(cursor: Any, card_id: Any, amount: Decimal) -> Optional[int]:
+    '''
+    Business: Change a card balance through the ledger against the bank's external account
+    Args: cursor - open cursor; the caller commits
+          card_id - card to credit (or debit for a negative amount)
+          amount - value from parse_adjustment
+    Returns: id of the card owner, or None if the card does not exist
+    Raises: InsufficientFunds when a withdrawal would take the balance below zero
+    '''
+    cursor.execute("SELECT user_id, balance FROM cards WHERE id = %s FOR UPDATE", (card_id,))
+    card = cursor.fetchone()
+    if not card:
+        return None
+    if card['balance'] + amount < 0:
+        raise InsufficientFunds('Insufficient funds')
+    cursor.execute(
+        "SELECT ledger_apply(ARRAY[0, 0], ARRAY[%s, NULL]::int[], ARRAY[%s, %s]::numeric[], 'adjustment', ARRAY[NULL, NULL]::int[])",
+        (card_id, amount, -amount)
+    )
+    return card['user_id']
+
+
+def balance_at(cursor: Any, card_id: Any, at: Optional[datetime]) -> Optional[Decimal]:
+    cursor.execute("SELECT card_balance_at(%s, %s) AS balance", (card_id, at))
+    row = cursor.fetchone()
+    return row['balance'] if row else None
+
+
+def reconcile(cursor: Any, grace_seconds: int = 60) -> List[Dict[str, Any]]:
+    '''
+    Business: Compare cards.balance with the ledger for everything posted since the last run
+    Args: cursor - open RealDictCursor; the caller commits to advance the watermark
+          grace_seconds - entries younger than this are checked again next run
+    Returns: list of problems (balance_mismatch / unbalanced_posting); empty when consistent
+    '''
+    cursor.execute("SELECT * FROM ledger_reconcile(make_interval(secs => %s))", (grace_seconds,))
+    return [dict(row) for row in cursor.fetchall()]
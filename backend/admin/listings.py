@@ -0,0 +1,231 @@
+'''
+Business: Keyset-paginated admin listings and chunked NDJSON/CSV exports
+An export response holds at most EXPORT_MAX_ROWS rows; longer exports are
+continued with the X-Next-Cursor header, the same keyset cursor the listing
+pages use, so a function never builds an unbounded body in memory.
+'''
+import base64
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import encoder
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_MAX_ROWS = int(os.environ.get('ADMIN_EXPORT_MAX_ROWS', '50000'))
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+LISTINGS: Dict[str, Dict[str, Any]] = {
+    'users': {
+        'key': 'users',
+        'alias': 'u',
+        'sql': """SELECT u.id, u.username, u.email, u.first_name, u.last_name, u.phone, u.birth_year,
+                         u.is_admin, u.is_blocked, u.created_at
+                  FROM users u""",
+        'filters': {
+            'is_admin': ('u.is_admin = %s', 'bool'),
+            'is_blocked': ('u.is_blocked = %s', 'bool'),
+        },
+    },
+    'card_requests': {
+        'key': 'requests',
+        'alias': 'cr',
+        'sql': """SELECT cr.*, u.username, u.first_name, u.last_name, u.phone
+                  FROM card_requests cr
+                  JOIN users u ON cr.user_id = u.id""",
+        'filters': {
+            'status': ('cr.status = %s', 'str'),
+            'category': ('cr.card_category = %s', 'str'),
+            'user_id': ('cr.user_id = %s', 'int'),
+        },
+    },
+    'all_cards': {
+        'key': 'cards',
+        'alias': 'c',
+        'sql': """SELECT c.*, u.username, u.first_name, u.last_name
+                  FROM cards c
+                  JOIN users u ON c.user_id = u.id""",
+        'filters': {
+            'status': ('c.status = %s', 'str'),
+            'category': ('c.card_category = %s', 'str'),
+            'card_type': ('c.card_type = %s', 'str'),
+            'user_id': ('c.user_id = %s', 'int'),
+            'is_active': ('c.is_active = %s', 'bool'),
+        },
+    },
+}
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token: str) -> Tuple[datetime, int]:
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        parsed, row_id = datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise InvalidFilter('Invalid cursor')
+    # cursors are minted from naive created_at values; an offset could not be compared
+    if parsed.tzinfo is not None:
+        raise InvalidFilter('Invalid cursor')
+    return parsed, row_id
+
+
+def _convert(value: Any, kind: str, name: str) -> Any:
+    if kind == 'int':
+        try:
+            return int(value)
+        except (ValueError, TypeError):
+            raise InvalidFilter(f'Invalid {name}')
+    if kind == 'bool':
+        if str(value).lower() in ('true', '1'):
+            return True
+        if str(value).lower() in ('false', '0'):
+            return False
+        raise InvalidFilter(f'Invalid {name}')
+    return str(value)
+
+
+def build_query(name: str, params: Dict[str, Any], paged: bool = True) -> Tuple[str, List[Any], Optional[int]]:
+    '''
+    Business: Build the SQL for an admin listing with filters and keyset pagination
+    Args: name - listing name: users, card_requests or all_cards
+          params - query string parameters (filters, cursor, limit, from_date, to_date)
+          paged - False for exports, which take EXPORT_MAX_ROWS rows instead of limit
+    Returns: (sql, parameters, page size)
+    Raises: InvalidFilter for malformed parameters
+    '''
+    listing = LISTINGS[name]
+    alias = listing['alias']
+    conditions: List[str] = []
+    values: List[Any] = []
+
+    for field, (condition, kind) in listing['filters'].items():
+        value = params.get(field)
+        if value not in (None, ''):
+            conditions.append(condition)
+            values.append(_convert(value, kind, field))
+
+    for field, operator in (('from_date', '>='), ('to_date', '<')):
+        value = params.get(field)
+        if value not in (None, ''):
+            try:
+                values.append(datetime.fromisoformat(str(value)))
+            except ValueError:
+                raise InvalidFilter(f'Invalid {field}')
+            conditions.append(f'{alias}.created_at {operator} %s')
+
+    limit = EXPORT_MAX_ROWS
+    if paged:
+        limit = _convert(params.get('limit') or DEFAULT_PAGE_SIZE, 'int', 'limit')
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise InvalidFilter('Invalid limit')
+    if params.get('cursor'):
+        after_created_at, after_id = decode_cursor(str(params['cursor']))
+        conditions.append(f'({alias}.created_at, {alias}.id) < (%s, %s)')
+        values.extend([after_created_at, after_id])
+
+    sql = listing['sql']
+    if conditions:
+        sql += '\nWHERE ' + ' AND '.join(conditions)
+    sql += f'\nORDER BY {alias}.created_at DESC, {alias}.id DESC\nLIMIT %s'
+    values.append(limit + 1)
+    return sql, values, limit
+
+
+def fetch_page(conn: Any, name: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Business: Fetch one page of an admin listing
+    Args: conn - open connection; rows are read as plain tuples
+          name - listing name
+          params - query string parameters
+    Returns: dict with cursor 'description', tuple 'rows' and 'next_cursor'
+    '''
+    sql, values, limit = build_query(name, params)
+    with conn.cursor() as cursor:
+        cursor.execute(sql, values)
+        rows = cursor.fetchall()
+        description = cursor.description
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        columns = [column[0] for column in description]
+        last = rows[-1]
+        next_cursor = encode_cursor(last[columns.index('created_at')], last[columns.index('id')])
+    return {'description': description, 'rows': rows, 'next_cursor': next_cursor}
+
+
+def _cell(value: Any) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return str(value)
+
+
+def export_page(conn: Any, name: str, params: Dict[str, Any], fmt: str) -> Dict[str, Any]:
+    '''
+    Business: Read up to EXPORT_MAX_ROWS rows of an admin listing through a server-side cursor
+    Args: conn - open connection (inside a transaction, as named cursors require)
+          name - listing name
+          params - filters and an optional cursor; limit is ignored
+          fmt - 'ndjson' or 'csv'
+    Returns: dict with the encoded 'body', the number of 'rows' and
+             'next_cursor' (None on the last page)
+    '''
+    sql, values, limit = build_query(name, params, paged=False)
+    chunks: List[str] = []
+    count = 0
+    last = None
+    more = False
+    cursor = conn.cursor(name=f'export_{name}')
+    cursor.itersize = EXPORT_CHUNK_SIZE
+    try:
+        cursor.execute(sql, values)
+        layout: Optional[encoder.Layout] = None
+        while not more:
+            rows = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if layout is None:
+                layout = encoder.layout_for(cursor.description)
+                if fmt == 'csv':
+                    header = io.StringIO()
+                    csv.writer(header).writerow(layout.columns)
+                    chunks.append(header.getvalue())
+            if count + len(rows) > limit:
+                # the query reads one row past the page to know whether there is more
+                rows = rows[:limit - count]
+                more = True
+            if not rows:
+                break
+            count += len(rows)
+            last = rows[-1]
+            if fmt == 'csv':
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for row in rows:
+                    writer.writerow([_cell(value) for value in row])
+                chunks.append(buffer.getvalue())
+            else:
+                chunks.append(''.join([layout.encode_row(row) + '\n' for row in rows]))
+    finally:
+        cursor.close()
+
+    next_cursor = None
+    if more:
+        next_cursor = encode_cursor(last[layout.columns.index('created_at')], last[layout.columns.index('id')])
+    return {'body': ''.join(chunks), 'rows': count, 'next_cursor': next_cursor}
@@ -0,0 +1,107 @@
+'''
+Business: Operational overview of the bank from trigger-maintained counters
+Reads admin_counters and the pending card request histogram (V0014), a few
+dozen rows whatever the size of cards, card_requests and users, and compares
+them with the tables on demand (check) or recounts them (repair). The
+histogram gets a row per hour and writer slot and is folded back by compact.
+'''
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+AGE_PERCENTILES = (50, 90, 99)
+
+
+def _age_percentiles(hours: List[Tuple[float, int]]) -> Dict[str, Optional[float]]:
+    '''
+    Business: Age percentiles of pending requests in hours, from counts per creation hour
+    Args: hours - (age of the creation hour, pending requests created in it), oldest first
+    Ages are measured from the start of the creation hour, so they may be
+    overstated by up to an hour.
+    '''
+    ages: Dict[str, Optional[float]] = {f'p{p}': None for p in AGE_PERCENTILES}
+    ages['max'] = round(hours[0][0], 1) if hours else None
+    total = sum(items for _, items in hours)
+    seen = 0
+    targets = [(p, total * p / 100) for p in AGE_PERCENTILES]
+    # youngest first: the p-th percentile is the age p% of requests do not exceed
+    for age, items in reversed(hours):
+        seen += items
+        while targets and seen >= targets[0][1]:
+            ages[f'p{targets.pop(0)[0]}'] = round(age, 1)
+    return ages
+
+
+def read(cursor: Any) -> Dict[str, Any]:
+    '''
+    Business: Totals by card status and category, card requests and users
+    Args: cursor - open RealDictCursor
+    Returns: dict with 'cards', 'card_requests' and 'users' sections
+    '''
+    cursor.execute(
+        """SELECT metric, status, category, SUM(items)::BIGINT AS items, SUM(amount) AS amount
+           FROM admin_counters
+           GROUP BY 1, 2, 3
+           HAVING SUM(items) <> 0 OR SUM(amount) <> 0"""
+    )
+    counters = cursor.fetchall()
+    cursor.execute(
+        """SELECT GREATEST(EXTRACT(EPOCH FROM LOCALTIMESTAMP - hour), 0)::FLOAT / 3600 AS age, SUM(items)::BIGINT AS items
+           FROM card_requests_pending_hours
+           GROUP BY hour
+           HAVING SUM(items) > 0
+           ORDER BY hour"""
+    )
+    hours = [(row['age'], row['items']) for row in cursor.fetchall()]
+
+    cards: Dict[str, Any] = {'total': 0, 'balance': Decimal('0'), 'by_status': {}, 'by_category': {}}
+    requests: Dict[str, Any] = {'total': 0, 'by_status': {}, 'pending_by_category': {}}
+    users: Dict[str, Any] = {'total': 0, 'admins': 0}
+    for row in counters:
+        metric, status, category, items = row['metric'], row['status'], row['category'], row['items']
+        if metric == 'cards':
+            cards['total'] += items
+            cards['balance'] += row['amount']
+            for group, key in (('by_status', status), ('by_category', category)):
+                entry = cards[group].setdefault(key, {'count': 0, 'balance': Decimal('0')})
+                entry['count'] += items
+                entry['balance'] += row['amount']
+        elif metric == 'card_requests':
+            requests['total'] += items
+            requests['by_status'][status] = requests['by_status'].get(status, 0) + items
+            if status == 'pending':
+                requests['pending_by_category'][category] = items
+        elif metric == 'users':
+            users['total'] += items
+            if status == 'admin':
+                users['admins'] += items
+
+    requests['pending'] = requests['by_status'].get('pending', 0)
+    requests['pending_age_hours'] = _age_percentiles(hours)
+    return {'cards': cards, 'card_requests': requests, 'users': users}
+
+
+def check(cursor: Any) -> List[Dict[str, Any]]:
+    '''
+    Business: Counters that disagree with the tables; empty when consistent
+    Args: cursor - open RealDictCursor
+    '''
+    cursor.execute('SELECT * FROM admin_counters_check()')
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def compact(cursor: Any) -> int:
+    '''
+    Business: Fold the histogram slots of each hour into one row and drop empty hours
+    Args: cursor - open RealDictCursor; the caller commits
+    Returns: number of histogram rows removed
+    '''
+    cursor.execute('SELECT card_requests_pending_compact() AS removed')
+    return cursor.fetchone()['removed']
+
+
+def repair(cursor: Any) -> None:
+    '''
+    Business: Recount every counter from the tables
+    Briefly blocks writes to cards, card_requests and users; the caller commits.
+    '''
+    cursor.execute('SELECT admin_counters_rebuild()')
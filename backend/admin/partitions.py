@@ -0,0 +1,90 @@
+'''
+Business: Maintenance of the monthly partitions of the transactions table
+Creates partitions TRANSACTIONS_PARTITIONS_AHEAD months ahead, detaches the
+ones older than TRANSACTIONS_RETENTION_MONTHS and moves their rows into the
+compressed transactions_archive table (see V0012). Every step commits on its
+own, so the exclusive lock DETACH PARTITION takes on transactions is held
+only for the detach itself, never while a month is being compressed.
+
+Nothing runs it on its own: call POST maintain_partitions (admin) or this
+module from a monthly scheduler. Until a month's partition exists its rows go
+to transactions_default, and attaching the partition later locks and scans
+that default partition (V0018).
+
+Usage: DATABASE_URL=postgresql://... python partitions.py
+'''
+import json
+import os
+import sys
+from typing import Any, Dict, List, Optional
+
+import db
+
+MONTHS_AHEAD = int(os.environ.get('TRANSACTIONS_PARTITIONS_AHEAD', '3'))
+RETENTION_MONTHS = int(os.environ.get('TRANSACTIONS_RETENTION_MONTHS', '24'))
+ARCHIVE_CHUNK_ROWS = 10000
+DETACH_LOCK_TIMEOUT = '5s'
+
+
+def _names(cursor: Any) -> List[str]:
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _partition(detached_name: str) -> str:
+    return detached_name.replace('transactions_detached_', 'transactions_')
+
+
+def maintain(conn: Any, months_ahead: int = MONTHS_AHEAD, retention_months: int = RETENTION_MONTHS,
+             archive_limit: Optional[int] = None) -> Dict[str, Any]:
+    '''
+    Business: Create future partitions, detach expired ones and archive detached ones
+    Args: conn - open connection outside a transaction; each step is committed
+          months_ahead - months after the current one that must have a partition
+          retention_months - whole months kept attached before the current one
+          archive_limit - detached partitions to compress in this call, None for all
+    Returns: dict with 'created', 'detached' partition names and 'archived'
+             {partition: rows}
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT transactions_ensure_partitions(%s)', (months_ahead,))
+        created = _names(cursor)
+    conn.commit()
+
+    with conn.cursor() as cursor:
+        # give up rather than queue every insert behind a lock waiting for a long reader
+        cursor.execute(f"SET LOCAL lock_timeout = '{DETACH_LOCK_TIMEOUT}'")
+        cursor.execute(
+            """SELECT transactions_detach_partitions(
+                   date_trunc('month', LOCALTIMESTAMP) - make_interval(months => %s)
+               )""",
+            (retention_months,)
+        )
+        detached = [_partition(name) for name in _names(cursor)]
+    conn.commit()
+
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT transactions_detached_tables()')
+        pending = _names(cursor)
+    archived: Dict[str, int] = {}
+    for name in pending[:archive_limit]:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT transactions_archive_table(%s, %s)', (name, ARCHIVE_CHUNK_ROWS))
+            archived[_partition(name)] = cursor.fetchone()[0]
+        conn.commit()
+
+    return {'created': created, 'detached': detached, 'archived': archived}
+
+
+def main() -> None:
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn or len(sys.argv) != 1:
+        raise SystemExit('Usage: DATABASE_URL=... python partitions.py')
+    conn = db.acquire(dsn)
+    try:
+        print(json.dumps(maintain(conn)))
+    finally:
+        db.release(dsn, conn)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+'''
+Business: Ranked admin search over users, their cards and pending card requests
+One query finds candidates through indexes only (V0015): exact username,
+email or phone, the start of any word of users.search_text (a query that is
+mostly digits, e.g. '+7 900 123', is searched as one run of digits, the way
+phones are stored there), the last four digits or the full number of a card
+and, where pg_trgm is installed, words
+similar to the query (typos). It ranks them and returns each hit with the
+user's cards and pending requests.
+'''
+import re
+from typing import Any, Dict, List, Optional
+
+import listings
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MIN_QUERY_LENGTH = 2
+MAX_QUERY_LENGTH = 100
+# rows each index may contribute before ranking, so a short common prefix
+# cannot make the query rank the whole table
+MAX_CANDIDATES = 200
+
+# rank by how the user matched; similar words (0..1) decide between hits of a kind
+RANKS = {'exact': 1.0, 'card_number': 0.95, 'card_last4': 0.7, 'prefix': 0.5, 'similar': 0.0}
+
+_trigrams: Optional[bool] = None
+
+
+def has_trigrams(cursor: Any) -> bool:
+    '''
+    Business: Whether pg_trgm is installed, checked once per container
+    '''
+    global _trigrams
+    if _trigrams is None:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') AS installed")
+        _trigrams = bool(cursor.fetchone()['installed'])
+    return _trigrams
+
+
+def parse(params: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Business: Query text and limit from ?q=...&limit=...
+    Raises: listings.InvalidFilter
+    '''
+    text = ' '.join(str(params.get('q') or '').split())
+    if len(text) < MIN_QUERY_LENGTH or len(text) > MAX_QUERY_LENGTH:
+        raise listings.InvalidFilter(f'Query must be {MIN_QUERY_LENGTH} to {MAX_QUERY_LENGTH} characters')
+    try:
+        limit = int(params.get('limit') or DEFAULT_LIMIT)
+    except (TypeError, ValueError):
+        raise listings.InvalidFilter('Invalid limit')
+    if limit < 1 or limit > MAX_LIMIT:
+        raise listings.InvalidFilter('Invalid limit')
+    digits = re.sub(r'[^0-9]', '', text)
+    digits = digits if digits and len(digits) * 2 >= len(text) else None
+    return {
+        'text': text,
+        'digits': digits,
+        # search_text holds a phone as one word of digits
+        'words': digits or text,
+        'limit': limit,
+    }
+
+
+def _candidates(query: Dict[str, Any], trigrams: bool) -> List[str]:
+    digits = query['digits']
+    sources = [
+        """SELECT id AS user_id, 'exact' AS matched FROM users
+           WHERE username = %(text)s OR email = %(text)s OR normalize_phone(phone) = normalize_phone(%(text)s)""",
+        """(SELECT id, 'prefix' FROM users
+            WHERE to_tsvector('simple', search_text) @@ (
+                SELECT to_tsquery('simple', string_agg(quote_literal(lexeme) || ':*', ' & '))
+                FROM unnest(to_tsvector('simple', search_normalize(%(words)s)))
+            )
+            LIMIT %(candidates)s)""",
+    ]
+    if digits and len(digits) == 4:
+        sources.append(
+            """(SELECT user_id, 'card_last4' FROM cards
+                WHERE right(normalize_card_number(card_number), 4) = %(digits)s
+                LIMIT %(candidates)s)"""
+        )
+    if digits and len(digits) >= 12:
+        sources.append(
+            "SELECT user_id, 'card_number' FROM cards WHERE normalize_card_number(card_number) = %(digits)s"
+        )
+    if trigrams:
+        sources.append(
+            """(SELECT id, 'similar' FROM users
+                WHERE search_normalize(%(text)s) <%% search_text
+                LIMIT %(candidates)s)"""
+        )
+    return sources
+
+
+def run(cursor: Any, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+    '''
+    Business: Ranked users matching the query, each with 'cards' and 'pending_requests'
+    Args: cursor - open RealDictCursor
+          query - parse() result
+    Returns: up to query['limit'] users, best first, with 'rank' and 'matched'
+    '''
+    trigrams = has_trigrams(cursor)
+    similarity = 'word_similarity(search_normalize(%(text)s), u.search_text)' if trigrams else '0'
+    ranks = ' '.join(f"WHEN '{name}' THEN {rank}" for name, rank in RANKS.items())
+    cursor.execute(
+        f"""WITH candidates AS (
+                {' UNION ALL '.join(_candidates(query, trigrams))}
+            ), best AS (
+                SELECT user_id, MAX(CASE matched {ranks} END) AS kind_rank,
+                       (array_agg(matched ORDER BY CASE matched {ranks} END DESC))[1] AS matched
+                FROM candidates
+                GROUP BY user_id
+            ), ranked AS (
+                SELECT u.id, b.matched, ROUND((b.kind_rank + {similarity} * 0.3)::NUMERIC, 3)::FLOAT AS rank
+                FROM best b
+                JOIN users u ON u.id = b.user_id
+                ORDER BY rank DESC, u.id
+                LIMIT %(limit)s
+            )
+            SELECT u.id, u.username, u.email, u.first_name, u.last_name, u.full_name, u.phone,
+                   u.is_admin, u.created_at, r.rank, r.matched,
+                   COALESCE((
+                       SELECT json_agg(json_build_object(
+                                  'id', c.id, 'masked_number', c.masked_number, 'card_type', c.card_type,
+                                  'card_category', c.card_category, 'status', c.status,
+                                  'balance', c.balance, 'is_active', c.is_active
+                              ) ORDER BY c.id)
+                       FROM cards c
+                       WHERE c.user_id = u.id
+                   ), '[]') AS cards,
+                   COALESCE((
+                       SELECT json_agg(json_build_object(
+                                  'id', cr.id, 'card_category', cr.card_category, 'created_at', cr.created_at
+                              ) ORDER BY cr.id)
+                       FROM card_requests cr
+                       WHERE cr.user_id = u.id AND cr.status = 'pending'
+                   ), '[]') AS pending_requests
+            FROM ranked r
+            JOIN users u ON u.id = r.id
+            ORDER BY r.rank DESC, u.id""",
+        {**query, 'candidates': MAX_CANDIDATES}
+    )
+    return [dict(row) for row in cursor.fetchall()]
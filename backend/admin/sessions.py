@@ -0,0 +1,287 @@
+'''
+Business: Stateless HMAC-signed session tokens and their verifier
+A token is '<key id>.<payload>.<signature>': the payload is base64url JSON
+[user_id, is_admin, expires_at, issued_at, token_id] and the signature is
+HMAC-SHA256 over '<key id>.<payload>'. SESSION_KEYS lists 'id:secret' pairs
+separated by commas; the first key signs, all of them verify, so a key is
+rotated by prepending the new one and dropping the old one after SESSION_TTL.
+Revoked tokens (logout), users signed out everywhere and blocked users are kept
+in the session_revocations table and cached in-process, refreshed at most every
+REVOCATION_REFRESH seconds. A block (block()) rejects every token of the user,
+whenever issued, until it is lifted, and login refuses blocked users.
+Each refresh re-reads REVOCATION_OVERLAP seconds before the previous one, so a
+revocation whose transaction committed late is still picked up.
+The legacy X-User-Id / X-Is-Admin headers, which anyone can send, are trusted
+only when SESSION_HEADER_AUTH=1 and SESSION_KEYS is unset; otherwise a request
+without a valid token is anonymous.
+Every cloud function directory ships an identical copy of this module.
+'''
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from typing import Any, Dict, NamedTuple, Optional, Set, Tuple
+
+import db
+
+SESSION_TTL = int(os.environ.get('SESSION_TTL', '43200'))
+REVOCATION_REFRESH = float(os.environ.get('REVOCATION_REFRESH', '15'))
+REVOCATION_OVERLAP = float(os.environ.get('REVOCATION_OVERLAP', '60'))
+HEADER_AUTH = os.environ.get('SESSION_HEADER_AUTH') == '1'
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class Claims(NamedTuple):
+    user_id: int
+    is_admin: bool
+    expires_at: int
+    issued_at: int
+    token_id: str
+
+
+def load_keys(raw: Optional[str] = None) -> Dict[str, bytes]:
+    raw = os.environ.get('SESSION_KEYS', '') if raw is None else raw
+    keys: Dict[str, bytes] = {}
+    for item in raw.split(','):
+        key_id, _, secret = item.strip().partition(':')
+        if key_id and secret:
+            keys[key_id] = secret.encode()
+    return keys
+
+
+KEYS = load_keys()
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _sign(key: bytes, message: str) -> str:
+    return _b64encode(hmac.new(key, message.encode(), hashlib.sha256).digest())
+
+
+def issue(user_id: int, is_admin: bool, ttl: int = SESSION_TTL, now: Optional[int] = None) -> Tuple[str, Claims]:
+    '''
+    Business: Create a signed session token with the active (first) key
+    Args: user_id, is_admin - identity carried by the token
+          ttl - lifetime in seconds
+    Returns: (token, claims)
+    Raises: InvalidToken when SESSION_KEYS is not configured
+    '''
+    if not KEYS:
+        raise InvalidToken('Session keys not configured')
+    key_id = next(iter(KEYS))
+    issued_at = int(time.time()) if now is None else now
+    claims = Claims(int(user_id), bool(is_admin), issued_at + ttl, issued_at, secrets.token_urlsafe(9))
+    payload = _b64encode(json.dumps(
+        [claims.user_id, int(claims.is_admin), claims.expires_at, claims.issued_at, claims.token_id],
+        separators=(',', ':')
+    ).encode())
+    message = f'{key_id}.{payload}'
+    return f'{message}.{_sign(KEYS[key_id], message)}', claims
+
+
+def verify(token: str, now: Optional[float] = None) -> Claims:
+    '''
+    Business: Check signature and expiry of a token without any I/O
+    Raises: InvalidToken
+    '''
+    try:
+        key_id, payload, signature = token.split('.')
+    except (AttributeError, ValueError):
+        raise InvalidToken('Malformed token')
+    key = KEYS.get(key_id)
+    if key is None:
+        raise InvalidToken('Unknown key')
+    if not hmac.compare_digest(_sign(key, f'{key_id}.{payload}'), signature):
+        raise InvalidToken('Bad signature')
+    try:
+        user_id, is_admin, expires_at, issued_at, token_id = json.loads(_b64decode(payload))
+    except (ValueError, TypeError):
+        raise InvalidToken('Malformed token')
+    if expires_at <= (time.time() if now is None else now):
+        raise InvalidToken('Token expired')
+    return Claims(user_id, bool(is_admin), expires_at, issued_at, token_id)
+
+
+class RevocationList:
+    '''
+    Business: In-process copy of session_revocations, refreshed incrementally
+    A refresh reads the rows revoked since the previous read's database time
+    minus overlap (all unexpired rows on the first read or after a gap of
+    SESSION_TTL). Ids and revoked_at (the inserting transaction's start) may
+    become visible out of order, so the rows a read could have missed are
+    read again; applying a row twice changes nothing.
+    Args: refresh_interval - seconds between database reads
+          overlap - seconds re-read before the previous read; longer than any
+                    transaction that inserts revocations
+    '''
+
+    def __init__(self, refresh_interval: float = REVOCATION_REFRESH, overlap: float = REVOCATION_OVERLAP) -> None:
+        self.refresh_interval = refresh_interval
+        self.overlap = overlap
+        self.users: Dict[int, float] = {}
+        self.blocked: Set[int] = set()
+        self.tokens: Set[str] = set()
+        self._expiry: Dict[Any, float] = {}
+        self._read_at: Optional[float] = None
+        self.checked_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def refresh(self, dsn: str, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self.checked_at < self.refresh_interval:
+            return
+        with self._lock:
+            if not force and now - self.checked_at < self.refresh_interval:
+                return
+            conn = db.acquire(dsn)
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT extract(epoch FROM now())')
+                    read_at = float(cursor.fetchone()[0])
+                    # after a gap longer than the lifting of a block is kept, read everything again
+                    since = self._read_at
+                    if since is not None and read_at - since >= SESSION_TTL:
+                        since = None
+                    cursor.execute(
+                        """SELECT user_id, token_id, extract(epoch FROM revoked_at), extract(epoch FROM expires_at), blocked
+                           FROM session_revocations
+                           WHERE expires_at > now()
+                             AND (%s::FLOAT IS NULL OR revoked_at > to_timestamp(%s::FLOAT - %s))
+                           -- a block and its lifting apply in the order they were made
+                           ORDER BY revoked_at, id""",
+                        (since, since, self.overlap)
+                    )
+                    rows = cursor.fetchall()
+                conn.rollback()
+            finally:
+                db.release(dsn, conn)
+            wall = time.time()
+            if since is None:
+                self.users, self.blocked, self.tokens, self._expiry = {}, set(), set(), {}
+            self._read_at = read_at
+            for user_id, token_id, revoked_at, expires_at, blocked in rows:
+                if blocked is not None:
+                    if blocked:
+                        self.blocked.add(user_id)
+                    else:
+                        self.blocked.discard(user_id)
+                        # tokens revoked by the block expire before the lifting row does
+                        self._expiry[user_id] = max(self._expiry.get(user_id, 0), float(expires_at))
+                elif token_id:
+                    self.tokens.add(token_id)
+                    self._expiry[token_id] = float(expires_at)
+                else:
+                    self.users[user_id] = max(self.users.get(user_id, 0), float(revoked_at))
+                    self._expiry[user_id] = max(self._expiry.get(user_id, 0), float(expires_at))
+            for entry, expires_at in list(self._expiry.items()):
+                if expires_at <= wall:
+                    del self._expiry[entry]
+                    self.tokens.discard(entry)
+                    self.users.pop(entry, None)
+            self.checked_at = now
+
+    def is_revoked(self, claims: Claims) -> bool:
+        if claims.token_id in self.tokens or claims.user_id in self.blocked:
+            return True
+        revoked_before = self.users.get(claims.user_id)
+        return revoked_before is not None and claims.issued_at <= revoked_before
+
+
+revocations = RevocationList()
+
+
+def _header(headers: Dict[str, Any], name: str) -> Optional[str]:
+    return headers.get(name) or headers.get(name.lower())
+
+
+def token_from_headers(headers: Dict[str, Any]) -> Optional[str]:
+    authorization = _header(headers, 'Authorization') or ''
+    if authorization.startswith('Bearer '):
+        return authorization[7:].strip()
+    return _header(headers, 'X-Auth-Token')
+
+
+def authenticate(headers: Optional[Dict[str, Any]], dsn: str) -> Optional[Claims]:
+    '''
+    Business: Identify the caller of a request
+    Args: headers - event headers
+          dsn - database used to refresh the revocation list when it is stale
+    Returns: Claims of a valid, unrevoked token; legacy header claims when
+             SESSION_HEADER_AUTH=1 and SESSION_KEYS is unset; otherwise None
+    '''
+    headers = headers or {}
+    if not KEYS:
+        if not HEADER_AUTH:
+            return None
+        user_id = str(_header(headers, 'X-User-Id') or '')
+        is_admin = _header(headers, 'X-Is-Admin') == 'true'
+        if not user_id.isdigit() and not is_admin:
+            return None
+        return Claims(int(user_id) if user_id.isdigit() else 0, is_admin, 0, 0, '')
+    token = token_from_headers(headers)
+    if not token:
+        return None
+    try:
+        claims = verify(token)
+    except InvalidToken:
+        return None
+    revocations.refresh(dsn)
+    return None if revocations.is_revoked(claims) else claims
+
+
+def revoke(cursor: Any, user_id: int, token_id: Optional[str] = None, expires_at: Optional[int] = None) -> None:
+    '''
+    Business: Revoke one token (logout) or every token issued so far to a user (block)
+    Args: cursor - open cursor; the caller commits
+          token_id - token to revoke, or None for all of the user's tokens
+          expires_at - when the revocation can be forgotten; defaults to now + SESSION_TTL
+    '''
+    cursor.execute(
+        """INSERT INTO session_revocations (user_id, token_id, expires_at)
+           VALUES (%s, %s, COALESCE(to_timestamp(%s), now() + make_interval(secs => %s)))""",
+        (user_id, token_id, expires_at, SESSION_TTL)
+    )
+
+
+def block(cursor: Any, user_id: int, blocked: bool = True) -> bool:
+    '''
+    Business: Block a user (login refused, every token rejected) or lift the block
+    The block row never expires while it holds; lifting it expires that row
+    and records the lifting for the caches that have already read the block.
+    Args: cursor - open cursor; the caller commits
+    Returns: False when there is no such user
+    '''
+    cursor.execute('UPDATE users SET is_blocked = %s WHERE id = %s', (blocked, user_id))
+    if not cursor.rowcount:
+        return False
+    if blocked:
+        cursor.execute(
+            """INSERT INTO session_revocations (user_id, blocked, expires_at)
+               VALUES (%s, TRUE, 'infinity')""",
+            (user_id,)
+        )
+    else:
+        cursor.execute(
+            """UPDATE session_revocations SET expires_at = now()
+               WHERE user_id = %s AND blocked AND expires_at = 'infinity'""",
+            (user_id,)
+        )
+        cursor.execute(
+            """INSERT INTO session_revocations (user_id, blocked, expires_at)
+               VALUES (%s, FALSE, now() + make_interval(secs => %s))""",
+            (user_id, SESSION_TTL)
+        )
+    return True
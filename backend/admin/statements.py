@@ -0,0 +1,287 @@
+'''
+Business: Monthly statements for every card, written as per-card CSV or JSON files
+The card-id space is cut into ranges of STATEMENTS_RANGE_CARDS ids and a
+process pool of STATEMENTS_WORKERS processes takes them one at a time. A
+range is one query read through a server-side cursor in (card_id,
+created_at) order: an opening row per card (its ledger balance when the
+month starts), then the month's completed transactions and the ledger
+entries that have no transactions row (adjustments from the admin panel,
+opening balances). Every branch is bounded by created_at, so only the
+month's partition of transactions is read (V0012) and each one is an index
+range scan (V0016 for the ledger); the server sorts no more than one range's
+month at a time. The closing balance is summed while the lines are written,
+one card at a time, so a worker holds at most STATEMENTS_FETCH_ROWS rows
+whatever the number of cards or transactions.
+
+Each range is written to OUT_DIR/YYYY-MM/<first>-<last>/ with one file per
+card and a manifest.csv of opening and closing balances, and replaces the
+previous output of that range only once it is complete, so a failed or
+repeated run can simply be started again. Cards with no balance and no
+movements in the month get no statement. Run it for months that have
+ended: a transfer queued in the last moments of a month and applied after
+it is on that month's statement (its transactions row is dated when it was
+queued) but in the next month's opening balance.
+
+Usage: DATABASE_URL=postgresql://... python statements.py 2024-05 /var/statements [csv|json]
+'''
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+import db
+
+WORKERS = int(os.environ.get('STATEMENTS_WORKERS', str(os.cpu_count() or 1)))
+RANGE_CARDS = int(os.environ.get('STATEMENTS_RANGE_CARDS', '5000'))
+FETCH_ROWS = int(os.environ.get('STATEMENTS_FETCH_ROWS', '2000'))
+FORMATS = ('csv', 'json')
+
+STATEMENT_SQL = """
+    SELECT card_id, created_at, kind, amount, transaction_id, details FROM (
+        SELECT c.id AS card_id, '-infinity'::TIMESTAMP AS created_at, 'balance' AS kind,
+               -- card_balance_at() counts entries made at the instant itself
+               card_balance_at(c.id, %(start)s::TIMESTAMP - INTERVAL '1 microsecond') AS amount,
+               NULL::INTEGER AS transaction_id, c.masked_number AS details
+        FROM cards c
+        WHERE c.id BETWEEN %(first)s AND %(last)s
+        UNION ALL
+        SELECT t.card_id, t.created_at, t.transaction_type,
+               CASE WHEN t.transaction_type = 'outgoing' THEN -t.amount ELSE t.amount END,
+               t.id, t.recipient
+        FROM transactions t
+        WHERE t.card_id BETWEEN %(first)s AND %(last)s
+          AND t.created_at >= %(start)s AND t.created_at < %(end)s
+          AND t.status = 'completed'
+        UNION ALL
+        SELECT l.card_id, l.created_at, l.entry_type, l.amount, NULL, NULL
+        FROM ledger_entries l
+        WHERE l.card_id BETWEEN %(first)s AND %(last)s
+          AND l.created_at >= %(start)s AND l.created_at < %(end)s
+          AND l.card_id IS NOT NULL AND l.entry_type <> 'transfer'
+    ) movements
+    ORDER BY card_id, created_at, transaction_id"""
+
+CSV_COLUMNS = ('date', 'type', 'amount', 'balance', 'details', 'transaction_id')
+MANIFEST_COLUMNS = ('card_id', 'masked_number', 'opening_balance', 'closing_balance', 'lines', 'file')
+
+
+def parse_period(value: str) -> Tuple[datetime, datetime]:
+    '''
+    Business: First instant of a 'YYYY-MM' month and of the month after it
+    Raises: ValueError
+    '''
+    start = datetime.strptime(value, '%Y-%m')
+    year, month = divmod(start.month, 12)
+    return start, start.replace(year=start.year + year, month=month + 1)
+
+
+def card_ranges(conn: Any, range_cards: int = RANGE_CARDS) -> List[Tuple[int, int]]:
+    '''
+    Business: Inclusive (first, last) card-id ranges covering every card
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT MIN(id), MAX(id) FROM cards')
+        low, high = cursor.fetchone()
+    conn.rollback()
+    if low is None:
+        return []
+    return [(first, min(first + range_cards - 1, high)) for first in range(low, high + 1, range_cards)]
+
+
+class CsvStatement:
+    extension = 'csv'
+
+    def __init__(self, path: str, card_id: int, masked_number: str, period: str, opening: Decimal) -> None:
+        self.file = open(path, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(CSV_COLUMNS)
+        self.writer.writerow((period, 'opening', '', opening, masked_number, ''))
+
+    def line(self, created_at: datetime, kind: str, amount: Decimal, balance: Decimal,
+             details: Optional[str], transaction_id: Optional[int]) -> None:
+        self.writer.writerow((created_at.isoformat(sep=' '), kind, amount, balance, details or '',
+                              transaction_id or ''))
+
+    def close(self, closing: Decimal, lines: int) -> None:
+        self.writer.writerow(('', 'closing', '', closing, '', ''))
+        self.file.close()
+
+
+class JsonStatement:
+    extension = 'json'
+
+    def __init__(self, path: str, card_id: int, masked_number: str, period: str, opening: Decimal) -> None:
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write(json.dumps({'card_id': card_id, 'masked_number': masked_number, 'period': period,
+                                    'opening_balance': str(opening)}, ensure_ascii=False)[:-1])
+        self.file.write(', "lines": [')
+        self.separator = ''
+
+    def line(self, created_at: datetime, kind: str, amount: Decimal, balance: Decimal,
+             details: Optional[str], transaction_id: Optional[int]) -> None:
+        self.file.write(self.separator + json.dumps({
+            'date': created_at.isoformat(), 'type': kind, 'amount': str(amount), 'balance': str(balance),
+            'details': details, 'transaction_id': transaction_id,
+        }, ensure_ascii=False))
+        self.separator = ', '
+
+    def close(self, closing: Decimal, lines: int) -> None:
+        self.file.write(f'], "closing_balance": "{closing}", "line_count": {lines}}}')
+        self.file.close()
+
+
+WRITERS = {'csv': CsvStatement, 'json': JsonStatement}
+
+
+def write_range(dsn: str, period: str, first: int, last: int, out_dir: str, fmt: str = 'csv') -> Dict[str, Any]:
+    '''
+    Business: Write the statements of cards first..last for one month
+    Runs in a pool process with its own connection.
+    Args: dsn - database to read
+          period - 'YYYY-MM'
+          first, last - inclusive card-id range
+          out_dir - root directory; the range goes to out_dir/period/first-last/
+          fmt - 'csv' or 'json'
+    Returns: dict with 'pid', the range, 'cards' read, 'statements' written,
+             'lines' and 'seconds'
+    '''
+    started = time.perf_counter()
+    start, end = parse_period(period)
+    writer = WRITERS[fmt]
+    target = os.path.join(out_dir, period, f'{first}-{last}')
+    partial = target + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+
+    cards = statements = lines = 0
+    conn = db.acquire(dsn)
+    try:
+        with open(os.path.join(partial, 'manifest.csv'), 'w', encoding='utf-8', newline='') as manifest_file:
+            manifest = csv.writer(manifest_file)
+            manifest.writerow(MANIFEST_COLUMNS)
+            # a named cursor keeps the result on the server and fetches FETCH_ROWS rows at a time
+            with conn.cursor(name=f'statements_{first}') as cursor:
+                cursor.itersize = FETCH_ROWS
+                cursor.execute(STATEMENT_SQL, {'start': start, 'end': end, 'first': first, 'last': last})
+                card: Optional[Dict[str, Any]] = None
+                for card_id, created_at, kind, amount, transaction_id, details in cursor:
+                    # every card's balance row sorts first; ledger entries may be 'opening' too
+                    if card is None or card_id != card['id']:
+                        statements += _finish(card, manifest)
+                        cards += 1
+                        card = {'id': card_id, 'masked_number': details, 'opening': amount, 'balance': amount,
+                                'lines': 0, 'statement': None, 'file': None}
+                        if amount:
+                            _open(card, writer, partial, period)
+                        continue
+                    if card['statement'] is None:
+                        _open(card, writer, partial, period)
+                    card['balance'] += amount
+                    card['lines'] += 1
+                    lines += 1
+                    card['statement'].line(created_at, kind, amount, card['balance'], details, transaction_id)
+                statements += _finish(card, manifest)
+    finally:
+        db.release(dsn, conn)
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(partial, target)
+    return {
+        'pid': os.getpid(),
+        'first': first,
+        'last': last,
+        'cards': cards,
+        'statements': statements,
+        'lines': lines,
+        'seconds': time.perf_counter() - started,
+    }
+
+
+def _open(card: Dict[str, Any], writer: Any, directory: str, period: str) -> None:
+    card['file'] = f"{card['id']}.{writer.extension}"
+    card['statement'] = writer(os.path.join(directory, card['file']), card['id'], card['masked_number'], period,
+                               card['opening'])
+
+
+def _finish(card: Optional[Dict[str, Any]], manifest: Any) -> int:
+    if card is None or card['statement'] is None:
+        return 0
+    card['statement'].close(card['balance'], card['lines'])
+    manifest.writerow((card['id'], card['masked_number'], card['opening'], card['balance'], card['lines'],
+                       card['file']))
+    return 1
+
+
+def generate(dsn: str, period: str, out_dir: str, fmt: str = 'csv', workers: int = WORKERS,
+             range_cards: int = RANGE_CARDS) -> Dict[str, Any]:
+    '''
+    Business: Write the month's statements of all cards with a pool of worker processes
+    Args: dsn - database to read
+          period - 'YYYY-MM'
+          out_dir - root directory for the statements
+          fmt - 'csv' or 'json'
+          workers - pool processes
+          range_cards - card ids per range handed to a worker
+    Returns: dict with totals ('ranges', 'cards', 'statements', 'lines',
+             'seconds') and 'workers': per process ranges, cards, lines, busy
+             seconds and cards/lines per busy second
+    Raises: ValueError on a malformed period or an unknown format
+    '''
+    parse_period(period)
+    if fmt not in WRITERS:
+        raise ValueError(f'Format must be one of {", ".join(FORMATS)}')
+    conn = db.acquire(dsn)
+    try:
+        ranges = card_ranges(conn, range_cards)
+    finally:
+        db.release(dsn, conn)
+
+    started = time.perf_counter()
+    # spawn, so no process inherits this one's pooled connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(write_range, dsn, period, first, last, out_dir, fmt) for first, last in ranges]
+        results = [future.result() for future in futures]
+    seconds = time.perf_counter() - started
+
+    per_worker: Dict[int, Dict[str, Any]] = {}
+    for result in results:
+        worker = per_worker.setdefault(result['pid'], {'pid': result['pid'], 'ranges': 0, 'cards': 0,
+                                                       'lines': 0, 'seconds': 0.0})
+        worker['ranges'] += 1
+        worker['cards'] += result['cards']
+        worker['lines'] += result['lines']
+        worker['seconds'] += result['seconds']
+    for worker in per_worker.values():
+        busy = worker['seconds'] or 1e-9
+        worker['cards_per_s'] = round(worker['cards'] / busy, 1)
+        worker['lines_per_s'] = round(worker['lines'] / busy, 1)
+        worker['seconds'] = round(worker['seconds'], 3)
+
+    return {
+        'period': period,
+        'ranges': len(ranges),
+        'cards': sum(result['cards'] for result in results),
+        'statements': sum(result['statements'] for result in results),
+        'lines': sum(result['lines'] for result in results),
+        'seconds': round(seconds, 3),
+        'workers': sorted(per_worker.values(), key=lambda worker: worker['pid']),
+    }
+
+
+def main() -> None:
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn or len(sys.argv) not in (3, 4):
+        raise SystemExit('Usage: DATABASE_URL=... python statements.py YYYY-MM OUT_DIR [csv|json]')
+    summary = generate(dsn, sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) == 4 else 'csv')
+    print(json.dumps(summary))
+
+
+if __name__ == '__main__':
+    main()
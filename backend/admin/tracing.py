@@ -0,0 +1,328 @@
+'''
+Business: Opt-in per-invocation tracing of database and serialization time
+With TRACE=1 every handler invocation prints one JSON log line
+{"trace": {...}} tagged with context.request_id and the action, holding the
+total time, connection acquisition, every SQL statement (normalized text,
+parameter count, execute and fetch time, row count) and response
+serialization. TRACE_EXPLAIN_MS additionally attaches the plan of SELECT
+statements slower than that many milliseconds, for a TRACE_EXPLAIN_SAMPLE
+fraction of them. Only a read-only SELECT (no locking clause, no call to a
+VOLATILE function such as transfer_funds() or nextval()) is re-run, under
+EXPLAIN ANALYZE in a read-only savepoint; any other one gets the estimated
+plan of a plain EXPLAIN, which does not execute it.
+When TRACE is unset handlers are not wrapped, connections are plain psycopg2
+ones and span() costs a thread-local lookup; psycopg2 itself is only imported
+by connection_class().
+Every cloud function directory ships an identical copy of this module.
+'''
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+ENABLED = os.environ.get('TRACE') == '1'
+EXPLAIN_MS = float(os.environ.get('TRACE_EXPLAIN_MS', '0'))
+EXPLAIN_SAMPLE = float(os.environ.get('TRACE_EXPLAIN_SAMPLE', '1'))
+MAX_STATEMENTS = int(os.environ.get('TRACE_MAX_STATEMENTS', '50'))
+MAX_SQL_LENGTH = 300
+
+# names of VOLATILE functions, read from pg_proc on the first EXPLAIN
+_volatile_functions: Optional[frozenset] = None
+
+
+class _Local(threading.local):
+    # class default, so threads that never traced read None without an AttributeError
+    trace: Optional['Trace'] = None
+
+
+_local = _Local()
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql: Any) -> str:
+    '''
+    Business: Statement text with literals replaced by '?' and whitespace collapsed
+    '''
+    import re
+    if isinstance(sql, bytes):
+        sql = sql.decode(errors='replace')
+    text = re.sub(r'\s+', ' ', re.sub(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", '?', str(sql))).strip()
+    return text if len(text) <= MAX_SQL_LENGTH else text[:MAX_SQL_LENGTH] + '...'
+
+
+def _param_count(params: Any) -> int:
+    if params is None:
+        return 0
+    try:
+        return len(params)
+    except TypeError:
+        return 1
+
+
+class Trace:
+    '''
+    Business: Measurements of one handler invocation
+    Args: context - cloud function context (request_id, function_name)
+          event - incoming event, used for the method and action tags
+    '''
+
+    def __init__(self, context: Any, event: Dict[str, Any]) -> None:
+        self.request_id = getattr(context, 'request_id', None)
+        self.function = getattr(context, 'function_name', None)
+        self.method = event.get('httpMethod', 'GET')
+        self.action = _action(event)
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.statements: List[Dict[str, Any]] = []
+        self.statement_count = 0
+        self.db_ms = 0.0
+
+    def add_span(self, name: str, ms: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + ms
+
+    def add_statement(self, sql: Any, params: Any, ms: float, rows: int,
+                      failed: bool = False) -> Optional[Dict[str, Any]]:
+        self.statement_count += 1
+        self.db_ms += ms
+        if len(self.statements) >= MAX_STATEMENTS:
+            return None
+        record: Dict[str, Any] = {'sql': normalize(sql), 'params': _param_count(params), 'ms': round(ms, 3)}
+        if failed:
+            record['failed'] = True
+        elif rows < 0:
+            # server-side cursor: rows are only known as they are fetched
+            record['rows'] = 0
+            record['streamed'] = True
+        else:
+            record['rows'] = rows
+        self.statements.append(record)
+        return record
+
+    def add_fetch(self, record: Optional[Dict[str, Any]], ms: float, rows: int) -> None:
+        self.db_ms += ms
+        if record is not None:
+            record['fetch_ms'] = round(record.get('fetch_ms', 0.0) + ms, 3)
+            if record.get('streamed'):
+                record['rows'] += rows
+
+    def as_dict(self, response: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        total_ms = (time.perf_counter() - self.started) * 1000
+        return {
+            'request_id': self.request_id,
+            'function': self.function,
+            'method': self.method,
+            'action': self.action,
+            'status': response.get('statusCode') if isinstance(response, dict) else 'error',
+            'total_ms': round(total_ms, 3),
+            'db_ms': round(self.db_ms, 3),
+            **{f'{name}_ms': round(ms, 3) for name, ms in self.spans.items()},
+            'statement_count': self.statement_count,
+            'statements': self.statements,
+        }
+
+
+def _action(event: Dict[str, Any]) -> Optional[str]:
+    action = (event.get('queryStringParameters') or {}).get('action')
+    if action or not event.get('body'):
+        return action
+    try:
+        body = json.loads(event['body'])
+    except (TypeError, ValueError):
+        return None
+    return body.get('action') if isinstance(body, dict) else None
+
+
+def current() -> Optional[Trace]:
+    return _local.trace
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'started')
+
+    def __init__(self, trace: Trace, name: str) -> None:
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.trace.add_span(self.name, (time.perf_counter() - self.started) * 1000)
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc: Any) -> None:
+        return None
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str) -> Any:
+    '''
+    Business: Context manager adding its elapsed time to the current trace under name
+    '''
+    trace = _local.trace
+    return _NO_SPAN if trace is None else _Span(trace, name)
+
+
+def traced(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    '''
+    Business: Wrap a cloud function handler so each invocation logs its trace
+    Returns: the handler itself when TRACE is off
+    '''
+    if not ENABLED:
+        return handler
+
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        trace = Trace(context, event)
+        _local.trace = trace
+        response = None
+        try:
+            response = handler(event, context)
+            return response
+        finally:
+            _local.trace = None
+            print(json.dumps({'trace': trace.as_dict(response)}, default=str))
+
+    return wrapper
+
+
+def _sampled() -> bool:
+    import random
+    return random.random() < EXPLAIN_SAMPLE
+
+
+def _read_only(explain: Any, sql: str) -> bool:
+    global _volatile_functions
+    import re
+    text = sql.lower()
+    if re.search(r'\bfor\s+(update|no\s+key\s+update|share|key\s+share)\b', text):
+        return False
+    if _volatile_functions is None:
+        explain.execute("SELECT DISTINCT proname FROM pg_proc WHERE provolatile = 'v'")
+        _volatile_functions = frozenset(row[0] for row in explain.fetchall())
+    return _volatile_functions.isdisjoint(re.findall(r'\b([a-z_][a-z0-9_$]*)\s*\(', text))
+
+
+def _explain(cursor: Any, query: Any, params: Any) -> Optional[List[str]]:
+    import psycopg2
+    import psycopg2.extensions
+    conn = cursor.connection
+    if (cursor.name or conn.autocommit
+            or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+            or not normalize(query).lower().startswith('select')):
+        return None
+    sql = query.decode() if isinstance(query, bytes) else query
+    explain = psycopg2.extensions.cursor(conn)
+    try:
+        explain.execute('SAVEPOINT trace_explain')
+        try:
+            if _read_only(explain, sql):
+                # undone with the savepoint; a write the check missed fails instead of running twice
+                explain.execute('SET LOCAL transaction_read_only = on')
+                explain.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+            else:
+                explain.execute('EXPLAIN ' + sql, params)
+            plan = [row[0] for row in explain.fetchall()]
+        except psycopg2.Error as e:
+            plan = [f'EXPLAIN failed: {e}'.strip()]
+        explain.execute('ROLLBACK TO SAVEPOINT trace_explain')
+        explain.execute('RELEASE SAVEPOINT trace_explain')
+        return plan
+    except psycopg2.Error:
+        return None
+    finally:
+        explain.close()
+
+
+_cursor_classes: Dict[type, type] = {}
+
+
+def _traced_cursor(base: type) -> type:
+    traced_class = _cursor_classes.get(base)
+    if traced_class is not None:
+        return traced_class
+
+    def execute(self, query, vars=None):
+        trace = _local.trace
+        if trace is None:
+            return base.execute(self, query, vars)
+        started = time.perf_counter()
+        try:
+            base.execute(self, query, vars)
+        except Exception:
+            self._trace_record = trace.add_statement(query, vars, (time.perf_counter() - started) * 1000, -1, True)
+            raise
+        ms = (time.perf_counter() - started) * 1000
+        self._trace_record = trace.add_statement(query, vars, ms, self.rowcount)
+        if EXPLAIN_MS and ms >= EXPLAIN_MS and self._trace_record is not None and _sampled():
+            plan = _explain(self, query, vars)
+            if plan:
+                self._trace_record['plan'] = plan
+
+    def executemany(self, query, vars_list):
+        trace = _local.trace
+        if trace is None:
+            return base.executemany(self, query, vars_list)
+        vars_list = list(vars_list)
+        started = time.perf_counter()
+        try:
+            base.executemany(self, query, vars_list)
+        except Exception:
+            self._trace_record = trace.add_statement(query, vars_list, (time.perf_counter() - started) * 1000, -1,
+                                                     True)
+            raise
+        self._trace_record = trace.add_statement(query, vars_list, (time.perf_counter() - started) * 1000,
+                                                 self.rowcount)
+
+    def timed_fetch(method: Callable[..., Any]) -> Callable[..., Any]:
+        def fetch(self, *args):
+            trace = _local.trace
+            if trace is None:
+                return method(self, *args)
+            started = time.perf_counter()
+            result = method(self, *args)
+            rows = len(result) if isinstance(result, list) else int(result is not None)
+            trace.add_fetch(getattr(self, '_trace_record', None), (time.perf_counter() - started) * 1000, rows)
+            return result
+        return fetch
+
+    traced_class = type('Traced' + base.__name__, (base,), {
+        'execute': execute,
+        'executemany': executemany,
+        'fetchone': timed_fetch(base.fetchone),
+        'fetchmany': timed_fetch(base.fetchmany),
+        'fetchall': timed_fetch(base.fetchall),
+    })
+    _cursor_classes[base] = traced_class
+    return traced_class
+
+
+_connection_class: Optional[type] = None
+
+
+def connection_class() -> type:
+    '''
+    Business: psycopg2 connection class whose cursors report to the current trace
+    '''
+    global _connection_class
+    if _connection_class is None:
+        import psycopg2.extensions
+
+        class TracingConnection(psycopg2.extensions.connection):
+            def cursor(self, *args, **kwargs):
+                base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+                kwargs['cursor_factory'] = _traced_cursor(base)
+                return super().cursor(*args, **kwargs)
+
+        _connection_class = TracingConnection
+    return _connection_class
@@ -0,0 +1,386 @@
+'''
+Business: Admission control in front of database-bound actions
+guard() wraps every action of a routing table. Before the action runs, and so
+before it borrows a database connection, the wrapper
+- takes a token from each of the action's Rule buckets, one bucket per
+  identity (client IP, account name, signed-in user). The in-process tier
+  sheds a flood hitting one warm container without a network call; the shared
+  tier (REDIS_URL, or ADMISSION_BACKEND=memory for the local stand-in)
+  enforces the limit across containers;
+- takes an in-flight slot: at most ADMISSION_MAX_INFLIGHT actions per
+  container and, with a shared tier, ADMISSION_GLOBAL_INFLIGHT across all of
+  them, so a burst cannot open more connections than Postgres accepts.
+A refused request gets 429 with Retry-After. If the shared tier is down the
+in-process tier still applies.
+ADMISSION_LIMITS overrides rule rates as 'name=rate/burst,...' (tokens per
+second / bucket size), or turns the rules off with 'off'.
+Every cloud function directory ships an identical copy.
+'''
+import functools
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+import db
+import runtime
+
+MAX_INFLIGHT = int(os.environ.get('ADMISSION_MAX_INFLIGHT', str(db.POOL_MAX_SIZE)))
+GLOBAL_INFLIGHT = int(os.environ.get('ADMISSION_GLOBAL_INFLIGHT', '64'))
+QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '0.1'))
+LEASE_TTL = float(os.environ.get('ADMISSION_LEASE_TTL', '30'))
+SHARED_POLL_INTERVAL = 0.01
+MAX_LOCAL_KEYS = 10000
+LOG_STATS = os.environ.get('ADMISSION_STATS') == '1'
+
+REJECT_HEADERS = {**runtime.JSON_HEADERS, 'Access-Control-Expose-Headers': 'Retry-After'}
+
+
+def _overrides(raw: Optional[str]) -> Optional[Dict[str, Tuple[float, float]]]:
+    '''
+    Business: Parse ADMISSION_LIMITS; None when the rules are off
+    '''
+    if raw is not None and raw.strip().lower() == 'off':
+        return None
+    limits: Dict[str, Tuple[float, float]] = {}
+    for item in (raw or '').split(','):
+        if '=' not in item:
+            continue
+        name, _, value = item.partition('=')
+        rate, _, burst = value.partition('/')
+        limits[name.strip()] = (float(rate), float(burst or rate))
+    return limits
+
+
+OVERRIDES = _overrides(os.environ.get('ADMISSION_LIMITS'))
+
+
+def client_ip(request: runtime.Request) -> Optional[str]:
+    '''
+    Business: Caller's address as seen by the API gateway
+    The rightmost X-Forwarded-For entry is the one the gateway appended;
+    earlier ones are whatever the client sent.
+    '''
+    identity = (request.event.get('requestContext') or {}).get('identity') or {}
+    if identity.get('sourceIp'):
+        return identity['sourceIp']
+    forwarded = request.header('X-Forwarded-For')
+    if not forwarded:
+        return None
+    return forwarded.rsplit(',', 1)[-1].strip() or None
+
+
+def session_user(request: runtime.Request) -> Optional[str]:
+    return str(request.session.user_id) if request.session and request.session.user_id else None
+
+
+def param(name: str) -> Callable[[runtime.Request], Optional[str]]:
+    '''
+    Business: Identity taken from an action parameter, e.g. the account a login targets
+    '''
+
+    def identity(request: runtime.Request) -> Optional[str]:
+        value = request.params.get(name)
+        if value is None:
+            return None
+        return str(value).strip().lower() or None
+
+    return identity
+
+
+class Rule:
+    '''
+    Business: Token bucket limit on one identity of a request
+    Args: name - bucket family, also the ADMISSION_LIMITS key
+          identity - request -> identity string, or None to skip the rule
+          rate - tokens added per second
+          burst - bucket size: requests allowed at once after a quiet period
+    '''
+
+    def __init__(self, name: str, identity: Callable[[runtime.Request], Optional[str]],
+                 rate: float, burst: float) -> None:
+        self.name = name
+        self.identity = identity
+        self.rate, self.burst = (OVERRIDES or {}).get(name, (rate, burst))
+
+    def key(self, request: runtime.Request) -> Optional[str]:
+        identity = self.identity(request)
+        if identity is None:
+            return None
+        if len(identity) > 64:
+            identity = hashlib.blake2b(identity.encode(), digest_size=16).hexdigest()
+        return f'adm:{self.name}:{identity}'
+
+
+def _refill(state: Optional[Tuple[float, float]], rate: float, burst: float,
+            cost: float, now: float) -> Tuple[Tuple[float, float], float]:
+    '''
+    Business: Take cost tokens from a bucket
+    Args: state - (tokens, updated at) or None for a full bucket
+    Returns: (new state, seconds until the tokens are available; 0 when taken)
+    '''
+    tokens, updated = state if state is not None else (burst, now)
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return (tokens - cost, now), 0.0
+    return (tokens, now), (cost - tokens) / rate
+
+
+class LocalBuckets:
+    '''
+    Business: In-process token buckets
+    Args: max_keys - buckets kept; past it, buckets that have refilled are dropped
+    '''
+
+    def __init__(self, max_keys: int = MAX_LOCAL_KEYS) -> None:
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[Tuple[float, float], float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._buckets.get(key)
+            state, wait = _refill(entry[0] if entry else None, rate, burst, cost, now)
+            if len(self._buckets) >= self.max_keys and key not in self._buckets:
+                # forget buckets that have refilled by now
+                self._buckets = {
+                    k: e for k, e in self._buckets.items() if e[0][0] + (now - e[0][1]) * e[1] < e[2]
+                }
+            self._buckets[key] = (state, rate, burst)
+        return wait
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+class MemoryStore:
+    '''
+    Business: In-process stand-in for the shared tier (buckets and in-flight leases)
+    '''
+
+    def __init__(self) -> None:
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._leases: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        with self._lock:
+            self._buckets[key], wait = _refill(self._buckets.get(key), rate, burst, cost, time.time())
+        return wait
+
+    def enter(self, key: str, lease: str, limit: int, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            leases = {k: expires for k, expires in self._leases.get(key, {}).items() if expires > now}
+            self._leases[key] = leases
+            if len(leases) >= limit:
+                return False
+            leases[lease] = now + ttl
+        return True
+
+    def leave(self, key: str, lease: str) -> None:
+        with self._lock:
+            self._leases.get(key, {}).pop(lease, None)
+
+
+# Redis scripts run atomically and read the server clock, so containers with
+# skewed clocks share one timeline (TIME in scripts needs Redis 5+)
+TAKE_SCRIPT = '''
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = math.min(burst, (tonumber(state[1]) or burst) + math.max(0, now - (tonumber(state[2]) or now)) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'at', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+'''
+ENTER_SCRIPT = '''
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then return 0 end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+redis.call('PEXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2]) * 1000))
+return 1
+'''
+
+
+class RedisStore:
+    '''
+    Business: Shared tier on Redis: buckets in hashes, in-flight leases in a sorted set
+    Leases expire after their ttl, so a container that dies mid-action frees its slot.
+    '''
+
+    def __init__(self, client: Any) -> None:
+        self.client = client
+        self._take = client.register_script(TAKE_SCRIPT)
+        self._enter = client.register_script(ENTER_SCRIPT)
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1) -> float:
+        return float(self._take(keys=[key], args=[rate, burst, cost]))
+
+    def enter(self, key: str, lease: str, limit: int, ttl: float) -> bool:
+        return bool(self._enter(keys=[key], args=[limit, ttl, lease]))
+
+    def leave(self, key: str, lease: str) -> None:
+        self.client.zrem(key, lease)
+
+
+def _shared_store() -> Any:
+    if os.environ.get('ADMISSION_BACKEND') == 'memory':
+        return MemoryStore()
+    url = os.environ.get('REDIS_URL')
+    if not url:
+        return None
+    try:
+        import redis
+    except ImportError:
+        return None
+    return RedisStore(redis.Redis.from_url(url, socket_timeout=0.05, socket_connect_timeout=0.05))
+
+
+class Admission:
+    '''
+    Business: Rate and concurrency gate shared by the actions of a function
+    Args: local - in-process bucket tier
+          shared - shared tier (MemoryStore / RedisStore) or None
+          max_inflight - concurrent actions in this container
+          global_inflight - concurrent actions across containers, with a shared tier
+    '''
+
+    def __init__(self, local: Optional[LocalBuckets] = None, shared: Any = None,
+                 max_inflight: int = MAX_INFLIGHT, global_inflight: int = GLOBAL_INFLIGHT) -> None:
+        self.local = local or LocalBuckets()
+        self.shared = shared
+        self.global_inflight = global_inflight
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._lock = threading.Lock()
+        self.stats: Dict[str, int] = {
+            'admitted': 0,
+            'rejected_rate': 0,
+            'rejected_concurrency': 0,
+            'shared_errors': 0,
+        }
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def wait(self, rule: Rule, key: str) -> float:
+        '''
+        Business: Seconds until the rule admits the request; 0 admits it now
+        '''
+        wait = self.local.take(key, rule.rate, rule.burst)
+        if wait or self.shared is None:
+            return wait
+        try:
+            return self.shared.take(key, rule.rate, rule.burst)
+        except Exception:
+            self.count('shared_errors')
+            return 0.0
+
+    def enter(self) -> Optional[str]:
+        '''
+        Business: Take an in-flight slot
+        Returns: lease id to pass to leave(), or None when every slot is busy
+        '''
+        deadline = time.monotonic() + QUEUE_TIMEOUT
+        if not self._slots.acquire(timeout=QUEUE_TIMEOUT):
+            return None
+        lease = uuid.uuid4().hex
+        if self.shared is None or self.global_inflight <= 0:
+            return lease
+        while True:
+            try:
+                if self.shared.enter('adm:inflight', lease, self.global_inflight, LEASE_TTL):
+                    return lease
+            except Exception:
+                self.count('shared_errors')
+                return lease
+            # the shared tier cannot wake waiters: poll until the queue timeout
+            if time.monotonic() + SHARED_POLL_INTERVAL > deadline:
+                self._slots.release()
+                return None
+            time.sleep(SHARED_POLL_INTERVAL)
+
+    def leave(self, lease: str) -> None:
+        self._slots.release()
+        if self.shared is not None and self.global_inflight > 0:
+            try:
+                self.shared.leave('adm:inflight', lease)
+            except Exception:
+                self.count('shared_errors')
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        total = stats['admitted'] + stats['rejected_rate'] + stats['rejected_concurrency']
+        stats['rejected_ratio'] = round(1 - stats['admitted'] / total, 4) if total else 0.0
+        return stats
+
+    def log_stats(self) -> None:
+        if LOG_STATS:
+            print(json.dumps({'admission': self.snapshot()}))
+
+
+gate = Admission(shared=_shared_store())
+
+
+def too_many(retry_after: float, message: str = 'Too many requests') -> Dict[str, Any]:
+    seconds = max(1, math.ceil(retry_after))
+    return runtime.respond(429, json.dumps({'error': message, 'retry_after': seconds}),
+                           {**REJECT_HEADERS, 'Retry-After': str(seconds)})
+
+
+def limited(action: runtime.Action, rules: Sequence[Rule] = ()) -> runtime.Action:
+    '''
+    Business: Run the action only when its rules and an in-flight slot admit it
+    '''
+
+    @functools.wraps(action)
+    def wrapper(request: runtime.Request) -> Dict[str, Any]:
+        try:
+            if OVERRIDES is not None:
+                for rule in rules:
+                    key = rule.key(request)
+                    wait = gate.wait(rule, key) if key else 0.0
+                    if wait:
+                        gate.count('rejected_rate')
+                        gate.count(f'rejected:{rule.name}')
+                        return too_many(wait)
+            lease = gate.enter()
+            if lease is None:
+                gate.count('rejected_concurrency')
+                return too_many(1, 'Server is busy')
+            gate.count('admitted')
+            try:
+                return action(request)
+            finally:
+                gate.leave(lease)
+        finally:
+            gate.log_stats()
+
+    return wrapper
+
+
+def guard(routes: Dict[str, Dict[str, runtime.Action]],
+          rules: Optional[Dict[str, Sequence[Rule]]] = None) -> Dict[str, Dict[str, runtime.Action]]:
+    '''
+    Business: Routing table with every action behind the gate
+    Args: routes - {method: {action: function}}
+          rules - {action: rules} for actions with rate limits
+    '''
+    rules = rules or {}
+    return {
+        method: {name: limited(action, rules.get(name, ())) for name, action in actions.items()}
+        for method, actions in routes.items()
+    }
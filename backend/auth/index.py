@@ -1,9 +1,133 @@
-import json
-import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
 from typing import Dict, Any
 
+import admission
+import encoder
+import passwords
+import runtime
+import sessions
+import tracing
+
+PREFLIGHT = runtime.preflight('GET, POST, OPTIONS', 'Content-Type, Authorization, X-User-Id, X-Auth-Token')
+
+
+def register(request: runtime.Request) -> Dict[str, Any]:
+    body_data = request.params
+    username = body_data.get('username')
+    email = body_data.get('email')
+    password = body_data.get('password')
+    first_name = body_data.get('first_name', '')
+    last_name = body_data.get('last_name', '')
+    phone = body_data.get('phone', '')
+    birth_year = body_data.get('birth_year')
+    
+    if not username or not email or not password or not first_name or not last_name or not phone or not birth_year:
+        return runtime.error(400, 'Missing required fields')
+    
+    if not isinstance(password, str):
+        return runtime.error(400, 'Invalid password')
+    
+    cursor = request.cursor
+    cursor.execute(
+        "SELECT id FROM users WHERE username = %s OR email = %s OR phone = %s",
+        (username, email, phone)
+    )
+    existing_user = cursor.fetchone()
+    
+    if existing_user:
+        return runtime.error(400, 'User already exists')
+    
+    cursor.execute(
+        """INSERT INTO users (username, email, password_hash, first_name, last_name, phone, birth_year, is_admin)
+           VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+           RETURNING id, username, email, first_name, last_name, phone, birth_year, is_admin""",
+        (username, email, passwords.hash_password(password), first_name, last_name, phone, birth_year, False)
+    )
+    new_user = cursor.fetchone()
+    request.commit()
+    
+    return runtime.respond(200, encoder.dumps({
+        'success': True,
+        'user': encoder.row(cursor.description, new_user),
+        **session_fields(new_user)
+    }))
+
+
+def login(request: runtime.Request) -> Dict[str, Any]:
+    username = request.params.get('username')
+    password = request.params.get('password')
+    
+    if not username or not password:
+        return runtime.error(400, 'Missing credentials')
+    
+    if not isinstance(password, str):
+        return runtime.error(400, 'Invalid credentials')
+    
+    cursor = request.cursor
+    cursor.execute(
+        """SELECT id, username, email, full_name, is_admin, is_blocked, password_hash
+           FROM users
+           WHERE username = %s OR email = %s
+           ORDER BY username = %s DESC
+           LIMIT 1""",
+        (username, username, username)
+    )
+    user = cursor.fetchone()
+    description = [column for column in cursor.description if column[0] not in ('is_blocked', 'password_hash')]
+    matches, needs_rehash = passwords.verify_password(password, user['password_hash'] if user else None)
+    
+    if not matches:
+        return runtime.error(401, 'Invalid credentials')
+    
+    if user['is_blocked']:
+        return runtime.error(403, 'Account is blocked')
+    
+    if needs_rehash:
+        cursor.execute(
+            "UPDATE users SET password_hash = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+            (passwords.hash_password(password), user['id'])
+        )
+        request.commit()
+    
+    user = {key: value for key, value in user.items() if key not in ('is_blocked', 'password_hash')}
+    
+    return runtime.respond(200, encoder.dumps({
+        'success': True,
+        'user': encoder.row(description, user),
+        **session_fields(user)
+    }))
+
+
+def logout(request: runtime.Request) -> Dict[str, Any]:
+    token = sessions.token_from_headers(request.event.get('headers') or {})
+    try:
+        claims = sessions.verify(token or '')
+    except sessions.InvalidToken:
+        return runtime.error(401, 'Unauthorized')
+    
+    sessions.revoke(request.cursor, claims.user_id, claims.token_id, claims.expires_at)
+    request.commit()
+    
+    return runtime.ok({'success': True})
+
+
+LIMITS = {
+    'register': [admission.Rule('register:ip', admission.client_ip, rate=0.05, burst=5)],
+    'login': [
+        admission.Rule('login:ip', admission.client_ip, rate=1, burst=20),
+        admission.Rule('login:account', admission.param('username'), rate=0.1, burst=10),
+    ],
+}
+
+ROUTES = admission.guard({
+    'POST': {
+        'register': register,
+        'login': login,
+        'logout': logout,
+    },
+}, LIMITS)
+
+
+@tracing.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: User authentication and registration API
@@ -11,126 +135,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
           context - object with attributes: request_id, function_name
     Returns: HTTP response dict with user data or error
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    database_url = os.environ.get('DATABASE_URL')
-    if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'})
-        }
-    
-    conn = psycopg2.connect(database_url)
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    try:
-        if method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            action = body_data.get('action')
-            
-            if action == 'register':
-                username = body_data.get('username')
-                email = body_data.get('email')
-                password = body_data.get('password')
-                first_name = body_data.get('first_name', '')
-                last_name = body_data.get('last_name', '')
-                phone = body_data.get('phone', '')
-                birth_year = body_data.get('birth_year')
-                
-                if not username or not email or not password or not first_name or not last_name or not phone or not birth_year:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Missing required fields'})
-                    }
-                
-                cursor.execute(
-                    "SELECT id FROM users WHERE username = %s OR email = %s OR phone = %s",
-                    (username, email, phone)
-                )
-                existing_user = cursor.fetchone()
-                
-                if existing_user:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'User already exists'})
-                    }
-                
-                cursor.execute(
-                    """INSERT INTO users (username, email, password_hash, first_name, last_name, phone, birth_year, is_admin) 
-                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s) 
-                       RETURNING id, username, email, first_name, last_name, phone, birth_year, is_admin""",
-                    (username, email, password, first_name, last_name, phone, birth_year, False)
-                )
-                new_user = cursor.fetchone()
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({
-                        'success': True,
-                        'user': dict(new_user)
-                    })
-                }
-            
-            elif action == 'login':
-                username = body_data.get('username')
-                password = body_data.get('password')
-                
-                if not username or not password:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Missing credentials'})
-                    }
-                
-                cursor.execute(
-                    """SELECT id, username, email, full_name, is_admin 
-                       FROM users 
-                       WHERE (username = %s OR email = %s) AND password_hash = %s""",
-                    (username, username, password)
-                )
-                user = cursor.fetchone()
-                
-                if not user:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid credentials'})
-                    }
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({
-                        'success': True,
-                        'user': dict(user)
-                    })
-                }
-        
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
-    
-    finally:
-        cursor.close()
-        conn.close()
\ No newline at end of file
+    return runtime.dispatch(event, context, ROUTES, PREFLIGHT)
+
+
+def session_fields(user: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Business: Session token fields added to login/register responses once SESSION_KEYS is set
+    '''
+    if not sessions.KEYS:
+        return {}
+    token, claims = sessions.issue(user['id'], user['is_admin'])
+    return {'token': token, 'expires_at': claims.expires_at}
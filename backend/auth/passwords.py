@@ -0,0 +1,143 @@
+'''
+Business: Password hashing with scrypt within a fixed memory budget
+Stored format: 'scrypt$<n>$<r>$<p>$<salt>$<hash>' (base64url salt and hash).
+The work factor n is PASSWORD_SCRYPT_N (2**15 by default). When
+PASSWORD_HASH_TARGET_MS is set it is instead calibrated to the largest power of
+two whose hash fits in that many ms here (measured once, lazily, bounded by
+PASSWORD_MIN_N / PASSWORD_MAX_N). Hashing runs in a pool of PASSWORD_WORKERS
+threads (scrypt releases the GIL); a hash takes 128 * n * r bytes, so n is
+always capped to keep every worker's hash together within
+PASSWORD_MEMORY_BUDGET_MB. Values without the prefix are legacy plaintext.
+'''
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from typing import Any, Optional, Tuple
+
+PREFIX = 'scrypt'
+DEFAULT_N = int(os.environ.get('PASSWORD_SCRYPT_N', str(2 ** 15)))
+TARGET_MS = float(os.environ.get('PASSWORD_HASH_TARGET_MS', '0'))
+MIN_N = int(os.environ.get('PASSWORD_MIN_N', str(2 ** 14)))
+MAX_N = int(os.environ.get('PASSWORD_MAX_N', str(2 ** 16)))
+BLOCK_SIZE = 8
+PARALLELISM = 1
+SALT_BYTES = 16
+HASH_BYTES = 32
+WORKERS = int(os.environ.get('PASSWORD_WORKERS', '1'))
+MEMORY_BUDGET_MB = int(os.environ.get('PASSWORD_MEMORY_BUDGET_MB', '64'))
+
+
+def memory_cap(workers: int = WORKERS, budget_mb: int = MEMORY_BUDGET_MB) -> int:
+    '''
+    Business: Largest power-of-two n whose hashes on all workers fit in the memory budget
+    '''
+    n = 2
+    while 128 * (n * 2) * BLOCK_SIZE * PARALLELISM * workers <= budget_mb * 1024 * 1024:
+        n *= 2
+    return n
+
+
+MEMORY_N = memory_cap()
+
+# None until work_factor() calibrates it on first use
+WORK_FACTOR: Optional[int] = None if TARGET_MS > 0 else min(DEFAULT_N, MEMORY_N)
+
+# created on first use: concurrent.futures alone adds ~10ms to a cold start
+_executor: Any = None
+_executor_lock = threading.Lock()
+_calibration_lock = threading.Lock()
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r * p, dklen=HASH_BYTES)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _pool() -> Any:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='password')
+    return _executor
+
+
+def calibrate(target_ms: float = TARGET_MS, min_n: int = MIN_N, max_n: int = MAX_N) -> int:
+    '''
+    Business: Find the largest scrypt n (power of two) that hashes within target_ms here
+    Returns: work factor n, at least min_n and at most max_n, never above MEMORY_N
+    '''
+    max_n = min(max_n, MEMORY_N)
+    n = min(min_n, max_n)
+    salt = secrets.token_bytes(SALT_BYTES)
+    while n < max_n:
+        started = time.perf_counter()
+        _scrypt('calibration', salt, n * 2, BLOCK_SIZE, PARALLELISM)
+        if (time.perf_counter() - started) * 1000 > target_ms:
+            break
+        n *= 2
+    return n
+
+
+def work_factor() -> int:
+    global WORK_FACTOR
+    if WORK_FACTOR is None:
+        with _calibration_lock:
+            if WORK_FACTOR is None:
+                WORK_FACTOR = calibrate()
+    return WORK_FACTOR
+
+
+def hash_password(password: str, n: Optional[int] = None) -> str:
+    '''
+    Business: Hash a password in the worker pool with the calibrated (or given) work factor
+    Returns: encoded hash for users.password_hash
+    '''
+    n = n or work_factor()
+    salt = secrets.token_bytes(SALT_BYTES)
+    digest = _pool().submit(_scrypt, password, salt, n, BLOCK_SIZE, PARALLELISM).result()
+    return f'{PREFIX}${n}${BLOCK_SIZE}${PARALLELISM}${_b64encode(salt)}${_b64encode(digest)}'
+
+
+def _parse(stored: str) -> Optional[Tuple[int, int, int, bytes, bytes]]:
+    parts = stored.split('$')
+    if len(parts) != 6 or parts[0] != PREFIX:
+        return None
+    try:
+        return int(parts[1]), int(parts[2]), int(parts[3]), _b64decode(parts[4]), _b64decode(parts[5])
+    except ValueError:
+        return None
+
+
+def verify_password(password: str, stored: Optional[str]) -> Tuple[bool, bool]:
+    '''
+    Business: Check a password against users.password_hash
+    Args: password - password from the login form
+          stored - users.password_hash, a scrypt hash or legacy plaintext; None
+                   for an unknown user, which still costs one hash to keep timing flat
+    Returns: (matches, needs_rehash) - needs_rehash is True for legacy plaintext
+             and for hashes made with another work factor (weaker, or above
+             the memory budget)
+    '''
+    if stored is None:
+        hash_password(password)
+        return False, False
+    parsed = _parse(stored)
+    if parsed is None:
+        return hmac.compare_digest(password.encode(), stored.encode()), True
+    n, r, p, salt, expected = parsed
+    digest = _pool().submit(_scrypt, password, salt, n, r, p).result()
+    return hmac.compare_digest(digest, expected), n != work_factor() or r != BLOCK_SIZE or p != PARALLELISM
@@ -0,0 +1,232 @@
+'''
+Business: Shared request plumbing for the cloud function handlers
+A handler declares its actions in a routing table {method: {action: function}}
+and hands the event to dispatch(), which answers preflight, unknown actions
+and failed authentication from precomputed responses. Each action receives a
+Request whose database connection is acquired on first use of request.conn or
+request.cursor, so requests rejected by validation never touch the pool or
+load the psycopg2 driver.
+Actions commit through request.commit() so a wrapper (idempotency keys) can
+hold the commit until it has written its own rows in the same transaction.
+GET actions read from the replica in DATABASE_REPLICA_URL when one is set
+(see db.acquire_for_read); if it drops the connection mid-read the action
+runs again on the primary. A committed write records the primary's WAL
+position for the session that made it and the users it changed, so those
+keep reading from the primary until the replica has caught up.
+Every cloud function directory ships an identical copy of this module.
+'''
+import functools
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import db
+import sessions
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+
+def preflight(methods: str, allow_headers: str) -> Dict[str, Any]:
+    '''
+    Business: CORS preflight response of a function, built once at import
+    '''
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': allow_headers,
+            'Access-Control-Max-Age': '86400'
+        },
+        'body': ''
+    }
+
+
+def respond(status: int, body: str, headers: Dict[str, str] = JSON_HEADERS) -> Dict[str, Any]:
+    return {'statusCode': status, 'headers': headers, 'isBase64Encoded': False, 'body': body}
+
+
+def ok(payload: Dict[str, Any]) -> Dict[str, Any]:
+    return respond(200, json.dumps(payload, default=str))
+
+
+@functools.lru_cache(maxsize=256)
+def _error_body(message: str) -> str:
+    return json.dumps({'error': message})
+
+
+def error(status: int, message: str, **extra: Any) -> Dict[str, Any]:
+    body = json.dumps({'error': message, **extra}, default=str) if extra else _error_body(message)
+    return respond(status, body)
+
+
+class Request:
+    '''
+    Business: One invocation's input and its lazily acquired database connection
+    Args: event, context - as passed to the handler
+          action - resolved action name
+          params - action input: the query string for GET, the JSON body otherwise
+          session - caller's Claims, or None for functions without authentication
+          database_url - DSN of the pool to borrow from
+          replica_url - DSN of a read replica for read-only actions, or None
+    '''
+    __slots__ = ('event', 'context', 'action', 'params', 'session', 'database_url', 'replica_url',
+                 'read_only', 'hold_commits', 'commit_requested', 'committed', '_conn', '_conn_url', '_cursor',
+                 '_on_commit')
+
+    def __init__(self, event: Dict[str, Any], context: Any, action: str, params: Dict[str, Any],
+                 session: Optional[sessions.Claims], database_url: str, replica_url: Optional[str] = None,
+                 read_only: bool = False) -> None:
+        self.event = event
+        self.context = context
+        self.action = action
+        self.params = params
+        self.session = session
+        self.database_url = database_url
+        self.replica_url = replica_url
+        self.read_only = read_only
+        self.hold_commits = False
+        self.commit_requested = False
+        self._conn = None
+        self._conn_url = database_url
+        self._cursor = None
+        self._on_commit: List[Callable[[], Any]] = []
+        self.committed = False
+
+    def header(self, name: str) -> Optional[str]:
+        headers = self.event.get('headers') or {}
+        return headers.get(name) or headers.get(name.lower())
+
+    @property
+    def conn(self) -> Any:
+        if self._conn is None:
+            if self.read_only and self.replica_url:
+                self._conn, self._conn_url = db.acquire_for_read(self.database_url, self.replica_url,
+                                                                 self.position_keys)
+            else:
+                self._conn = db.acquire(self.database_url)
+        return self._conn
+
+    @property
+    def position_keys(self) -> Tuple[str, ...]:
+        '''
+        Business: Keys of the WAL positions this request must read past: its session and its user
+        Legacy header sessions have no token and legacy admins have user id 0,
+        so they share the user's key.
+        '''
+        if self.session is None:
+            return ()
+        keys = (str(self.session.user_id),)
+        return keys + (f'session:{self.session.token_id}',) if self.session.token_id else keys
+
+    @property
+    def on_replica(self) -> bool:
+        return self._conn is not None and self._conn_url != self.database_url
+
+    @property
+    def cursor(self) -> Any:
+        if self._cursor is None:
+            from psycopg2.extras import RealDictCursor
+            self._cursor = self.conn.cursor(cursor_factory=RealDictCursor)
+        return self._cursor
+
+    def commit(self, on_commit: Optional[Callable[[], Any]] = None) -> None:
+        '''
+        Business: Commit the action's transaction, then run on_commit (e.g. cache invalidation)
+        While hold_commits is set the commit is only recorded in commit_requested
+        and happens in flush_commit().
+        '''
+        if on_commit is not None:
+            self._on_commit.append(on_commit)
+        if self.hold_commits:
+            self.commit_requested = True
+            return
+        self.flush_commit()
+
+    def flush_commit(self) -> None:
+        self.conn.commit()
+        self.committed = True
+        callbacks, self._on_commit = self._on_commit, []
+        for callback in callbacks:
+            callback()
+
+    def close(self) -> None:
+        if self._cursor is not None:
+            self._cursor.close()
+        try:
+            if self._conn is None:
+                return
+            # only a commit moves the WAL; failed and read-only actions keep reading from the replica
+            if self.replica_url and self.committed and not self.read_only and not self._conn.closed:
+                try:
+                    db.record_writes(self._conn, *self.position_keys)
+                except Exception:
+                    pass
+            db.release(self._conn_url, self._conn)
+        finally:
+            # users marked by an action that never reached record_writes()
+            db.forget_writes()
+
+
+Action = Callable[[Request], Dict[str, Any]]
+
+
+def dispatch(event: Dict[str, Any], context: Any, routes: Dict[str, Dict[str, Action]],
+             preflight_response: Dict[str, Any], auth: Optional[str] = None,
+             default_action: Optional[str] = None) -> Dict[str, Any]:
+    '''
+    Business: Route an event to its action function
+    Args: routes - {method: {action: function}}
+          preflight_response - answer to OPTIONS, see preflight()
+          auth - None, 'user' (401 without a signed-in user) or 'admin' (403 unless admin)
+          default_action - GET action when the query string names none
+    Returns: HTTP response dict
+    '''
+    method = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return dict(preflight_response)
+
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return error(500, 'Database not configured')
+
+    session = None
+    if auth:
+        session = sessions.authenticate(event.get('headers'), database_url)
+        if auth == 'admin' and (not session or not session.is_admin):
+            return error(403, 'Access denied')
+        if auth == 'user' and (not session or not session.user_id):
+            return error(401, 'Unauthorized')
+
+    actions = routes.get(method)
+    if actions is None:
+        return error(405, 'Method not allowed')
+
+    if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        action = params.get('action', default_action)
+    else:
+        params = json.loads(event.get('body') or '{}')
+        action = params.get('action')
+
+    function = actions.get(action)
+    if function is None:
+        return error(405, 'Method not allowed')
+
+    replica_url = db.replica_url()
+    request = Request(event, context, action, params, session, database_url, replica_url, method == 'GET')
+    try:
+        return function(request)
+    except Exception as e:
+        if not request.on_replica or not db.is_disconnect(e):
+            raise
+        # a read-only action is safe to repeat: run it on the primary
+        db.get_replica(replica_url).mark_down()
+        retry = Request(event, context, action, params, session, database_url, read_only=True)
+        try:
+            return function(retry)
+        finally:
+            retry.close()
+    finally:
+        request.close()
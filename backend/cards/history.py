@@ -0,0 +1,239 @@
+'''
+Business: Keyset-paginated, filterable transaction history queries
+transactions is partitioned by month of created_at, so every statement here
+carries a created_at range the planner can prune partitions with. A page is
+read newest window first: the month of the cursor (or the current month),
+then windows of 2, 4, 8... months further back, until the page is full or the
+window reaches from_date or the oldest attached partition.
+'''
+import base64
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+DIRECTIONS = ('incoming', 'outgoing')
+PARTITIONS_CACHE_TTL = 300.0
+
+_oldest_partition: Tuple[float, Optional[datetime]] = (float('-inf'), None)
+_oldest_partition_lock = threading.Lock()
+
+
+class InvalidFilter(ValueError):
+    pass
+
+
+def encode_cursor(created_at: datetime, transaction_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), transaction_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token: str) -> Tuple[datetime, int]:
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        created_at, transaction_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        parsed, transaction_id = datetime.fromisoformat(created_at), int(transaction_id)
+    except (ValueError, TypeError):
+        raise InvalidFilter('Invalid cursor')
+    # cursors are minted from naive created_at values; an offset could not be compared
+    if parsed.tzinfo is not None:
+        raise InvalidFilter('Invalid cursor')
+    return parsed, transaction_id
+
+
+def _parse_date(value: Any, name: str) -> Optional[datetime]:
+    if value in (None, ''):
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        raise InvalidFilter(f'Invalid {name}')
+    # created_at has no time zone, so an offset could be neither compared nor honoured
+    if parsed.tzinfo is not None:
+        raise InvalidFilter(f'Invalid {name}: time zone offsets are not supported')
+    return parsed
+
+
+def _parse_decimal(value: Any, name: str) -> Optional[Decimal]:
+    if value in (None, ''):
+        return None
+    try:
+        amount = Decimal(str(value))
+    except InvalidOperation:
+        raise InvalidFilter(f'Invalid {name}')
+    if not amount.is_finite():
+        raise InvalidFilter(f'Invalid {name}')
+    return amount
+
+
+def _parse_int(value: Any, name: str) -> Optional[int]:
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        raise InvalidFilter(f'Invalid {name}')
+
+
+def _month_start(moment: datetime, months_back: int = 0) -> datetime:
+    year, month = divmod(moment.year * 12 + moment.month - 1 - months_back, 12)
+    return datetime(year, month + 1, 1)
+
+
+def oldest_partition(conn: Any) -> Optional[datetime]:
+    '''
+    Business: Start of the oldest attached monthly partition, cached per container
+    Older months are archived, so history is never searched below it.
+    '''
+    global _oldest_partition
+    checked_at, oldest = _oldest_partition
+    if time.monotonic() - checked_at < PARTITIONS_CACHE_TTL:
+        return oldest
+    with _oldest_partition_lock:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT transactions_oldest_partition()')
+            row = cursor.fetchone()
+        oldest = row['transactions_oldest_partition'] if isinstance(row, dict) else row[0]
+        _oldest_partition = (time.monotonic(), oldest)
+    return oldest
+
+
+def windows(upper: Optional[datetime], lower: Optional[datetime]) -> Iterator[Tuple[datetime, Optional[datetime]]]:
+    '''
+    Business: created_at ranges [start, end) to scan, newest first
+    Args: upper - newest created_at a page can hold (cursor or to_date), None for now
+          lower - oldest created_at worth scanning, None for one window only
+    Returns: iterator of (start, end); the first window is open-ended so rows
+             stamped slightly ahead of the application clock are not missed
+    '''
+    end: Optional[datetime] = None
+    start = _month_start(upper or datetime.now())
+    months = 1
+    while True:
+        if lower is not None and start < lower:
+            start = lower
+        yield start, end
+        if lower is None or start <= lower:
+            return
+        end = start
+        months *= 2
+        start = _month_start(start, months)
+
+
+def build_query(user_id: Any, params: Dict[str, Any],
+                window: Optional[Tuple[datetime, Optional[datetime]]] = None,
+                fetch: Optional[int] = None) -> Tuple[str, List[Any], int]:
+    '''
+    Business: Build the SQL for one page of a user's transaction history
+    Args: user_id - owner whose history is listed
+          params - cursor, limit, from_date, to_date, card_id, direction,
+                   min_amount, max_amount (all optional)
+          window - (start, end) created_at range to scan, see windows()
+          fetch - rows to fetch, by default one more than the page size
+    Returns: (sql, parameters, page size); the query fetches one extra row
+             to tell whether a next page exists
+    Raises: InvalidFilter for malformed parameters
+    '''
+    limit = _parse_int(params.get('limit'), 'limit') or DEFAULT_PAGE_SIZE
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise InvalidFilter('Invalid limit')
+
+    conditions = ['t.user_id = %s']
+    values: List[Any] = [user_id]
+
+    card_id = _parse_int(params.get('card_id'), 'card_id')
+    if card_id is not None:
+        conditions.append('t.card_id = %s')
+        values.append(card_id)
+
+    direction = params.get('direction')
+    if direction not in (None, ''):
+        if direction not in DIRECTIONS:
+            raise InvalidFilter('Invalid direction')
+        conditions.append('t.transaction_type = %s')
+        values.append(direction)
+
+    from_date = _parse_date(params.get('from_date'), 'from_date')
+    if from_date is not None:
+        conditions.append('t.created_at >= %s')
+        values.append(from_date)
+
+    to_date = _parse_date(params.get('to_date'), 'to_date')
+    if to_date is not None:
+        conditions.append('t.created_at < %s')
+        values.append(to_date)
+
+    min_amount = _parse_decimal(params.get('min_amount'), 'min_amount')
+    if min_amount is not None:
+        conditions.append('t.amount >= %s')
+        values.append(min_amount)
+
+    max_amount = _parse_decimal(params.get('max_amount'), 'max_amount')
+    if max_amount is not None:
+        conditions.append('t.amount <= %s')
+        values.append(max_amount)
+
+    cursor_token = params.get('cursor')
+    if cursor_token:
+        after_created_at, after_id = decode_cursor(str(cursor_token))
+        # the plain bound lets the planner prune partitions; the row comparison cannot
+        conditions.append('t.created_at <= %s AND (t.created_at, t.id) < (%s, %s)')
+        values.extend([after_created_at, after_created_at, after_id])
+
+    if window is not None:
+        conditions.append('t.created_at >= %s')
+        values.append(window[0])
+        if window[1] is not None:
+            conditions.append('t.created_at < %s')
+            values.append(window[1])
+
+    sql = f"""SELECT t.* FROM transactions t
+              WHERE {' AND '.join(conditions)}
+              ORDER BY t.created_at DESC, t.id DESC
+              LIMIT %s"""
+    values.append(fetch or limit + 1)
+    return sql, values, limit
+
+
+def fetch_page(conn: Any, user_id: Any, params: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Business: Fetch one page of history and the cursor for the next page
+    Args: conn - open connection; rows are read as plain tuples
+          user_id - owner whose history is listed
+          params - filters, see build_query
+    Returns: dict with cursor 'description', tuple 'rows' and 'next_cursor'
+             (None on the last page)
+    Raises: InvalidFilter for malformed parameters
+    '''
+    _, _, limit = build_query(user_id, params)
+    from_date = _parse_date(params.get('from_date'), 'from_date')
+    to_date = _parse_date(params.get('to_date'), 'to_date')
+    cursor_token = params.get('cursor')
+    after_created_at = decode_cursor(str(cursor_token))[0] if cursor_token else None
+    # to_date is exclusive: a month-aligned to_date must not open an empty window
+    last_to_date = to_date - timedelta(microseconds=1) if to_date is not None else None
+    upper = min((bound for bound in (last_to_date, after_created_at) if bound is not None), default=None)
+    oldest = oldest_partition(conn)
+    lower = max((bound for bound in (from_date, oldest) if bound is not None), default=None)
+
+    rows: List[Any] = []
+    description = None
+    with conn.cursor() as cursor:
+        for window in windows(upper, lower):
+            sql, values, _ = build_query(user_id, params, window, limit + 1 - len(rows))
+            cursor.execute(sql, values)
+            rows.extend(cursor.fetchall())
+            description = cursor.description
+            if len(rows) > limit:
+                break
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        columns = [column[0] for column in description]
+        last = rows[-1]
+        next_cursor = encode_cursor(last[columns.index('created_at')], last[columns.index('id')])
+    return {'description': description, 'rows': rows, 'next_cursor': next_cursor}
@@ -0,0 +1,178 @@
+'''
+Business: Idempotency-Key support for actions that move money
+A client sends the same Idempotency-Key header on every retry of one logical
+request. The first attempt claims the key with an INSERT into
+idempotency_keys inside the action's own transaction and stores the response
+there before committing, so the key and the money movement commit (or roll
+back) together. A concurrent duplicate blocks on that uncommitted row (or, in
+the same container, on an in-process event) and then returns the stored
+response; replays are served from an in-process cache without any SQL. Only
+committed outcomes are stored: an attempt that rolled back left nothing
+behind, so its retry runs again. Keys live IDEMPOTENCY_TTL seconds.
+Every cloud function directory that uses it ships an identical copy.
+'''
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import cache
+import runtime
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+CACHE_TTL = float(os.environ.get('IDEMPOTENCY_CACHE_TTL', '300'))
+WAIT_TIMEOUT = float(os.environ.get('IDEMPOTENCY_WAIT_TIMEOUT', '10'))
+CLEANUP_INTERVAL = float(os.environ.get('IDEMPOTENCY_CLEANUP_INTERVAL', '300'))
+CLEANUP_BATCH = 1000
+
+REPLAY_HEADERS = {**runtime.JSON_HEADERS, 'Idempotent-Replayed': 'true'}
+
+# (scope, key) -> (request hash, status code, body) of committed responses
+responses = cache.LocalLRU(ttl=CACHE_TTL)
+
+_inflight: Dict[Tuple[str, str], threading.Event] = {}
+_inflight_lock = threading.Lock()
+_cleaned_at = float('-inf')
+
+
+def request_hash(params: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _replay(stored: Tuple[str, int, str], fingerprint: str) -> Dict[str, Any]:
+    if stored[0] != fingerprint:
+        return runtime.error(422, 'Idempotency-Key was used with a different request')
+    return runtime.respond(stored[1], stored[2], REPLAY_HEADERS)
+
+
+def cleanup(conn: Any, force: bool = False) -> int:
+    '''
+    Business: Delete a batch of expired keys, at most once per CLEANUP_INTERVAL per container
+    Args: conn - connection outside a transaction; the deletion is committed on its own
+    Returns: number of keys deleted
+    '''
+    global _cleaned_at
+    now = time.monotonic()
+    if not force and now - _cleaned_at < CLEANUP_INTERVAL:
+        return 0
+    _cleaned_at = now
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """DELETE FROM idempotency_keys
+               WHERE ctid IN (
+                   SELECT ctid FROM idempotency_keys
+                   WHERE expires_at < now()
+                   LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+               )""",
+            (CLEANUP_BATCH,)
+        )
+        deleted = cursor.rowcount
+    conn.commit()
+    return deleted
+
+
+def _claim(cursor: Any, scope: str, key: str, fingerprint: str) -> Optional[Tuple[str, int, str]]:
+    '''
+    Business: Claim the key in the current transaction
+    Blocks while another transaction holds an uncommitted claim on it.
+    Returns: None when claimed, else the stored (hash, status, body)
+    '''
+    cursor.execute(
+        """INSERT INTO idempotency_keys (scope, idempotency_key, request_hash, expires_at)
+           VALUES (%s, %s, %s, now() + make_interval(secs => %s))
+           ON CONFLICT (scope, idempotency_key) DO UPDATE
+               SET request_hash = EXCLUDED.request_hash, status_code = NULL, response_body = NULL,
+                   created_at = now(), expires_at = EXCLUDED.expires_at
+               WHERE idempotency_keys.expires_at < now()
+           RETURNING 1""",
+        (scope, key, fingerprint, IDEMPOTENCY_TTL)
+    )
+    if cursor.fetchone():
+        return None
+    cursor.execute(
+        """SELECT request_hash, status_code, response_body FROM idempotency_keys
+           WHERE scope = %s AND idempotency_key = %s""",
+        (scope, key)
+    )
+    row = cursor.fetchone()
+    return (row[0], row[1], row[2]) if row else None
+
+
+def _store(cursor: Any, scope: str, key: str, fingerprint: str, response: Dict[str, Any]) -> None:
+    # upsert: an action that rolled back and then committed has lost the claim row
+    cursor.execute(
+        """INSERT INTO idempotency_keys (scope, idempotency_key, request_hash, status_code, response_body, expires_at)
+           VALUES (%s, %s, %s, %s, %s, now() + make_interval(secs => %s))
+           ON CONFLICT (scope, idempotency_key) DO UPDATE
+               SET status_code = EXCLUDED.status_code, response_body = EXCLUDED.response_body""",
+        (scope, key, fingerprint, response['statusCode'], response['body'], IDEMPOTENCY_TTL)
+    )
+
+
+def keyed(action: runtime.Action) -> runtime.Action:
+    '''
+    Business: Make an action honour the Idempotency-Key header
+    The action must commit through request.commit(). Requests without the
+    header run unchanged.
+    '''
+
+    @functools.wraps(action)
+    def wrapper(request: runtime.Request) -> Dict[str, Any]:
+        key = request.header(HEADER)
+        if key is None:
+            return action(request)
+        if not key or len(key) > MAX_KEY_LENGTH or not key.isprintable():
+            return runtime.error(400, 'Invalid Idempotency-Key')
+
+        caller = request.session.user_id if request.session else 0
+        scope = f'{request.action}:{caller}'
+        fingerprint = request_hash(request.params)
+        slot = (scope, key)
+
+        while True:
+            stored = responses.get(slot)
+            if stored is not None:
+                return _replay(stored, fingerprint)
+            with _inflight_lock:
+                running = _inflight.get(slot)
+                if running is None:
+                    done = _inflight[slot] = threading.Event()
+                    break
+            # same container: wait for the first attempt instead of holding a second connection
+            if not running.wait(WAIT_TIMEOUT):
+                return runtime.error(409, 'A request with this Idempotency-Key is still in progress')
+
+        try:
+            cleanup(request.conn)
+            with request.conn.cursor() as cursor:
+                stored = _claim(cursor, scope, key, fingerprint)
+            if stored is not None:
+                request.conn.rollback()
+                if stored[1] is None:
+                    return runtime.error(409, 'A request with this Idempotency-Key is still in progress')
+                responses.set(slot, stored)
+                return _replay(stored, fingerprint)
+
+            request.hold_commits = True
+            response = action(request)
+            if not request.commit_requested:
+                request.conn.rollback()
+                return response
+
+            with request.conn.cursor() as cursor:
+                _store(cursor, scope, key, fingerprint, response)
+            request.flush_commit()
+            responses.set(slot, (fingerprint, response['statusCode'], response['body']))
+            return response
+        finally:
+            with _inflight_lock:
+                _inflight.pop(slot, None)
+            done.set()
+
+    return wrapper
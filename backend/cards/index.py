@@ -1,10 +1,281 @@
 import json
-import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
 from typing import Dict, Any
-import random
 
+import admission
+import cache
+import encoder
+import history
+import idempotency
+import recipients
+import runtime
+import stats
+import tracing
+import transfers
+
+PREFLIGHT = runtime.preflight('GET, POST, OPTIONS', 'Content-Type, Authorization, X-Auth-Token, X-User-Id, Idempotency-Key')
+
+
+def list_cards(request: runtime.Request) -> Dict[str, Any]:
+    user_id = str(request.session.user_id)
+    cache_key = cache.dashboard.key(user_id, 'cards')
+    cached = cache.dashboard.get(cache_key)
+    if cached is not None:
+        return runtime.respond(200, cached)
+    
+    cursor = request.cursor
+    cursor.execute(
+        """SELECT c.*, u.first_name, u.last_name
+           FROM cards c
+           JOIN users u ON c.user_id = u.id
+           WHERE c.user_id = %s AND c.is_active = TRUE
+           ORDER BY c.created_at DESC""",
+        (user_id,)
+    )
+    cards = cursor.fetchall()
+    body = encoder.dumps({'cards': encoder.rows(cursor.description, cards)})
+    cache.dashboard.set(cache_key, body)
+    
+    return runtime.respond(200, body)
+
+
+def list_requests(request: runtime.Request) -> Dict[str, Any]:
+    user_id = str(request.session.user_id)
+    cache_key = cache.dashboard.key(user_id, 'requests')
+    cached = cache.dashboard.get(cache_key)
+    if cached is not None:
+        return runtime.respond(200, cached)
+    
+    cursor = request.cursor
+    cursor.execute(
+        """SELECT * FROM card_requests
+           WHERE user_id = %s
+           ORDER BY created_at DESC""",
+        (user_id,)
+    )
+    requests = cursor.fetchall()
+    body = encoder.dumps({'requests': encoder.rows(cursor.description, requests)})
+    cache.dashboard.set(cache_key, body)
+    
+    return runtime.respond(200, body)
+
+
+def transactions(request: runtime.Request) -> Dict[str, Any]:
+    user_id = str(request.session.user_id)
+    params = request.params
+    # Only the unfiltered first page (the dashboard's recent list) is cached
+    cache_key = cache.dashboard.key(user_id, 'transactions') if set(params) <= {'action'} else None
+    if cache_key:
+        cached = cache.dashboard.get(cache_key)
+        if cached is not None:
+            return runtime.respond(200, cached)
+    
+    try:
+        page = history.fetch_page(request.conn, user_id, params)
+    except history.InvalidFilter as e:
+        return runtime.error(400, str(e))
+    
+    body = encoder.dumps({
+        'transactions': encoder.rows(page['description'], page['rows']),
+        'next_cursor': page['next_cursor']
+    })
+    if cache_key:
+        cache.dashboard.set(cache_key, body)
+    
+    return runtime.respond(200, body)
+
+
+def spending_stats(request: runtime.Request) -> Dict[str, Any]:
+    user_id = str(request.session.user_id)
+    params = request.params
+    cache_key = cache.dashboard.key(user_id, 'stats:' + json.dumps(params, sort_keys=True))
+    cached = cache.dashboard.get(cache_key)
+    if cached is not None:
+        return runtime.respond(200, cached)
+    
+    try:
+        report = stats.summary(request.conn, user_id, params)
+    except history.InvalidFilter as e:
+        return runtime.error(400, str(e))
+    
+    body = json.dumps(report, default=str)
+    cache.dashboard.set(cache_key, body)
+    
+    return runtime.respond(200, body)
+
+
+def resolve_recipient(request: runtime.Request) -> Dict[str, Any]:
+    identifier = recipients.normalize(request.params.get('to_identifier'))
+    recipient = recipients.resolve(request.conn, identifier) if identifier else None
+    
+    if not recipient:
+        return runtime.error(404, 'Recipient not found')
+    
+    return runtime.ok({
+        'recipient': {
+            'masked_number': recipient.masked_number,
+            'holder_name': recipient.holder_name,
+            'own_card': str(recipient.user_id) == str(request.session.user_id)
+        }
+    })
+
+
+def request_card(request: runtime.Request) -> Dict[str, Any]:
+    user_id = str(request.session.user_id)
+    card_category = request.params.get('card_category')
+    
+    if card_category not in ['debit', 'credit']:
+        return runtime.error(400, 'Invalid card category')
+    
+    cursor = request.cursor
+    cursor.execute(
+        """INSERT INTO card_requests (user_id, card_category, status)
+           VALUES (%s, %s, 'pending')
+           RETURNING id, card_category, status, created_at""",
+        (user_id, card_category)
+    )
+    new_request = cursor.fetchone()
+    request.commit()
+    cache.dashboard.invalidate(user_id)
+    
+    return runtime.respond(200, encoder.dumps({'success': True, 'request': encoder.row(cursor.description, new_request)}))
+
+
+def transfer(request: runtime.Request) -> Dict[str, Any]:
+    user_id = str(request.session.user_id)
+    from_card_id = request.params.get('from_card_id')
+    to_identifier = request.params.get('to_identifier')
+    amount = transfers.parse_amount(request.params.get('amount', 0))
+    
+    if not from_card_id or not to_identifier or amount is None:
+        return runtime.error(400, 'Invalid transfer data')
+    
+    conn = request.conn
+    identifier = recipients.normalize(to_identifier)
+    to_card = recipients.resolve(conn, identifier) if identifier else None
+    
+    if request.params.get('async', transfers.ASYNC_DEFAULT):
+        return queue_transfer(request, user_id, from_card_id, to_card, amount, to_identifier)
+    
+    outcome = transfers.execute_transfer(
+        request.cursor, user_id, from_card_id, to_card.card_id if to_card else None, amount, to_identifier
+    )
+    
+    if outcome['result'] != 'completed':
+        conn.rollback()
+        if outcome['result'] == 'recipient_not_found' and to_card:
+            recipients.forget(identifier)
+        status_code, error = transfers.RESULT_ERRORS[outcome['result']]
+        return runtime.error(status_code, error)
+    
+    request.commit(lambda: cache.dashboard.invalidate(user_id, to_card.user_id))
+    
+    return runtime.ok({'success': True, 'message': 'Transfer completed'})
+
+
+def queue_transfer(request: runtime.Request, user_id: str, from_card_id: Any, to_card: Any,
+                   amount: Any, to_identifier: str) -> Dict[str, Any]:
+    if to_card is None:
+        status_code, error = transfers.RESULT_ERRORS['recipient_not_found']
+        return runtime.error(status_code, error)
+    if not str(from_card_id).isdigit() or int(from_card_id) == to_card.card_id:
+        status_code, error = transfers.RESULT_ERRORS['same_card']
+        return runtime.error(status_code, error)
+    
+    transaction_id = transfers.enqueue_transfer(
+        request.cursor, user_id, from_card_id, to_card.card_id, amount, to_identifier
+    )
+    if transaction_id is None:
+        request.conn.rollback()
+        status_code, error = transfers.RESULT_ERRORS['invalid_card']
+        return runtime.error(status_code, error)
+    
+    request.commit(lambda: cache.dashboard.invalidate(user_id))
+    
+    return runtime.respond(202, encoder.dumps({
+        'success': True,
+        'status': 'pending',
+        'transaction_id': transaction_id,
+        'message': 'Transfer queued'
+    }))
+
+
+def transfer_status(request: runtime.Request) -> Dict[str, Any]:
+    transaction_id = str(request.params.get('transaction_id', ''))
+    
+    if not transaction_id.isdigit():
+        return runtime.error(400, 'Invalid transaction_id')
+    
+    cursor = request.cursor
+    cursor.execute(
+        """SELECT id, card_id, amount, recipient, status, failure_reason, created_at
+           FROM transactions
+           WHERE id = %s AND user_id = %s AND transaction_type = 'outgoing'""",
+        (transaction_id, request.session.user_id)
+    )
+    transaction = cursor.fetchone()
+    
+    if not transaction:
+        return runtime.error(404, 'Transaction not found')
+    
+    return runtime.respond(200, encoder.dumps({'transaction': encoder.row(cursor.description, transaction)}))
+
+
+def transfer_batch(request: runtime.Request) -> Dict[str, Any]:
+    user_id = str(request.session.user_id)
+    from_card_id = request.params.get('from_card_id')
+    items = request.params.get('items')
+    atomic = bool(request.params.get('atomic', False))
+    
+    if (not str(from_card_id or '').isdigit() or not isinstance(items, list)
+            or not items or len(items) > transfers.MAX_BATCH_ITEMS):
+        return runtime.error(400, 'Invalid transfer data')
+    
+    conn = request.conn
+    outcome = transfers.execute_batch(conn, user_id, from_card_id, items, atomic)
+    
+    if not outcome['applied']:
+        conn.rollback()
+    
+    if 'error' in outcome:
+        return runtime.error(400, outcome['error'])
+    
+    if atomic and outcome['failed']:
+        return runtime.error(400, 'Batch rejected', results=outcome['results'])
+    
+    if outcome['applied']:
+        request.commit()
+        cache.dashboard.invalidate(user_id, *outcome['user_ids'])
+    
+    return runtime.ok({
+        'success': True,
+        'completed': outcome['completed'],
+        'failed': outcome['failed'],
+        'total_amount': outcome['total_amount'],
+        'results': outcome['results']
+    })
+
+
+TRANSFER_LIMITS = [admission.Rule('transfer:user', admission.session_user, rate=2, burst=20)]
+
+ROUTES = admission.guard({
+    'GET': {
+        'list': list_cards,
+        'requests': list_requests,
+        'transactions': transactions,
+        'stats': spending_stats,
+        'resolve_recipient': resolve_recipient,
+        'transfer_status': transfer_status,
+    },
+    'POST': {
+        'request_card': request_card,
+        'transfer': idempotency.keyed(transfer),
+        'transfer_batch': transfer_batch,
+        'transactions': transactions,
+    },
+}, {'transfer': TRANSFER_LIMITS, 'transfer_batch': TRANSFER_LIMITS})
+
+
+@tracing.traced
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Card management API for users
@@ -12,210 +283,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
           context - object with attributes: request_id, function_name
     Returns: HTTP response dict with card data
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    database_url = os.environ.get('DATABASE_URL')
-    if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'})
-        }
-    
-    conn = psycopg2.connect(database_url)
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
     try:
-        headers = event.get('headers', {})
-        user_id = headers.get('X-User-Id') or headers.get('x-user-id')
-        
-        if not user_id:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Unauthorized'})
-            }
-        
-        if method == 'GET':
-            action = event.get('queryStringParameters', {}).get('action', 'list')
-            
-            if action == 'list':
-                cursor.execute(
-                    """SELECT c.*, u.first_name, u.last_name 
-                       FROM cards c 
-                       JOIN users u ON c.user_id = u.id 
-                       WHERE c.user_id = %s AND c.is_active = TRUE 
-                       ORDER BY c.created_at DESC""",
-                    (user_id,)
-                )
-                cards = cursor.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'cards': [dict(card) for card in cards]}, default=str)
-                }
-            
-            elif action == 'requests':
-                cursor.execute(
-                    """SELECT * FROM card_requests 
-                       WHERE user_id = %s 
-                       ORDER BY created_at DESC""",
-                    (user_id,)
-                )
-                requests = cursor.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'requests': [dict(req) for req in requests]}, default=str)
-                }
-        
-        elif method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            action = body_data.get('action')
-            
-            if action == 'request_card':
-                card_category = body_data.get('card_category')
-                
-                if card_category not in ['debit', 'credit']:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid card category'})
-                    }
-                
-                cursor.execute(
-                    """INSERT INTO card_requests (user_id, card_category, status) 
-                       VALUES (%s, %s, 'pending') 
-                       RETURNING id, card_category, status, created_at""",
-                    (user_id, card_category)
-                )
-                new_request = cursor.fetchone()
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'request': dict(new_request)}, default=str)
-                }
-            
-            elif action == 'transfer':
-                from_card_id = body_data.get('from_card_id')
-                to_identifier = body_data.get('to_identifier')
-                amount = float(body_data.get('amount', 0))
-                
-                if not from_card_id or not to_identifier or amount <= 0:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid transfer data'})
-                    }
-                
-                cursor.execute(
-                    "SELECT * FROM cards WHERE id = %s AND user_id = %s AND status = 'active'",
-                    (from_card_id, user_id)
-                )
-                from_card = cursor.fetchone()
-                
-                if not from_card or float(from_card['balance']) < amount:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Insufficient funds or invalid card'})
-                    }
-                
-                if to_identifier.startswith('+'):
-                    cursor.execute(
-                        """SELECT c.* FROM cards c 
-                           JOIN users u ON c.user_id = u.id 
-                           WHERE u.phone = %s AND c.status = 'active' 
-                           LIMIT 1""",
-                        (to_identifier,)
-                    )
-                else:
-                    cursor.execute(
-                        "SELECT * FROM cards WHERE card_number = %s AND status = 'active' LIMIT 1",
-                        (to_identifier.replace(' ', '').replace('•', ''),)
-                    )
-                
-                to_card = cursor.fetchone()
-                
-                if not to_card:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Recipient not found'})
-                    }
-                
-                cursor.execute(
-                    "UPDATE cards SET balance = balance - %s WHERE id = %s",
-                    (amount, from_card_id)
-                )
-                cursor.execute(
-                    "UPDATE cards SET balance = balance + %s WHERE id = %s",
-                    (amount, to_card['id'])
-                )
-                
-                cursor.execute(
-                    """INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status) 
-                       VALUES (%s, %s, 'outgoing', %s, %s, 'completed')""",
-                    (from_card_id, user_id, amount, to_identifier)
-                )
-                cursor.execute(
-                    """INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status) 
-                       VALUES (%s, %s, 'incoming', %s, %s, 'completed')""",
-                    (to_card['id'], to_card['user_id'], amount, from_card['masked_number'])
-                )
-                
-                conn.commit()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'success': True, 'message': 'Transfer completed'})
-                }
-            
-            elif action == 'transactions':
-                cursor.execute(
-                    """SELECT t.* FROM transactions t 
-                       JOIN cards c ON t.card_id = c.id 
-                       WHERE c.user_id = %s 
-                       ORDER BY t.created_at DESC 
-                       LIMIT 50""",
-                    (user_id,)
-                )
-                transactions = cursor.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({'transactions': [dict(t) for t in transactions]}, default=str)
-                }
-        
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
-    
+        return runtime.dispatch(event, context, ROUTES, PREFLIGHT, auth='user', default_action='list')
     finally:
-        cursor.close()
-        conn.close()
+        cache.dashboard.log_stats()
@@ -0,0 +1,109 @@
+'''
+Business: Resolve transfer recipients given as a phone number or card number
+Identifiers are normalized the same way the database indexes them
+(normalize_phone / normalize_card_number): phones keep '+' and digits, card
+numbers keep digits only. A phone resolves to the
+owner's primary card, the earliest active one that is not deleted. Found
+recipients are kept in a short-TTL in-process cache; misses are not cached, so
+new cards show up at once, and transfers forget() a recipient whose card turns
+out to be no longer usable.
+'''
+import os
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import cache
+
+RECIPIENT_CACHE_TTL = float(os.environ.get('RECIPIENT_CACHE_TTL', '5'))
+RECIPIENT_CACHE_SIZE = int(os.environ.get('RECIPIENT_CACHE_SIZE', '4096'))
+CARD_NUMBER_LENGTHS = range(12, 20)
+PHONE_LENGTHS = range(8, 16)
+
+_cache = cache.LocalLRU(RECIPIENT_CACHE_SIZE, RECIPIENT_CACHE_TTL)
+
+
+class Recipient(NamedTuple):
+    card_id: int
+    user_id: int
+    masked_number: str
+    holder_name: str
+
+
+def normalize(identifier: Any) -> Optional[str]:
+    '''
+    Business: Canonical form of a recipient identifier
+    Args: identifier - e.g. '+7 (900) 123-45-67' or '4532 1234 5678 8901'
+    Returns: '+79001234567' / '4532123456788901', or None if it cannot be a phone or card number
+    '''
+    if not isinstance(identifier, str):
+        return None
+    identifier = identifier.strip()
+    digits = ''.join(char for char in identifier if char.isdigit())
+    if identifier.startswith('+'):
+        return '+' + digits if len(digits) in PHONE_LENGTHS else None
+    if len(digits) not in CARD_NUMBER_LENGTHS:
+        return None
+    if any(not (char.isdigit() or char in ' -•') for char in identifier):
+        return None
+    return digits
+
+
+def resolve_many(conn: Any, identifiers: List[str]) -> Dict[str, Recipient]:
+    '''
+    Business: Resolve normalized identifiers to active cards, one query for all cache misses
+    Args: conn - open connection
+          identifiers - values returned by normalize()
+    Returns: dict identifier -> Recipient for every identifier that was found
+    '''
+    found: Dict[str, Recipient] = {}
+    missing = []
+    for identifier in set(identifiers):
+        recipient = _cache.get(identifier)
+        if recipient is None:
+            missing.append(identifier)
+        else:
+            found[identifier] = recipient
+    if not missing:
+        return found
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT w.ident, r.id, r.user_id, r.masked_number, r.first_name, r.last_name
+               FROM unnest(%s::text[]) AS w(ident)
+               JOIN LATERAL (
+                   (SELECT c.id, c.user_id, c.masked_number, u.first_name, u.last_name
+                    FROM users u
+                    JOIN cards c ON c.user_id = u.id AND c.status = 'active' AND c.is_active
+                    WHERE left(w.ident, 1) = '+' AND normalize_phone(u.phone) = w.ident
+                    ORDER BY c.id
+                    LIMIT 1)
+                   UNION ALL
+                   (SELECT c.id, c.user_id, c.masked_number, u.first_name, u.last_name
+                    FROM cards c
+                    JOIN users u ON u.id = c.user_id
+                    WHERE left(w.ident, 1) <> '+' AND normalize_card_number(c.card_number) = w.ident
+                      AND c.status = 'active' AND c.is_active
+                    ORDER BY c.id
+                    LIMIT 1)
+                   LIMIT 1
+               ) r ON TRUE""",
+            (missing,)
+        )
+        for identifier, card_id, user_id, masked_number, first_name, last_name in cursor.fetchall():
+            holder_name = first_name or ''
+            if last_name:
+                holder_name = f'{holder_name} {last_name[:1]}.'.strip()
+            recipient = Recipient(card_id, user_id, masked_number, holder_name)
+            _cache.set(identifier, recipient)
+            found[identifier] = recipient
+    return found
+
+
+def resolve(conn: Any, identifier: str) -> Optional[Recipient]:
+    return resolve_many(conn, [identifier]).get(identifier)
+
+
+def forget(identifier: str) -> None:
+    '''
+    Business: Drop a cached recipient, e.g. one whose card was blocked or deleted
+    '''
+    _cache.delete(identifier)
@@ -0,0 +1,214 @@
+'''
+Business: Income and spending analytics over the daily per-card rollups
+Reads card_daily_stats and card_daily_recipients (V0013), which transfers
+update in their own transaction, so a report costs at most one row per card
+and day of the range, however many transactions it covers. rebuild()
+recomputes the rollups from transactions for backfills and repairs.
+
+Usage: DATABASE_URL=postgresql://... python stats.py 2024-01-01 2024-12-31
+'''
+import calendar
+import os
+import sys
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+import db
+import history
+
+MAX_RANGE_DAYS = 3660
+DEFAULT_TOP = 5
+MAX_TOP = 50
+REBUILD_CHUNK_DAYS = 7
+FIELDS = ('incoming', 'incoming_count', 'outgoing', 'outgoing_count')
+
+
+def _parse_day(value: Any, name: str) -> Optional[date]:
+    if value in (None, ''):
+        return None
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        raise history.InvalidFilter(f'Invalid {name}')
+
+
+def shift_month(day: date, months: int) -> date:
+    year, month = divmod(day.year * 12 + day.month - 1 + months, 12)
+    month += 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def parse_range(params: Dict[str, Any], today: date) -> Tuple[date, date]:
+    '''
+    Business: Inclusive report range from from_date / to_date (YYYY-MM-DD)
+    Defaults to the current month up to today.
+    '''
+    end = _parse_day(params.get('to_date'), 'to_date') or today
+    start = _parse_day(params.get('from_date'), 'from_date') or end.replace(day=1)
+    if start > end or (end - start).days >= MAX_RANGE_DAYS:
+        raise history.InvalidFilter('Invalid date range')
+    return start, end
+
+
+def _totals(row: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    row = row or {}
+    totals = {field: row.get(field) or (0 if field.endswith('_count') else Decimal('0')) for field in FIELDS}
+    totals['net'] = totals['incoming'] - totals['outgoing']
+    return totals
+
+
+def _add(into: Dict[str, Any], row: Dict[str, Any]) -> None:
+    for field in FIELDS:
+        into[field] += row[field]
+    into['net'] = into['incoming'] - into['outgoing']
+
+
+def _change(current: Dict[str, Any], previous: Dict[str, Any]) -> Dict[str, Any]:
+    change: Dict[str, Any] = {}
+    for field in ('incoming', 'outgoing', 'net'):
+        change[field] = current[field] - previous[field]
+        change[f'{field}_pct'] = (
+            round(float((current[field] - previous[field]) / abs(previous[field]) * 100), 2)
+            if previous[field] else None
+        )
+    return change
+
+
+def summary(conn: Any, user_id: Any, params: Dict[str, Any], today: Optional[date] = None) -> Dict[str, Any]:
+    '''
+    Business: Totals, month-over-month change, monthly series and top recipients of a user
+    Args: conn - open connection
+          user_id - owner of the cards
+          params - from_date, to_date (inclusive days), card_id to limit the
+                   report to one card, top - number of recipients to list
+          today - report date, defaults to date.today()
+    Returns: dict with the range, 'totals', 'previous' (the same range one
+             month earlier) with 'change', 'months' and 'top_recipients'
+    Raises: history.InvalidFilter on malformed parameters
+    '''
+    start, end = parse_range(params, today or date.today())
+    previous_start, previous_end = shift_month(start, -1), shift_month(end, -1)
+    try:
+        card_id = int(params['card_id']) if params.get('card_id') not in (None, '') else None
+        top = min(max(int(params.get('top', DEFAULT_TOP)), 0), MAX_TOP)
+    except (TypeError, ValueError):
+        raise history.InvalidFilter('Invalid card_id or top')
+
+    card_filter = 'AND card_id = %(card_id)s' if card_id is not None else ''
+    own_card_filter = 'AND id = %(card_id)s' if card_id is not None else ''
+    values = {
+        'user_id': user_id,
+        'card_id': card_id,
+        'start': start,
+        'end': end,
+        'previous_start': previous_start,
+        'previous_end': previous_end,
+        'top': top,
+    }
+    with conn.cursor() as cursor:
+        # one pass over both ranges; they overlap when the range is longer than a month
+        cursor.execute(
+            f"""SELECT date_trunc('month', day)::DATE AS month,
+                       SUM(incoming_amount) FILTER (WHERE day >= %(start)s) AS incoming,
+                       SUM(incoming_count) FILTER (WHERE day >= %(start)s) AS incoming_count,
+                       SUM(outgoing_amount) FILTER (WHERE day >= %(start)s) AS outgoing,
+                       SUM(outgoing_count) FILTER (WHERE day >= %(start)s) AS outgoing_count,
+                       SUM(incoming_amount) FILTER (WHERE day <= %(previous_end)s) AS previous_incoming,
+                       SUM(incoming_count) FILTER (WHERE day <= %(previous_end)s) AS previous_incoming_count,
+                       SUM(outgoing_amount) FILTER (WHERE day <= %(previous_end)s) AS previous_outgoing,
+                       SUM(outgoing_count) FILTER (WHERE day <= %(previous_end)s) AS previous_outgoing_count
+                FROM card_daily_stats
+                WHERE user_id = %(user_id)s {card_filter}
+                  AND day BETWEEN %(previous_start)s AND %(end)s
+                GROUP BY 1
+                ORDER BY 1""",
+            values
+        )
+        columns = [column[0] for column in cursor.description]
+        monthly = {row[0]: dict(zip(columns, row)) for row in cursor.fetchall()}
+
+        top_recipients: List[Dict[str, Any]] = []
+        if top:
+            cursor.execute(
+                f"""SELECT recipient, SUM(amount) AS amount, SUM(transfer_count) AS transfer_count
+                    FROM card_daily_recipients
+                    WHERE card_id IN (SELECT id FROM cards WHERE user_id = %(user_id)s {own_card_filter})
+                      AND day BETWEEN %(start)s AND %(end)s
+                    GROUP BY recipient
+                    ORDER BY SUM(amount) DESC, recipient
+                    LIMIT %(top)s""",
+                values
+            )
+            top_recipients = [
+                {'recipient': recipient, 'amount': amount, 'count': count}
+                for recipient, amount, count in cursor.fetchall()
+            ]
+
+    totals, previous = _totals(), _totals()
+    for row in monthly.values():
+        _add(previous, {field: row[f'previous_{field}'] or 0 for field in FIELDS})
+    months: List[Dict[str, Any]] = []
+    month = start.replace(day=1)
+    while month <= end:
+        current = _totals(monthly.get(month))
+        _add(totals, current)
+        entry = {'month': month.strftime('%Y-%m'), **current}
+        if months:
+            entry['change'] = _change(current, months[-1])
+        months.append(entry)
+        month = shift_month(month, 1)
+
+    return {
+        'from_date': start.isoformat(),
+        'to_date': end.isoformat(),
+        'card_id': card_id,
+        'totals': totals,
+        'previous': {
+            'from_date': previous_start.isoformat(),
+            'to_date': previous_end.isoformat(),
+            **previous,
+            'change': _change(totals, previous),
+        },
+        'months': months,
+        'top_recipients': top_recipients,
+    }
+
+
+def rebuild(conn: Any, start: date, end: date, chunk_days: int = REBUILD_CHUNK_DAYS) -> int:
+    '''
+    Business: Recompute the rollups of [start, end] from transactions
+    Works in chunks of chunk_days, each committed on its own: card_stats_rebuild()
+    holds off transfers while it recounts a chunk. Days before the oldest
+    attached transactions partition keep their rollups, since the rows of
+    detached (archived) months are no longer there to recount (V0025).
+    Args: conn - open connection outside a transaction
+          start, end - inclusive days
+    Returns: number of card-day rows written
+    '''
+    rows = 0
+    day = start
+    while day <= end:
+        last = min(day + timedelta(days=chunk_days - 1), end)
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT card_stats_rebuild(%s, %s)', (day, last))
+            rows += cursor.fetchone()[0]
+        conn.commit()
+        day = last + timedelta(days=1)
+    return rows
+
+
+def main() -> None:
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn or len(sys.argv) != 3:
+        raise SystemExit('Usage: DATABASE_URL=... python stats.py FROM_DATE TO_DATE')
+    conn = db.acquire(dsn)
+    try:
+        rows = rebuild(conn, date.fromisoformat(sys.argv[1]), date.fromisoformat(sys.argv[2]))
+    finally:
+        db.release(dsn, conn)
+    print(f'rebuilt {rows} card-day rows')
+
+
+if __name__ == '__main__':
+    main()
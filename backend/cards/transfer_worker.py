@@ -0,0 +1,101 @@
+'''
+Business: Worker process that applies queued (async) transfers
+Repeatedly drains transfer_queue with transfers.drain_queue() and commits
+each batch at once, so one fsync covers up to TRANSFER_QUEUE_BATCH_SIZE
+transfers. Several workers may run side by side; SKIP LOCKED hands each its
+own rows. Sleeps TRANSFER_WORKER_IDLE_SLEEP seconds while the queue is empty.
+A batch that fails is logged and the loop goes on with the same connection;
+only a lost connection ends run(), and main() then reconnects.
+
+Usage: DATABASE_URL=postgresql://... python transfer_worker.py
+'''
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import cache
+import db
+import transfers
+
+IDLE_SLEEP = float(os.environ.get('TRANSFER_WORKER_IDLE_SLEEP', '0.2'))
+LOG_STATS = os.environ.get('TRANSFER_WORKER_STATS') == '1'
+
+
+def drain_once(conn: Any, batch_size: int = transfers.QUEUE_BATCH_SIZE) -> Dict[str, Any]:
+    '''
+    Business: Apply and commit one batch of queued transfers
+    Args: conn - connection borrowed from the pool
+          batch_size - maximum transfers in the batch
+    Returns: drain_queue() outcome
+    '''
+    try:
+        outcome = transfers.drain_queue(conn, batch_size)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if outcome['user_ids']:
+        cache.dashboard.invalidate(*outcome['user_ids'])
+        db.record_writes(conn)
+    return outcome
+
+
+def run(dsn: str, batch_size: int = transfers.QUEUE_BATCH_SIZE, idle_sleep: float = IDLE_SLEEP,
+        stop: Optional[threading.Event] = None, exit_when_empty: bool = False) -> Dict[str, int]:
+    '''
+    Business: Drain the queue until stopped
+    Args: dsn - database connection string
+          batch_size - maximum transfers committed together
+          idle_sleep - pause between polls of an empty queue
+          stop - event that ends the loop after the current batch
+          exit_when_empty - return as soon as a poll finds no work
+    Returns: totals {'batches', 'processed', 'completed', 'failed', 'errors'}
+    '''
+    stop = stop or threading.Event()
+    totals = {'batches': 0, 'processed': 0, 'completed': 0, 'failed': 0, 'errors': 0}
+    conn = db.acquire(dsn)
+    try:
+        while not stop.is_set():
+            try:
+                outcome = drain_once(conn, batch_size)
+            except Exception as e:
+                if conn.closed:
+                    raise
+                print(json.dumps({'transfer_worker_error': str(e)}))
+                totals['errors'] += 1
+                stop.wait(idle_sleep)
+                continue
+            for error in outcome['errors']:
+                print(json.dumps({'transfer_worker_error': error}))
+            totals['errors'] += len(outcome['errors'])
+            if not outcome['processed'] and not outcome['errors']:
+                if exit_when_empty:
+                    break
+                stop.wait(idle_sleep)
+                continue
+            totals['batches'] += 1
+            for field in ('processed', 'completed', 'failed'):
+                totals[field] += outcome[field]
+            if LOG_STATS:
+                print(json.dumps({'transfer_worker': {**totals, 'batch': outcome['processed']}}))
+    finally:
+        db.release(dsn, conn)
+    return totals
+
+
+def main() -> None:
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        raise SystemExit('DATABASE_URL is not set')
+    while True:
+        try:
+            run(dsn)
+        except Exception as e:
+            print(json.dumps({'transfer_worker_error': str(e)}))
+            time.sleep(IDLE_SLEEP)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+'''
+Business: Card-to-card transfer engine backed by the transfer_funds() SQL function
+Transfers can also be queued (TRANSFER_ASYNC=1 or "async": true in the
+request): enqueue_transfer() only records a pending outgoing transaction and
+a transfer_queue row, and transfer_worker.py applies queued transfers in
+batches with drain_queue(), one commit per batch. A job whose transactions
+row is gone (archived) or that keeps breaking its batch is failed and
+dequeued instead of being retried for ever.
+'''
+import os
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, List, Optional, Tuple
+
+import recipients
+
+CENT = Decimal('0.01')
+MAX_AMOUNT = Decimal('9999999999999.99')
+MAX_BATCH_ITEMS = 10000
+ASYNC_DEFAULT = os.environ.get('TRANSFER_ASYNC') == '1'
+QUEUE_BATCH_SIZE = int(os.environ.get('TRANSFER_QUEUE_BATCH_SIZE', '500'))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get('TRANSFER_QUEUE_MAX_ATTEMPTS', '5'))
+
+RESULT_ERRORS: Dict[str, Any] = {
+    'invalid_amount': (400, 'Invalid transfer data'),
+    'same_card': (400, 'Invalid transfer data'),
+    'invalid_card': (400, 'Insufficient funds or invalid card'),
+    'insufficient_funds': (400, 'Insufficient funds or invalid card'),
+    'recipient_not_found': (404, 'Recipient not found'),
+}
+
+
+def parse_amount(raw: Any) -> Optional[Decimal]:
+    '''
+    Business: Convert a client-supplied amount to Decimal with kopeck precision
+    Args: raw - amount from the request body (string or number)
+    Returns: positive Decimal with two fraction digits, or None if invalid
+    '''
+    if raw is None or isinstance(raw, bool):
+        return None
+    try:
+        amount = Decimal(str(raw))
+    except (InvalidOperation, ValueError):
+        return None
+    if not amount.is_finite() or amount <= 0 or amount > MAX_AMOUNT:
+        return None
+    if amount != amount.quantize(CENT):
+        return None
+    return amount.quantize(CENT)
+
+
+def execute_transfer(cursor: Any, user_id: Any, from_card_id: Any, to_card_id: Any,
+                     amount: Decimal, recipient: str) -> Dict[str, Any]:
+    '''
+    Business: Move money between two cards in a single database round trip
+    Args: cursor - open cursor; the caller commits on success
+          user_id - owner of the source card
+          from_card_id, to_card_id - card ids, locked in id order by the database
+          amount - Decimal amount already validated by parse_amount
+          recipient - label stored on the outgoing transaction
+    Returns: dict with result code, new sender balance and transaction ids
+    '''
+    cursor.execute(
+        "SELECT result, from_balance, outgoing_id, incoming_id FROM transfer_funds(%s, %s, %s, %s, %s)",
+        (user_id, from_card_id, to_card_id, amount, recipient)
+    )
+    row = cursor.fetchone()
+    if isinstance(row, dict):
+        return dict(row)
+    return {
+        'result': row[0],
+        'from_balance': row[1],
+        'outgoing_id': row[2],
+        'incoming_id': row[3],
+    }
+
+
+def execute_batch(conn: Any, user_id: Any, from_card_id: Any, items: List[Dict[str, Any]],
+                  atomic: bool = False) -> Dict[str, Any]:
+    '''
+    Business: Pay many recipients from one card with set-based statements
+    Args: conn - open connection; the caller commits when 'applied' is true
+          user_id - owner of the source card
+          from_card_id - card that is debited
+          items - list of {'to_identifier', 'amount'} dicts
+          atomic - reject the whole batch if any item fails
+    Returns: dict with 'error' for batch-level failures, or per-item 'results',
+             'completed' / 'failed' counts, 'total_amount' and 'applied';
+             applied batches also carry the touched 'user_ids'
+    '''
+    results: List[Dict[str, Any]] = []
+    parsed: List[Optional[Tuple[str, str, Decimal]]] = []
+    for index, item in enumerate(items):
+        raw_identifier = item.get('to_identifier') if isinstance(item, dict) else None
+        amount = parse_amount(item.get('amount')) if isinstance(item, dict) else None
+        result: Dict[str, Any] = {
+            'index': index,
+            'to_identifier': raw_identifier,
+            'amount': str(amount) if amount is not None else None,
+            'status': 'failed',
+        }
+        identifier = recipients.normalize(raw_identifier)
+        if not isinstance(raw_identifier, str) or not raw_identifier or amount is None:
+            result['error'] = 'Invalid transfer data'
+            parsed.append(None)
+        elif identifier is None:
+            result['error'] = 'Recipient not found'
+            parsed.append(None)
+        else:
+            parsed.append((raw_identifier, identifier, amount))
+        results.append(result)
+
+    resolved = recipients.resolve_many(conn, [entry[1] for entry in parsed if entry])
+
+    with conn.cursor() as cursor:
+        card_ids = {int(from_card_id)} | {recipient.card_id for recipient in resolved.values()}
+        cursor.execute(
+            # a deleted card (is_active = FALSE) neither sends nor receives
+            """SELECT id, user_id, CASE WHEN is_active THEN status ELSE 'deleted' END, balance, masked_number
+               FROM cards
+               WHERE id = ANY(%s)
+               ORDER BY id
+               FOR UPDATE""",
+            (sorted(card_ids),)
+        )
+        locked = {row[0]: row for row in cursor.fetchall()}
+
+        sender = locked.get(int(from_card_id))
+        if not sender or str(sender[1]) != str(user_id) or sender[2] != 'active':
+            return {'error': 'Insufficient funds or invalid card', 'applied': False}
+
+        balance: Decimal = sender[3]
+        rows: List[Tuple[int, int, str, Decimal, str]] = []
+        for result, entry in zip(results, parsed):
+            if entry is None:
+                continue
+            raw_identifier, identifier, amount = entry
+            recipient = resolved.get(identifier)
+            if recipient is None or locked.get(recipient.card_id, (None, None, None))[2] != 'active':
+                if recipient is not None:
+                    recipients.forget(identifier)
+                result['error'] = 'Recipient not found'
+                continue
+            to_card_id, to_user_id = recipient.card_id, recipient.user_id
+            if to_card_id == sender[0]:
+                result['error'] = 'Invalid transfer data'
+                continue
+            if balance < amount:
+                result['error'] = 'Insufficient funds or invalid card'
+                continue
+            balance -= amount
+            rows.append((sender[0], sender[1], 'outgoing', amount, raw_identifier))
+            rows.append((to_card_id, to_user_id, 'incoming', amount, sender[4]))
+            result['status'] = 'completed'
+            result.pop('error', None)
+
+        completed = sum(1 for result in results if result['status'] == 'completed')
+        failed = len(results) - completed
+        total = sender[3] - balance
+        summary = {
+            'results': results,
+            'completed': completed,
+            'failed': failed,
+            'total_amount': str(total),
+            'applied': False,
+        }
+        if atomic and failed:
+            for result in results:
+                if result['status'] == 'completed':
+                    result['status'] = 'rolled_back'
+            summary['completed'] = 0
+            return summary
+        if not rows:
+            return summary
+
+        cursor.execute(
+            """WITH src AS (
+                   SELECT nextval(pg_get_serial_sequence('transactions', 'id')) AS id, r.*
+                   FROM unnest(%s::int[], %s::int[], %s::varchar[], %s::numeric[], %s::varchar[])
+                        WITH ORDINALITY AS r(card_id, user_id, transaction_type, amount, recipient, ord)
+               ), ins AS (
+                   INSERT INTO transactions (id, card_id, user_id, transaction_type, amount, recipient, status)
+                   SELECT id, card_id, user_id, transaction_type, amount, recipient, 'completed' FROM src
+               )
+               SELECT id FROM src ORDER BY ord""",
+            tuple(list(column) for column in zip(*rows))
+        )
+        transaction_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            """SELECT ledger_apply(%s::int[], %s::int[], %s::numeric[], 'transfer', %s::int[]),
+                      card_stats_apply(%s::int[], %s::int[], %s::varchar[], %s::numeric[], %s::varchar[])""",
+            (
+                [index // 2 for index in range(len(rows))],
+                [row[0] for row in rows],
+                [-row[3] if row[2] == 'outgoing' else row[3] for row in rows],
+                transaction_ids,
+                *(list(column) for column in zip(*rows)),
+            )
+        )
+        summary['applied'] = True
+        summary['from_balance'] = str(balance)
+        summary['user_ids'] = sorted({row[1] for row in rows})
+        return summary
+
+
+def enqueue_transfer(cursor: Any, user_id: Any, from_card_id: Any, to_card_id: int,
+                     amount: Decimal, recipient: str) -> Optional[int]:
+    '''
+    Business: Queue a transfer for transfer_worker.py instead of moving money now
+    Takes no card locks, so transfers to a busy merchant card do not queue up
+    behind each other here. Funds are checked when the worker applies it.
+    Args: cursor - open cursor; the caller commits
+          user_id - owner of the source card
+          from_card_id, to_card_id - card ids
+          amount - Decimal amount already validated by parse_amount
+          recipient - label stored on the outgoing transaction
+    Returns: id of the pending outgoing transaction, or None if the source
+             card is not an active card of the user
+    '''
+    cursor.execute(
+        """WITH sender AS (
+               SELECT id FROM cards WHERE id = %s AND user_id = %s AND status = 'active' AND is_active
+           ), tx AS (
+               INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+               SELECT id, %s, 'outgoing', %s, %s, 'pending' FROM sender
+               RETURNING id
+           ), queued AS (
+               INSERT INTO transfer_queue (transaction_id, user_id, from_card_id, to_card_id, amount)
+               SELECT id, %s, %s, %s, %s FROM tx
+           )
+           SELECT id FROM tx""",
+        (from_card_id, user_id, user_id, amount, recipient, user_id, from_card_id, to_card_id, amount)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row['id'] if isinstance(row, dict) else row[0]
+
+
+def drain_queue(conn: Any, limit: int = QUEUE_BATCH_SIZE) -> Dict[str, Any]:
+    '''
+    Business: Apply up to limit queued transfers in one transaction
+    Claims the oldest queue rows with SKIP LOCKED, so several workers can
+    drain in parallel, and locks every card involved once, in id order.
+    Transfers are checked in queue order against running balances; all
+    completed ones go through a single ledger_apply(), which folds the
+    credits to each card (e.g. a merchant paid many times in the batch) into
+    one balance UPDATE per card.
+    Every claimed job's attempts are counted before it is applied, outside
+    the savepoint it is applied under. The jobs never attempted before are
+    applied together; each job that was (its batch broke) is retried under
+    its own savepoint, so one bad job cannot keep failing its neighbours, and
+    after QUEUE_MAX_ATTEMPTS it fails as 'too_many_attempts'. A group that
+    raises is rolled back to its savepoint and stays queued; its error is
+    reported in 'errors'. A job whose transactions row is missing fails as
+    'transaction_missing'.
+    Args: conn - open connection; the caller commits
+          limit - maximum transfers to take from the queue
+    Returns: dict with 'processed', 'completed', 'failed' counts, the
+             'user_ids' whose balances or transactions changed and the
+             'errors' of the groups that were rolled back
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT q.id, q.transaction_id, q.user_id, q.from_card_id, q.to_card_id, q.amount, q.enqueued_at,
+                      t.recipient, q.attempts, t.id IS NOT NULL
+               FROM transfer_queue q
+               LEFT JOIN transactions t ON t.id = q.transaction_id
+                    -- inserted together with the queue row; the bound prunes partitions
+                    AND t.created_at >= q.enqueued_at::timestamp - INTERVAL '1 day'
+               ORDER BY q.id
+               LIMIT %s
+               FOR UPDATE OF q SKIP LOCKED""",
+            (limit,)
+        )
+        jobs = cursor.fetchall()
+        outcome: Dict[str, Any] = {'processed': 0, 'completed': 0, 'failed': 0, 'user_ids': [], 'errors': []}
+        if not jobs:
+            return outcome
+        cursor.execute('UPDATE transfer_queue SET attempts = attempts + 1 WHERE id = ANY(%s)',
+                       ([job[0] for job in jobs],))
+        fresh = [job for job in jobs if not job[8]]
+        groups = ([fresh] if fresh else []) + [[job] for job in jobs if job[8]]
+        user_ids = set()
+        for group in groups:
+            cursor.execute('SAVEPOINT drain')
+            try:
+                applied = _apply_jobs(cursor, group)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO SAVEPOINT drain')
+                cursor.execute('RELEASE SAVEPOINT drain')
+                outcome['errors'].append(str(e))
+                continue
+            cursor.execute('RELEASE SAVEPOINT drain')
+            for field in ('processed', 'completed', 'failed'):
+                outcome[field] += applied[field]
+            user_ids.update(applied['user_ids'])
+        outcome['user_ids'] = sorted(user_ids)
+        return outcome
+
+
+def _apply_jobs(cursor: Any, jobs: List[Tuple[Any, ...]]) -> Dict[str, Any]:
+    '''
+    Business: Settle claimed queue jobs and dequeue them; see drain_queue()
+    '''
+    cursor.execute(
+        # a deleted card (is_active = FALSE) neither sends nor receives
+        """SELECT id, user_id, CASE WHEN is_active THEN status ELSE 'deleted' END, balance, masked_number
+           FROM cards
+           WHERE id = ANY(%s)
+           ORDER BY id
+           FOR UPDATE""",
+        (sorted({job[3] for job in jobs} | {job[4] for job in jobs}),)
+    )
+    locked = {row[0]: row for row in cursor.fetchall()}
+    balances = {card_id: row[3] for card_id, row in locked.items()}
+
+    outcomes: List[Tuple[int, str, Optional[str]]] = []
+    completed: List[Tuple[int, int, int, int, Decimal, str, int, str, Any]] = []
+    for _, transaction_id, user_id, from_card_id, to_card_id, amount, enqueued_at, recipient, attempts, found in jobs:
+        sender = locked.get(from_card_id)
+        receiver = locked.get(to_card_id)
+        if not found:
+            reason: Optional[str] = 'transaction_missing'
+        elif attempts >= QUEUE_MAX_ATTEMPTS:
+            reason = 'too_many_attempts'
+        elif not sender or sender[1] != user_id or sender[2] != 'active':
+            reason = 'invalid_card'
+        elif not receiver or receiver[2] != 'active':
+            reason = 'recipient_not_found'
+        elif balances[from_card_id] < amount:
+            reason = 'insufficient_funds'
+        else:
+            reason = None
+            balances[from_card_id] -= amount
+            balances[to_card_id] += amount
+            completed.append((transaction_id, from_card_id, to_card_id, receiver[1], amount, sender[4],
+                              user_id, recipient, enqueued_at))
+        outcomes.append((transaction_id, 'failed' if reason else 'completed', reason))
+
+    cursor.execute(
+        """WITH settled AS (
+               UPDATE transactions t
+               SET status = o.status, failure_reason = o.reason
+               FROM unnest(%s::int[], %s::varchar[], %s::varchar[]) AS o(id, status, reason)
+               WHERE t.id = o.id
+                 -- the pending row was inserted with its queue row; the bound prunes partitions
+                 AND t.created_at >= %s::timestamptz::timestamp - INTERVAL '1 day'
+           ), dequeued AS (
+               DELETE FROM transfer_queue WHERE id = ANY(%s)
+           ), src AS (
+               SELECT nextval(pg_get_serial_sequence('transactions', 'id')) AS id, r.*
+               FROM unnest(%s::int[], %s::int[], %s::numeric[], %s::varchar[])
+                    WITH ORDINALITY AS r(card_id, user_id, amount, recipient, ord)
+           ), ins AS (
+               INSERT INTO transactions (id, card_id, user_id, transaction_type, amount, recipient, status)
+               SELECT id, card_id, user_id, 'incoming', amount, recipient, 'completed' FROM src
+           )
+           SELECT id FROM src ORDER BY ord""",
+        (
+            [outcome[0] for outcome in outcomes],
+            [outcome[1] for outcome in outcomes],
+            [outcome[2] for outcome in outcomes],
+            min(job[6] for job in jobs),
+            [job[0] for job in jobs],
+            [transfer[2] for transfer in completed],
+            [transfer[3] for transfer in completed],
+            [transfer[4] for transfer in completed],
+            [transfer[5] for transfer in completed],
+        )
+    )
+    incoming_ids = [row[0] for row in cursor.fetchall()]
+    if completed:
+        cursor.execute(
+            """SELECT ledger_apply(%s::int[], %s::int[], %s::numeric[], 'transfer', %s::int[]),
+                      card_stats_apply(%s::int[], %s::int[], %s::varchar[], %s::numeric[], %s::varchar[],
+                                       %s::timestamptz[]::date[])""",
+            (
+                [index // 2 for index in range(2 * len(completed))],
+                [card_id for transfer in completed for card_id in transfer[1:3]],
+                [amount for transfer in completed for amount in (-transfer[4], transfer[4])],
+                [transaction_id for transfer, incoming_id in zip(completed, incoming_ids)
+                 for transaction_id in (transfer[0], incoming_id)],
+                [card_id for transfer in completed for card_id in transfer[1:3]],
+                [user_id for transfer in completed for user_id in (transfer[6], transfer[3])],
+                ['outgoing', 'incoming'] * len(completed),
+                [amount for transfer in completed for amount in (transfer[4], transfer[4])],
+                [label for transfer in completed for label in (transfer[7], transfer[5])],
+                # the outgoing row is dated when it was queued, the incoming one now
+                [day for transfer in completed for day in (transfer[8], None)],
+            )
+        )
+
+    return {
+        'processed': len(jobs),
+        'completed': len(completed),
+        'failed': len(jobs) - len(completed),
+        'user_ids': sorted({job[2] for job in jobs} | {transfer[3] for transfer in completed}),
+    }
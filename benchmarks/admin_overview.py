@@ -0,0 +1,215 @@
+'''
+Business: Admin overview from maintained counters versus counting the tables
+Seeds --cards cards (half debit, half credit) and --requests card requests,
+times the overview action against the GROUP BY queries it replaces, then runs
+concurrent traffic that moves the counters (debit-to-credit transfers, card
+status changes, new and approved requests) and checks the counters against
+the tables with admin_counters_check(). Also reports the transfer rate with
+and without the counter triggers, and checks that once every pending request
+is approved check_overview compacts the pending-hours histogram to nothing.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/admin_overview.py --cards 1000000
+'''
+import argparse
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Any, Dict, List
+
+import psycopg2
+
+import common
+
+common.use_function('admin')
+
+NAIVE_SQL = (
+    """SELECT status, card_category, is_active, COUNT(*), SUM(balance) FROM cards
+       GROUP BY status, card_category, is_active""",
+    "SELECT status, card_category, COUNT(*) FROM card_requests GROUP BY status, card_category",
+    """SELECT percentile_cont(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (ORDER BY LOCALTIMESTAMP - created_at)
+       FROM card_requests WHERE status = 'pending'""",
+    "SELECT is_admin, COUNT(*) FROM users GROUP BY is_admin",
+)
+
+
+def seed(dsn: str, args: argparse.Namespace) -> None:
+    common.seed_cards(dsn, args.cards, Decimal('1000.00'))
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute("UPDATE cards SET card_category = 'credit' WHERE id % 2 = 0")
+        cursor.execute(
+            """INSERT INTO card_requests (user_id, card_category, status, created_at)
+               SELECT g %% %s + 1, CASE WHEN g %% 2 = 0 THEN 'debit' ELSE 'credit' END,
+                      CASE WHEN g %% 10 = 0 THEN 'pending' ELSE 'approved' END,
+                      LOCALTIMESTAMP - (g %% 720) * INTERVAL '1 hour'
+               FROM generate_series(1, %s) g""",
+            (args.cards, args.requests)
+        )
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('VACUUM ANALYZE cards, card_requests, users')
+    conn.close()
+
+
+def best_ms(fn: Any, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def transfers_per_s(dsn: str, args: argparse.Namespace) -> float:
+    import psycopg2.pool
+    pool = psycopg2.pool.ThreadedConnectionPool(args.concurrency, args.concurrency, dsn)
+    rng = random.Random(7)
+    plan = [(rng.randrange(1, args.cards, 2), rng.randrange(2, args.cards, 2)) for _ in range(args.transfers)]
+
+    def send(pair: Any) -> None:
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT result FROM transfer_funds(%s, %s, %s, 1.00, %s)',
+                               (pair[0], pair[0], pair[1], 'bench'))
+            conn.commit()
+        finally:
+            pool.putconn(conn)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(send, plan))
+    elapsed = time.perf_counter() - started
+    pool.closeall()
+    return len(plan) / elapsed
+
+
+def churn(dsn: str, args: argparse.Namespace, stop: threading.Event, errors: List[str]) -> None:
+    conn = psycopg2.connect(dsn)
+    rng = random.Random(threading.get_ident())
+    try:
+        while not stop.is_set():
+            card_id = rng.randrange(1, args.cards + 1)
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "UPDATE cards SET status = %s WHERE id = %s",
+                    (rng.choice(('active', 'blocked', 'frozen')), card_id)
+                )
+                cursor.execute(
+                    "INSERT INTO card_requests (user_id, card_category) VALUES (%s, %s)",
+                    (card_id, rng.choice(('debit', 'credit')))
+                )
+                cursor.execute(
+                    """UPDATE card_requests SET status = 'approved', processed_at = LOCALTIMESTAMP
+                       WHERE id = (SELECT id FROM card_requests WHERE status = 'pending'
+                                   ORDER BY id DESC LIMIT 1 FOR UPDATE SKIP LOCKED)"""
+                )
+            conn.commit()
+    except psycopg2.Error as e:
+        errors.append(str(e))
+    finally:
+        conn.close()
+
+
+def approve_all(dsn: str, args: argparse.Namespace) -> None:
+    # several sessions, so the -1s land in other slots than the +1s of the inserts
+    def approve(part: int) -> None:
+        conn = psycopg2.connect(dsn)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """UPDATE card_requests SET status = 'approved', processed_at = LOCALTIMESTAMP
+                   WHERE status = 'pending' AND id %% %s = %s""",
+                (args.concurrency, part)
+            )
+        conn.commit()
+        conn.close()
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(approve, range(args.concurrency)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cards', type=int, default=1_000_000)
+    parser.add_argument('--requests', type=int, default=200_000)
+    parser.add_argument('--transfers', type=int, default=3000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    common.prepare_database(dsn)
+    seed(dsn, args)
+
+    import index
+    event = common.make_event('GET', headers={'X-Is-Admin': 'true'}, query={'action': 'overview'})
+    conn = psycopg2.connect(dsn)
+
+    def naive() -> None:
+        with conn.cursor() as cursor:
+            for sql in NAIVE_SQL:
+                cursor.execute(sql)
+                cursor.fetchall()
+        conn.rollback()
+
+    overview_ms = best_ms(lambda: index.handler(event, common.Context()), args.repeat)
+    naive_ms = best_ms(naive, args.repeat)
+
+    with conn.cursor() as cursor:
+        cursor.execute('ALTER TABLE cards DISABLE TRIGGER USER')
+        conn.commit()
+        without_triggers = transfers_per_s(dsn, args)
+        # the untracked transfers moved balances between categories
+        cursor.execute('ALTER TABLE cards ENABLE TRIGGER USER')
+        cursor.execute('SELECT admin_counters_rebuild()')
+        conn.commit()
+    with_triggers = transfers_per_s(dsn, args)
+    stop = threading.Event()
+    errors: List[str] = []
+    churners = [threading.Thread(target=churn, args=(dsn, args, stop, errors)) for _ in range(args.concurrency // 2)]
+    for thread in churners:
+        thread.start()
+    under_churn = transfers_per_s(dsn, args)
+    stop.set()
+    for thread in churners:
+        thread.join()
+
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM admin_counters_check()')
+        mismatches = cursor.fetchone()[0]
+        conn.rollback()
+
+        approve_all(dsn, args)
+        check = common.make_event('POST', {'action': 'check_overview'}, {'X-Is-Admin': 'true'})
+        if index.handler(check, common.Context())['statusCode'] != 200:
+            raise SystemExit('check_overview failed')
+        cursor.execute('SELECT COUNT(*) FROM card_requests_pending_hours')
+        hour_rows = cursor.fetchone()[0]
+    conn.close()
+
+    row: Dict[str, Any] = {
+        'cards': args.cards,
+        'requests': args.requests,
+        'overview_ms': overview_ms,
+        'naive_ms': naive_ms,
+        'no_triggers_per_s': without_triggers,
+        'transfers_per_s': with_triggers,
+        'with_churn_per_s': under_churn,
+        'mismatches': mismatches,
+        'hour_rows': hour_rows,
+        'errors': len(errors),
+    }
+    common.print_table([row])
+    if mismatches or errors:
+        raise SystemExit('counters drifted from the tables' if mismatches else errors[0])
+    if hour_rows:
+        raise SystemExit(f'{hour_rows} pending-hours rows left with no pending requests')
+
+
+if __name__ == '__main__':
+    main()
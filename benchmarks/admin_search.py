@@ -0,0 +1,155 @@
+'''
+Business: Latency of the admin search action on a large user base
+Seeds --users users (1M by default) with generated Russian names, emails and
+phones, one card each (every other number stored with spaces) and a pending
+card request for every tenth user, then times the search action for typical
+admin lookups (exact login, email, phone digits with and without
+separators, name prefixes, card last four digits, full card numbers and a
+misspelt surname) against an unindexed ILIKE scan over the same columns,
+the way the users listing would have to be searched. Checks how the top hit
+of every lookup matched and exits with status 1 when one differs.
+Misspellings only match (and are only checked) where the server has
+pg_trgm.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/admin_search.py --users 1000000
+'''
+import argparse
+import json
+import os
+import time
+from decimal import Decimal
+from typing import Any, Dict, List
+
+import psycopg2
+
+import common
+
+common.use_function('admin')
+
+FIRST_NAMES = ['Алексей', 'Мария', 'Иван', 'Ольга', 'Дмитрий', 'Анна', 'Сергей', 'Елена', 'Павел', 'Наталья',
+               'Андрей', 'Татьяна', 'Михаил', 'Юлия', 'Николай', 'Светлана', 'Артём', 'Ксения', 'Егор', 'Алёна']
+LAST_NAMES = ['Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов',
+              'Новиков', 'Фёдоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов', 'Егоров',
+              'Павлов', 'Козлов', 'Степанов', 'Николаев', 'Орлов', 'Андреев', 'Макаров', 'Никитин',
+              'Захаров', 'Зайцев', 'Соловьёв', 'Борисов', 'Яковлев', 'Григорьев', 'Романов', 'Воробьёв']
+
+NAIVE_SQL = """SELECT id FROM users
+               WHERE username ILIKE %(pattern)s OR email ILIKE %(pattern)s OR first_name ILIKE %(pattern)s
+                  OR last_name ILIKE %(pattern)s OR phone ILIKE %(pattern)s
+                  OR id IN (SELECT user_id FROM cards WHERE card_number LIKE %(pattern)s)
+               ORDER BY id
+               LIMIT 20"""
+
+
+def seed(dsn: str, users: int) -> None:
+    common.seed_cards(dsn, users, Decimal('100.00'))
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """UPDATE users SET
+                   first_name = (%(first)s::TEXT[])[id %% array_length(%(first)s::TEXT[], 1) + 1],
+                   last_name = (%(last)s::TEXT[])[(id / 7) %% array_length(%(last)s::TEXT[], 1) + 1]
+                               || CASE WHEN id %% 2 = 0 THEN 'а' ELSE '' END,
+                   email = 'client' || id || '.' || (id %% 97) || '@mail' || (id %% 5) || '.example'""",
+            {'first': FIRST_NAMES, 'last': LAST_NAMES}
+        )
+        cursor.execute(
+            """INSERT INTO card_requests (user_id, card_category)
+               SELECT id, 'credit' FROM users WHERE id % 10 = 0"""
+        )
+        # numbers entered by hand before normalization: '4000 0000 0000 0001'
+        cursor.execute(
+            """UPDATE cards SET card_number = regexp_replace(card_number, '(\\d{4})(?=\\d)', '\\1 ', 'g')
+               WHERE id % 2 = 1"""
+        )
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('VACUUM ANALYZE users, cards, card_requests')
+    conn.close()
+
+
+def has_trigrams(dsn: str) -> bool:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+        installed = cursor.fetchone()[0]
+    conn.close()
+    return installed
+
+
+def timings(fn: Any, repeat: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    stats = common.percentiles(samples)
+    return {'p50': stats['p50'], 'p95': stats['p95']}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--naive-repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    common.prepare_database(dsn)
+    seed(dsn, args.users)
+
+    import index
+    some = args.users // 2 + 1
+    odd, even = some | 1, (some | 1) + 1
+    spaced = ' '.join(common.card_number(even)[i:i + 4] for i in range(0, 16, 4))
+    trigrams = has_trigrams(dsn)
+    # (label, query, ILIKE pattern, how the top hit must match)
+    queries = [
+        ('login', f'bench{some}', f'bench{some}', 'exact'),
+        ('email', f'client{some}.{some % 97}@mail{some % 5}.example', f'client{some}.%', 'exact'),
+        ('phone digits', f'900{str(some).zfill(7)[:4]}', f'%900{str(some).zfill(7)[:4]}%', 'prefix'),
+        ('phone, spaced', f'+7 900 {str(some).zfill(7)[:3]}', f'%900{str(some).zfill(7)[:3]}%', 'prefix'),
+        ('surname prefix', 'Иванов', '%Иванов%', 'prefix'),
+        ('first + last', 'мария смирн', '%Смирн%', 'prefix'),
+        ('card last 4', str(some).zfill(4)[-4:], '%' + str(some).zfill(4)[-4:], 'card_last4'),
+        ('card number, stored spaced', common.card_number(odd), common.card_number(odd), 'card_number'),
+        ('card number, typed spaced', spaced, common.card_number(even), 'card_number'),
+        ('misspelt surname', 'Кузницов', '%Кузницов%', 'similar' if trigrams else '-'),
+    ]
+
+    conn = psycopg2.connect(dsn)
+    rows: List[Dict[str, Any]] = []
+    for label, text, pattern, expected in queries:
+        event = common.make_event('GET', headers={'X-Is-Admin': 'true'}, query={'action': 'search', 'q': text})
+        response = index.handler(event, common.Context())
+        results = json.loads(response['body'])['results'] if response['statusCode'] == 200 else []
+
+        def naive() -> None:
+            with conn.cursor() as cursor:
+                cursor.execute(NAIVE_SQL, {'pattern': pattern})
+                cursor.fetchall()
+            conn.rollback()
+
+        search = timings(lambda: index.handler(event, common.Context()), args.repeat)
+        rows.append({
+            'query': label,
+            'status': response['statusCode'],
+            'hits': len(results),
+            'top_match': results[0]['matched'] if results else '-',
+            'expected': expected,
+            'search_p50_ms': search['p50'],
+            'search_p95_ms': search['p95'],
+            'ilike_p50_ms': timings(naive, args.naive_repeat)['p50'],
+        })
+    conn.close()
+    common.print_table(rows)
+    print('fuzzy matching:', 'pg_trgm' if trigrams else 'off (pg_trgm not installed)')
+    wrong = [row['query'] for row in rows if row['top_match'] != row['expected']]
+    if wrong:
+        raise SystemExit(f'unexpected top match for: {", ".join(wrong)}')
+
+
+if __name__ == '__main__':
+    main()
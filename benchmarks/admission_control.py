@@ -0,0 +1,197 @@
+'''
+Business: Admission control under a login brute-force and a transfer burst
+Two phases against the auth and cards handlers, with the shared tier on its
+in-process stand-in (ADMISSION_BACKEND=memory):
+- login: one client hammers a single account with wrong passwords from one
+  IP, another from a different IP on every attempt, while legitimate users
+  log in from their own addresses. Reports how many attempts each side got
+  through, how fast the attacker is turned away and that legitimate logins
+  are unaffected.
+- burst: --burst-threads clients fire transfers at once, spread over
+  --containers independently imported copies of the cards function (each
+  with its own pool of DB_POOL_MAX_SIZE connections) that share one
+  stand-in store, with the gate on (--global-inflight actions at a time
+  across containers) and off. Without it every container fills its pool and
+  the excess queues for a connection; with it the excess gets 429 at once.
+  Reports status codes, latency and the peak number of busy connections
+  Postgres saw.
+Also prints the gate counters. Exits with status 1 when the attacker got past
+the account limit or a legitimate login was refused.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/admission_control.py --seconds 5
+'''
+import argparse
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Any, Dict, List, Tuple
+
+import psycopg2
+
+import common
+
+os.environ['ADMISSION_LIMITS'] = ''
+os.environ['ADMISSION_BACKEND'] = 'memory'
+os.environ.setdefault('DB_POOL_MAX_SIZE', '4')
+os.environ.setdefault('PASSWORD_SCRYPT_N', '16384')
+
+
+def load(function: str) -> Any:
+    common.use_function(function)
+    import index
+    return index
+
+
+def login_event(username: str, password: str, ip: str) -> Dict[str, Any]:
+    event = common.make_event('POST', {'action': 'login', 'username': username, 'password': password})
+    event['requestContext'] = {'identity': {'sourceIp': ip}}
+    return event
+
+
+def login_phase(auth: Any, args: argparse.Namespace) -> Tuple[List[Dict[str, Any]], bool]:
+    stop = threading.Event()
+    results: Dict[str, List[Tuple[int, float]]] = {'attacker, one IP': [], 'attacker, rotating IPs': [],
+                                                   'legitimate': []}
+
+    def attacker(client: str) -> None:
+        attempt = 0
+        while not stop.is_set():
+            attempt += 1
+            ip = f'10.2.{attempt // 250 % 250}.{attempt % 250}' if 'rotating' in client else '10.0.0.1'
+            started = time.perf_counter()
+            response = auth.handler(login_event('bench1', 'guess', ip), common.Context())
+            results[client].append((response['statusCode'], time.perf_counter() - started))
+
+    def legitimate(slot: int) -> None:
+        user = slot + 2
+        while not stop.is_set():
+            started = time.perf_counter()
+            response = auth.handler(login_event(f'bench{user}', 'x', f'10.1.0.{slot}'), common.Context())
+            results['legitimate'].append((response['statusCode'], time.perf_counter() - started))
+            stop.wait(args.legit_interval)
+
+    threads = [threading.Thread(target=attacker, args=(client,)) for client in results if 'attacker' in client]
+    threads += [threading.Thread(target=legitimate, args=(slot,)) for slot in range(args.legit_users)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    rows = []
+    for client, samples in results.items():
+        statuses = Counter(status for status, _ in samples)
+        refused = [elapsed * 1000 for status, elapsed in samples if status == 429]
+        rows.append({
+            'client': client,
+            'attempts': len(samples),
+            'per_s': len(samples) / args.seconds,
+            'statuses': ','.join(f'{status}x{count}' for status, count in sorted(statuses.items())),
+            'refused_p50_ms': common.percentiles(refused)['p50'],
+        })
+    attacker_through = sum(
+        1 for client, samples in results.items() if 'attacker' in client for status, _ in samples if status != 429
+    )
+    # the account bucket: its burst plus what refills over the run
+    allowed = 10 + 0.1 * args.seconds + 1
+    ok = attacker_through <= allowed and all(status == 200 for status, _ in results['legitimate'])
+    return rows, ok
+
+
+def peak_connections(dsn: str, stop: threading.Event, peak: List[int]) -> None:
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        while not stop.is_set():
+            cursor.execute(
+                "SELECT COUNT(*) FROM pg_stat_activity WHERE datname = current_database() AND state <> 'idle' "
+                "AND pid <> pg_backend_pid()"
+            )
+            peak[0] = max(peak[0], cursor.fetchone()[0])
+            stop.wait(0.005)
+    conn.close()
+
+
+def burst_phase(containers: List[Any], dsn: str, args: argparse.Namespace, gated: bool) -> Dict[str, Any]:
+    shared = containers[0].admission.MemoryStore()
+    for cards in containers:
+        if gated:
+            cards.admission.gate = cards.admission.Admission(shared=shared, global_inflight=args.global_inflight)
+        else:
+            cards.admission.gate = cards.admission.Admission(max_inflight=1 << 20)
+
+    def send(slot: int) -> Tuple[int, float]:
+        cards = containers[slot % len(containers)]
+        user = slot % args.users + 1
+        other = user % args.users + 1
+        body = {'action': 'transfer', 'from_card_id': user, 'to_identifier': common.card_number(other),
+                'amount': '1.00'}
+        event = common.make_event('POST', body, {'X-User-Id': str(user)})
+        started = time.perf_counter()
+        try:
+            status = cards.handler(event, common.Context())['statusCode']
+        except Exception:
+            status = 500
+        return status, time.perf_counter() - started
+
+    stop = threading.Event()
+    peak = [0]
+    sampler = threading.Thread(target=peak_connections, args=(dsn, stop, peak))
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.burst_threads) as executor:
+        samples = list(executor.map(send, range(args.burst)))
+    wall = time.perf_counter() - started
+    stop.set()
+    sampler.join()
+
+    statuses = Counter(status for status, _ in samples)
+    served = [elapsed * 1000 for status, elapsed in samples if status == 200]
+    everything = common.percentiles([elapsed * 1000 for _, elapsed in samples])
+    return {
+        'gate': 'on' if gated else 'off',
+        'requests': len(samples),
+        'statuses': ','.join(f'{status}x{count}' for status, count in sorted(statuses.items())),
+        'served_per_s': len(served) / wall,
+        'served_p95_ms': common.percentiles(served)['p95'],
+        'all_p99_ms': everything['p99'],
+        'peak_db_conns': peak[0],
+        'rejected_concurrency': sum(cards.admission.gate.stats['rejected_concurrency'] for cards in containers),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--legit-users', type=int, default=4)
+    parser.add_argument('--legit-interval', type=float, default=0.5)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--burst', type=int, default=2000)
+    parser.add_argument('--burst-threads', type=int, default=32)
+    parser.add_argument('--containers', type=int, default=4)
+    parser.add_argument('--global-inflight', type=int, default=8)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    common.prepare_database(dsn)
+    common.seed_cards(dsn, args.users, Decimal('1000000'))
+
+    auth = load('auth')
+    login_rows, ok = login_phase(auth, args)
+    common.print_table(login_rows)
+    print('gate counters:', auth.admission.gate.snapshot())
+
+    containers = [load('cards') for _ in range(args.containers)]
+    common.print_table([burst_phase(containers, dsn, args, gated) for gated in (False, True)])
+
+    if not ok:
+        raise SystemExit('attacker got past the account limit or a legitimate login was refused')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Business: Compare approving N card requests one by one with one bulk process_requests call
+Both paths go through the admin handler with server-generated card numbers.
+Afterwards every issued number is checked for Luhn validity and uniqueness.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/card_issuance.py --requests 2000
+'''
+import argparse
+import os
+import time
+from decimal import Decimal
+
+import psycopg2
+
+import common
+
+common.use_function('admin')
+import index  # noqa: E402
+import issuance  # noqa: E402
+
+HEADERS = {'X-Is-Admin': 'true'}
+
+
+def seed_requests(dsn: str, users: int, requests: int) -> None:
+    common.seed_cards(dsn, users, Decimal('0'))
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """INSERT INTO card_requests (user_id, card_category, status)
+               SELECT 1 + g %% %s, CASE WHEN g %% 3 = 0 THEN 'credit' ELSE 'debit' END, 'pending'
+               FROM generate_series(1, %s) g""",
+            (users, requests)
+        )
+    conn.commit()
+    conn.close()
+
+
+def check(dsn: str, expected_cards: int) -> bool:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT card_number FROM cards')
+        numbers = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT COUNT(*) FROM card_requests WHERE status <> 'approved'")
+        left = cursor.fetchone()[0]
+    conn.close()
+    issued = [number for number in numbers if not number.startswith('4000')]
+    return (left == 0 and len(issued) == expected_cards and len(set(numbers)) == len(numbers)
+            and all(issuance.is_luhn_valid(number) for number in issued))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=500)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    common.prepare_database(dsn)
+    rows = []
+
+    seed_requests(dsn, args.users, args.requests)
+    started = time.perf_counter()
+    failed = 0
+    for request_id in range(1, args.requests + 1):
+        event = common.make_event('POST', {'action': 'approve_card', 'request_id': request_id}, HEADERS)
+        if index.handler(event, common.Context())['statusCode'] != 200:
+            failed += 1
+    elapsed = time.perf_counter() - started
+    rows.append({'mode': 'approve_card x N', 'requests': args.requests, 'failed': failed, 'seconds': elapsed,
+                 'requests_per_s': args.requests / elapsed, 'consistent': check(dsn, args.requests)})
+
+    seed_requests(dsn, args.users, args.requests)
+    started = time.perf_counter()
+    event = common.make_event('POST', {'action': 'process_requests', 'decision': 'approve', 'filter': {}}, HEADERS)
+    response = index.handler(event, common.Context())
+    elapsed = time.perf_counter() - started
+    rows.append({'mode': 'process_requests', 'requests': args.requests,
+                 'failed': 0 if response['statusCode'] == 200 else args.requests, 'seconds': elapsed,
+                 'requests_per_s': args.requests / elapsed, 'consistent': check(dsn, args.requests)})
+
+    common.print_table(rows)
+
+
+if __name__ == '__main__':
+    main()
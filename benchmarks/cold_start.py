@@ -0,0 +1,142 @@
+'''
+Business: Cold-start cost of each cloud function
+Every sample is a fresh interpreter that imports the function's index module
+and serves one event, the way a new container does: a CORS preflight, a
+request rejected by validation, and (with BENCH_DATABASE_URL) one that reads
+the database. Reports the median import time, first-invocation latency and
+whether the psycopg2 driver had to be loaded. --ref measures the backend/ of
+another git revision side by side (e.g. --ref HEAD~1). --importtime prints
+the slowest imports of each index module from python -X importtime.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/cold_start.py --runs 15 --ref HEAD~1
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+from typing import Any, Dict, List, Optional
+
+import common
+
+EVENTS: Dict[str, Dict[str, Dict[str, Any]]] = {
+    'auth': {
+        'preflight': common.make_event('OPTIONS'),
+        'validation': common.make_event('POST', {'action': 'login', 'username': 'bench1'}),
+        'database': common.make_event('POST', {'action': 'login', 'username': 'bench1', 'password': 'x'}),
+    },
+    'cards': {
+        'preflight': common.make_event('OPTIONS'),
+        'validation': common.make_event('POST', {'action': 'transfer'}, {'X-User-Id': '1'}),
+        'database': common.make_event('GET', headers={'X-User-Id': '1'}, query={'action': 'list'}),
+    },
+    'admin': {
+        'preflight': common.make_event('OPTIONS'),
+        'validation': common.make_event('POST', {'action': 'update_card_status', 'card_id': 1, 'status': '?'},
+                                        {'X-Is-Admin': 'true'}),
+        'database': common.make_event('GET', headers={'X-Is-Admin': 'true'}, query={'action': 'users'}),
+    },
+}
+
+CHILD = '''
+import json, sys, time
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+
+class Context:
+    request_id = 'cold-start'
+    function_name = 'cold-start'
+
+response = index.handler(json.loads(sys.argv[1]), Context())
+done = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_call_ms': (done - imported) * 1000,
+    'status': response['statusCode'],
+    'driver_loaded': 'psycopg2' in sys.modules,
+}))
+'''
+
+
+def sample(function_dir: str, event: Dict[str, Any], env: Dict[str, str]) -> Dict[str, Any]:
+    result = subprocess.run([sys.executable, '-c', CHILD, json.dumps(event)], cwd=function_dir, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def importtime(function_dir: str, env: Dict[str, str], top: int) -> List[str]:
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import index'], cwd=function_dir, env=env,
+                            capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    return [f'{cumulative / 1000:8.2f} ms {name}' for cumulative, name in sorted(rows, reverse=True)[:top]]
+
+
+def export_backend(ref: str, target: str) -> str:
+    archive = os.path.join(target, 'backend.tar')
+    with open(archive, 'wb') as out:
+        subprocess.run(['git', 'archive', '--format=tar', ref, 'backend'], cwd=common.ROOT, stdout=out, check=True)
+    with tarfile.open(archive) as tar:
+        tar.extractall(target)
+    return os.path.join(target, 'backend')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=15, help='fresh interpreters per measurement')
+    parser.add_argument('--ref', help='git revision to compare against')
+    parser.add_argument('--importtime', type=int, default=0, metavar='N', help='print the N slowest imports')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.pop('TRACE', None)
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    env.setdefault('PASSWORD_SCRYPT_N', '1024')
+    dsn: Optional[str] = os.environ.get('BENCH_DATABASE_URL')
+    if dsn:
+        common.prepare_database(dsn)
+        common.seed_cards(dsn, 10, 0)
+    env['DATABASE_URL'] = dsn or 'postgresql://unused'
+
+    with tempfile.TemporaryDirectory() as scratch:
+        trees = [('working tree', common.BACKEND_DIR)]
+        if args.ref:
+            trees.append((args.ref, export_backend(args.ref, scratch)))
+
+        table = []
+        for function, events in EVENTS.items():
+            for label, backend_dir in trees:
+                function_dir = os.path.join(backend_dir, function)
+                # warm the OS page cache and the bytecode of the standard library
+                sample(function_dir, events['preflight'], env)
+                for kind, event in events.items():
+                    if kind == 'database' and not dsn:
+                        continue
+                    runs = [sample(function_dir, event, env) for _ in range(args.runs)]
+                    table.append({
+                        'function': function,
+                        'tree': label,
+                        'request': kind,
+                        'status': runs[0]['status'],
+                        'import_ms': statistics.median(run['import_ms'] for run in runs),
+                        'first_call_ms': statistics.median(run['first_call_ms'] for run in runs),
+                        'total_ms': statistics.median(run['import_ms'] + run['first_call_ms'] for run in runs),
+                        'driver_loaded': runs[0]['driver_loaded'],
+                    })
+                if args.importtime:
+                    print(f'{function} ({label}): slowest imports')
+                    print('\n'.join(importtime(function_dir, env, args.importtime)))
+
+    common.print_table(table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+'''
+Business: Shared helpers for the backend benchmarks
+Benchmarks run against a scratch PostgreSQL database given by BENCH_DATABASE_URL
+(never DATABASE_URL), because preparing it drops and recreates the public schema.
+'''
+import glob
+import json
+import os
+import statistics
+import sys
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Sequence
+
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MIGRATIONS_DIR = os.path.join(ROOT, 'db_migrations')
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+
+# synthetic clients reuse a handful of identities far beyond production rates;
+# admission_control.py turns the limits back on to measure them
+os.environ.setdefault('ADMISSION_LIMITS', 'off')
+# the tests.json scenarios identify callers with X-User-Id / X-Is-Admin
+os.environ.setdefault('SESSION_HEADER_AUTH', '1')
+
+
+def bench_dsn() -> str:
+    dsn = os.environ.get('BENCH_DATABASE_URL')
+    if not dsn:
+        sys.exit('Set BENCH_DATABASE_URL to a scratch PostgreSQL database')
+    return dsn
+
+
+def prepare_database(dsn: str, until: Optional[str] = None) -> None:
+    '''
+    Business: Recreate the schema from db_migrations in a scratch database
+    Args: dsn - connection string of a database that may be wiped
+          until - last migration version to apply (e.g. 'V0011'), None for all
+    '''
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('DROP SCHEMA IF EXISTS public CASCADE')
+        cursor.execute('CREATE SCHEMA public')
+        for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, 'V*.sql'))):
+            if until and os.path.basename(path).split('__')[0] > until:
+                break
+            with open(path, encoding='utf-8') as migration:
+                cursor.execute(migration.read())
+    conn.close()
+
+
+def seed_cards(dsn: str, cards: int, balance: Decimal) -> List[int]:
+    '''
+    Business: Replace all data with one active card per synthetic user
+    Starting balances are booked as opening ledger entries.
+    Args: dsn - scratch database
+          cards - number of users (and cards) to create; user N owns card N
+          balance - starting balance of every card
+    Returns: list of card ids
+    '''
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            'TRUNCATE ledger_snapshots, ledger_entries, transactions, cards, card_requests, users RESTART IDENTITY CASCADE'
+        )
+        cursor.execute(
+            """INSERT INTO users (username, email, password_hash, first_name, last_name, phone, birth_year)
+               SELECT 'bench' || g, 'bench' || g || '@example.com', 'x', 'Bench', 'User' || g,
+                      '+7900' || lpad(g::text, 7, '0'), 1990
+               FROM generate_series(1, %s) g""",
+            (cards,)
+        )
+        cursor.execute(
+            """INSERT INTO cards (user_id, card_number, masked_number, card_type, balance, status)
+               SELECT g, '4' || lpad(g::text, 15, '0'), '4000 •••• •••• ' || lpad((g %% 10000)::text, 4, '0'),
+                      'virtual', %s, 'active'
+               FROM generate_series(1, %s) g""",
+            (balance, cards)
+        )
+        cursor.execute(
+            """WITH opening AS (
+                   SELECT id, balance, nextval('ledger_posting_id_seq') AS posting_id
+                   FROM cards WHERE balance <> 0
+               )
+               INSERT INTO ledger_entries (posting_id, card_id, card_seq, amount, entry_type)
+               SELECT posting_id, id, 1, balance, 'opening' FROM opening
+               UNION ALL
+               SELECT posting_id, NULL, NULL, -balance, 'opening' FROM opening"""
+        )
+        cursor.execute('UPDATE cards SET ledger_seq = 1 WHERE balance <> 0')
+        cursor.execute('SELECT id FROM cards ORDER BY id')
+        card_ids = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    conn.close()
+    return card_ids
+
+
+def card_number(card_id: int) -> str:
+    '''
+    Business: Card number seed_cards gives to card N
+    '''
+    return '4' + str(card_id).zfill(15)
+
+
+def use_function(name: str) -> None:
+    '''
+    Business: Make a cloud function directory importable, the way the runtime does
+    Args: name - directory under backend/, e.g. 'cards'
+    '''
+    path = os.path.join(BACKEND_DIR, name)
+    for module_name, module in list(sys.modules.items()):
+        module_file = getattr(module, '__file__', None) or ''
+        if module_file.startswith(BACKEND_DIR + os.sep):
+            del sys.modules[module_name]
+    sys.path[:] = [p for p in sys.path if not p.startswith(BACKEND_DIR + os.sep)]
+    sys.path.insert(0, path)
+
+
+class Context:
+    def __init__(self, request_id: str = 'bench', function_name: str = 'bench') -> None:
+        self.request_id = request_id
+        self.function_name = function_name
+
+
+def make_event(method: str, body: Any = None, headers: Dict[str, str] = None,
+               query: Dict[str, str] = None) -> Dict[str, Any]:
+    event: Dict[str, Any] = {
+        'httpMethod': method,
+        'headers': headers or {},
+        'queryStringParameters': query or {},
+    }
+    if body is not None:
+        event['body'] = json.dumps(body)
+    return event
+
+
+def percentiles(samples: Sequence[float]) -> Dict[str, float]:
+    if not samples:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+    ordered = sorted(samples)
+
+    def pick(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'mean': statistics.fmean(ordered)}
+
+
+def print_table(rows: List[Dict[str, Any]]) -> None:
+    if not rows:
+        return
+    columns = list(rows[0].keys())
+    widths = {c: max(len(c), *(len(_fmt(r[c])) for r in rows)) for c in columns}
+    print('  '.join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print('  '.join(_fmt(row[c]).ljust(widths[c]) for c in columns))
+
+
+def _fmt(value: Any) -> str:
+    if isinstance(value, float):
+        return f'{value:.3f}'
+    return str(value)
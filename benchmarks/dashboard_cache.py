@@ -0,0 +1,84 @@
+'''
+Business: Measure dashboard renders (list + requests + transactions) with and without the user cache
+Renders pick users with a skewed distribution, and a share of them is followed by a
+transfer to another user, which invalidates both dashboards. Reports latency per
+render, hit ratio and how many section reads still reached the database.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/dashboard_cache.py --users 500 --renders 5000
+'''
+import argparse
+import os
+import random
+import time
+from decimal import Decimal
+
+import common
+
+common.use_function('cards')
+import cache  # noqa: E402
+import index  # noqa: E402
+
+SECTIONS = ('list', 'requests', 'transactions')
+
+
+def run(users: int, renders: int, write_ratio: float, seed: int) -> dict:
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(users)]
+    samples = []
+    transfers = 0
+    started = time.perf_counter()
+    for _ in range(renders):
+        user_id = rng.choices(range(1, users + 1), weights)[0]
+        headers = {'X-User-Id': str(user_id)}
+        render_started = time.perf_counter()
+        for action in SECTIONS:
+            event = common.make_event('GET', headers=headers, query={'action': action})
+            if index.handler(event, common.Context())['statusCode'] != 200:
+                raise SystemExit(f'{action} failed for user {user_id}')
+        samples.append((time.perf_counter() - render_started) * 1000)
+        if rng.random() < write_ratio:
+            to_card = rng.randint(1, users)
+            if to_card != user_id:
+                body = {'action': 'transfer', 'from_card_id': user_id, 'to_identifier': common.card_number(to_card),
+                        'amount': '1.00'}
+                index.handler(common.make_event('POST', body, headers), common.Context())
+                transfers += 1
+    elapsed = time.perf_counter() - started
+    stats = index.cache.dashboard.snapshot()
+    return dict(
+        renders_per_s=renders / elapsed,
+        transfers=transfers,
+        hit_ratio=stats['hit_ratio'],
+        db_reads=stats['misses'],
+        **{f'{name}_ms': value for name, value in common.percentiles(samples).items() if name != 'mean'},
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--renders', type=int, default=5000)
+    parser.add_argument('--write-ratio', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=11)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    common.prepare_database(dsn)
+
+    modes = [
+        ('no cache', cache.UserCache(cache.LocalLRU(ttl=0))),
+        ('local LRU', cache.UserCache(cache.LocalLRU(ttl=60))),
+        ('local LRU + shared', cache.UserCache(cache.LocalLRU(ttl=60), cache.MemoryStore())),
+    ]
+    table = []
+    for name, dashboard in modes:
+        common.seed_cards(dsn, args.users, Decimal('100000'))
+        index.cache.dashboard = dashboard
+        table.append(dict(mode=name, **run(args.users, args.renders, args.write_ratio, args.seed)))
+
+    common.print_table(table)
+
+
+if __name__ == '__main__':
+    main()
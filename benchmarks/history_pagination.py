@@ -0,0 +1,116 @@
+'''
+Business: Page-fetch latency of the transaction history at increasing depth
+Fills a synthetic transactions table (10M rows by default) and times the
+keyset-paginated history endpoint against the equivalent OFFSET query at the
+same depths. Keyset pages should stay flat while OFFSET grows with depth.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/history_pagination.py --rows 10000000
+'''
+import argparse
+import os
+import time
+from decimal import Decimal
+
+import psycopg2
+
+import common
+
+common.use_function('cards')
+import history  # noqa: E402
+import index  # noqa: E402
+
+
+def fill(dsn: str, rows: int, users: int) -> None:
+    common.seed_cards(dsn, users, Decimal('0'))
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT transactions_create_partitions(TIMESTAMP '2020-01-01', TIMESTAMP '2020-01-01' + %s * INTERVAL '1 second')",
+            (rows + 1,)
+        )
+        cursor.execute(
+            """INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status, created_at)
+               SELECT g %% %s + 1, g %% %s + 1,
+                      CASE WHEN g %% 2 = 0 THEN 'incoming' ELSE 'outgoing' END,
+                      (g %% 100000) / 100.0 + 1,
+                      'bench',
+                      'completed',
+                      TIMESTAMP '2020-01-01' + g * INTERVAL '1 second'
+               FROM generate_series(1, %s) g""",
+            (users, users, rows)
+        )
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('VACUUM ANALYZE transactions')
+    conn.close()
+
+
+def time_call(fn, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--skip-fill', action='store_true', help='reuse the table from a previous run')
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    if not args.skip_fill:
+        common.prepare_database(dsn)
+        fill(dsn, args.rows, args.users)
+
+    user_rows = args.rows // args.users
+    depths = [1, 10, 100, 1000, 10000]
+    depths = [d for d in depths if d * args.page_size < user_rows] + [user_rows // args.page_size - 1]
+
+    conn = psycopg2.connect(dsn)
+    cursor = conn.cursor()
+    headers = {'X-User-Id': '1'}
+    table = []
+    for depth in depths:
+        offset = depth * args.page_size
+        cursor.execute(
+            """SELECT created_at, id FROM transactions WHERE user_id = 1
+               ORDER BY created_at DESC, id DESC OFFSET %s LIMIT 1""",
+            (offset - 1,)
+        )
+        created_at, transaction_id = cursor.fetchone()
+        token = history.encode_cursor(created_at, transaction_id)
+        event = common.make_event('GET', headers=headers, query={
+            'action': 'transactions', 'limit': str(args.page_size), 'cursor': token
+        })
+
+        def keyset() -> None:
+            assert index.handler(event, common.Context())['statusCode'] == 200
+
+        def offset_page() -> None:
+            cursor.execute(
+                """SELECT t.* FROM transactions t JOIN cards c ON t.card_id = c.id
+                   WHERE c.user_id = 1 ORDER BY t.created_at DESC LIMIT %s OFFSET %s""",
+                (args.page_size, offset)
+            )
+            cursor.fetchall()
+
+        table.append({
+            'page': depth,
+            'row_offset': offset,
+            'keyset_ms': time_call(keyset, args.repeat),
+            'offset_ms': time_call(offset_page, args.repeat),
+        })
+    conn.close()
+    common.print_table(table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+'''
+Business: Parallel duplicate retries against the Idempotency-Key store
+Fires the same request with one Idempotency-Key from many threads at once,
+split across two independently imported copies of the function (two warm
+containers sharing the database), for a cards transfer and for the admin
+add_balance and approve_card actions. Checks that the money moved (or the
+card was issued) exactly once, that the key recorded no more than one
+transfer and one ledger posting, that every retry got the first response and
+was marked Idempotent-Replayed, that a later retry never borrows a database
+connection, and that reusing a key for a different body is refused with 422.
+Also checks that an add_balance withdrawal larger than the balance gets 409.
+Exits with status 1 when any check fails.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/idempotency_retries.py --threads 16
+'''
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Tuple
+
+import psycopg2
+
+import common
+
+FUNCTIONS = ('cards', 'admin')
+CONTAINERS = 2
+
+
+class Container:
+    '''
+    Business: One warm copy of a cloud function with its own caches, pool and inflight table
+    '''
+
+    def __init__(self, function: str) -> None:
+        common.use_function(function)
+        import db
+        import index
+        self.index = index
+        self.acquired = 0
+        acquire = db.acquire
+
+        def counted(dsn: str) -> Any:
+            self.acquired += 1
+            return acquire(dsn)
+
+        db.acquire = counted
+
+    def call(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        return self.index.handler(event, common.Context())
+
+
+def fire(containers: List[Container], event: Dict[str, Any], threads: int) -> List[Dict[str, Any]]:
+    barrier = threading.Barrier(threads)
+    responses: List[Dict[str, Any]] = [{}] * threads
+
+    def worker(slot: int) -> None:
+        barrier.wait()
+        responses[slot] = containers[slot % len(containers)].call(event)
+
+    workers = [threading.Thread(target=worker, args=(slot,)) for slot in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return responses
+
+
+def check(label: str, responses: List[Dict[str, Any]], problems: List[str]) -> None:
+    first = [r for r in responses if 'Idempotent-Replayed' not in r['headers']]
+    if len(first) != 1:
+        problems.append(f'{label}: {len(first)} responses were not replays, expected 1')
+    answers = {(r['statusCode'], r['body']) for r in responses}
+    if len(answers) != 1:
+        problems.append(f'{label}: retries got {len(answers)} different responses: {sorted(answers)}')
+    elif next(iter(answers))[0] != 200:
+        problems.append(f'{label}: request failed: {next(iter(answers))}')
+
+
+def scenario(label: str, containers: List[Container], body: Dict[str, Any], headers: Dict[str, str],
+             threads: int, verify: Callable[[], Tuple[bool, str]], problems: List[str],
+             recorded: Callable[[], Tuple[int, int]], expected: Tuple[int, int]) -> Dict[str, Any]:
+    '''
+    Business: Retry one request under a fresh key and check it took effect once
+    Args: recorded - (transfers, ledger postings) recorded so far in the database
+          expected - how many of each the request itself records
+    '''
+    before = recorded()
+    key = uuid.uuid4().hex
+    headers = {**headers, 'Idempotency-Key': key}
+    event = common.make_event('POST', body, headers)
+
+    started = time.perf_counter()
+    responses = fire(containers, event, threads)
+    elapsed = time.perf_counter() - started
+    check(label, responses, problems)
+
+    acquired = sum(container.acquired for container in containers)
+    late = containers[0].call(event)
+    if 'Idempotent-Replayed' not in late['headers'] or late['body'] != responses[0]['body']:
+        problems.append(f'{label}: a later retry was not replayed')
+    if sum(container.acquired for container in containers) != acquired:
+        problems.append(f'{label}: a cached replay borrowed a database connection')
+
+    changed = common.make_event('POST', {**body, 'probe': 1}, headers)
+    if containers[1].call(changed)['statusCode'] != 422:
+        problems.append(f'{label}: reusing the key for a different body was not refused')
+
+    executed_once, detail = verify()
+    if not executed_once:
+        problems.append(f'{label}: {detail}')
+    records = tuple(after - start for after, start in zip(recorded(), before))
+    if records != expected:
+        problems.append(f'{label}: the key recorded {records[0]} transfers and {records[1]} ledger postings, '
+                        f'expected {expected[0]} and {expected[1]}')
+
+    return {
+        'action': label,
+        'threads': threads,
+        'replays': sum('Idempotent-Replayed' in r['headers'] for r in responses),
+        'statuses': ','.join(sorted({str(r['statusCode']) for r in responses})),
+        'elapsed_ms': elapsed * 1000,
+        'executed': detail,
+        'transfers': records[0],
+        'postings': records[1],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16, help='parallel retries of each request')
+    parser.add_argument('--rounds', type=int, default=3, help='fresh keys per action')
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    common.prepare_database(dsn)
+    common.seed_cards(dsn, 4, Decimal('1000'))
+
+    os.environ['DATABASE_URL'] = dsn
+    containers = {name: [Container(name) for _ in range(CONTAINERS)] for name in FUNCTIONS}
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+
+    def scalar(sql: str, params: Tuple[Any, ...] = ()) -> Any:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()[0]
+
+    def balance(card_id: int) -> Decimal:
+        return scalar('SELECT balance FROM cards WHERE id = %s', (card_id,))
+
+    def recorded() -> Tuple[int, int]:
+        # a transfer is one outgoing row; a posting is all ledger entries sharing a posting_id
+        return (scalar("SELECT count(*) FROM transactions WHERE transaction_type = 'outgoing'"),
+                scalar('SELECT count(DISTINCT posting_id) FROM ledger_entries'))
+
+    problems: List[str] = []
+    table = []
+    for _ in range(args.rounds):
+        before = balance(1), balance(2)
+
+        def transferred_once() -> Tuple[bool, str]:
+            moved = (before[0] - balance(1), balance(2) - before[1])
+            return moved == (Decimal('10'), Decimal('10')), f'moved {moved[0]}'
+
+        table.append(scenario(
+            'transfer', containers['cards'],
+            {'action': 'transfer', 'from_card_id': 1, 'to_identifier': common.card_number(2), 'amount': 10},
+            {'X-User-Id': '1'}, args.threads, transferred_once, problems, recorded, (1, 1)
+        ))
+
+        topped = balance(3)
+
+        def credited_once() -> Tuple[bool, str]:
+            credited = balance(3) - topped
+            return credited == Decimal('25'), f'credited {credited}'
+
+        table.append(scenario(
+            'add_balance', containers['admin'], {'action': 'add_balance', 'card_id': 3, 'amount': 25},
+            {'X-Is-Admin': 'true'}, args.threads, credited_once, problems, recorded, (0, 1)
+        ))
+
+        request_id = scalar(
+            "INSERT INTO card_requests (user_id, card_category, status) VALUES (4, 'debit', 'pending') RETURNING id"
+        )
+        issued = scalar('SELECT count(*) FROM cards WHERE user_id = 4')
+
+        def issued_once() -> Tuple[bool, str]:
+            count = scalar('SELECT count(*) FROM cards WHERE user_id = 4') - issued
+            return count == 1, f'issued {count} cards'
+
+        table.append(scenario(
+            'approve_card', containers['admin'], {'action': 'approve_card', 'request_id': request_id},
+            {'X-Is-Admin': 'true'}, args.threads, issued_once, problems, recorded, (0, 0)
+        ))
+
+    kept = balance(3)
+    overdraft = common.make_event('POST', {'action': 'add_balance', 'card_id': 3, 'amount': str(-kept - 1)},
+                                  {'X-Is-Admin': 'true'})
+    if containers['admin'][0].call(overdraft)['statusCode'] != 409 or balance(3) != kept:
+        problems.append('add_balance: a withdrawal larger than the balance was not refused')
+
+    conn.close()
+    common.print_table(table)
+    for problem in problems:
+        print(f'FAIL {problem}', file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''
+Business: Micro-benchmark of response encoding for card and transaction rows
+Compares the old dict(row) + json.dumps(default=str) path with encoder.py
+(and its optional orjson mode) and checks that the default mode produces
+identical bytes. Needs no database.
+
+Usage: python benchmarks/json_encoding.py --rows 1000
+'''
+import argparse
+import json
+import os
+import random
+import timeit
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import common
+
+# encoder only imports orjson when it is selected; load it, then time the default mode first
+os.environ['JSON_ENCODER'] = 'orjson'
+common.use_function('cards')
+import encoder  # noqa: E402
+
+encoder.USE_ORJSON = False
+
+CARD_COLUMNS = ('id', 'user_id', 'card_number', 'masked_number', 'card_type', 'balance', 'color_scheme',
+                'is_active', 'created_at', 'updated_at', 'status', 'card_category', 'first_name', 'last_name')
+TRANSACTION_COLUMNS = ('id', 'card_id', 'user_id', 'transaction_type', 'amount', 'recipient', 'status', 'created_at')
+
+
+def card_rows(count: int, rng: random.Random):
+    started = datetime(2024, 1, 1, 9, 30)
+    for index in range(count):
+        number = ''.join(rng.choice('0123456789') for _ in range(16))
+        created = started + timedelta(minutes=index, microseconds=rng.randint(0, 999999))
+        yield (index + 1, rng.randint(1, 1000), number, f'{number[:4]} •••• •••• {number[-4:]}',
+               rng.choice(['virtual', 'physical']), Decimal(rng.randint(0, 10_000_000)) / 100,
+               'from-purple-500 to-pink-500', True, created, created,
+               rng.choice(['active', 'blocked', 'frozen']), rng.choice(['debit', 'credit']),
+               'Алексей', 'Иванов')
+
+
+def transaction_rows(count: int, rng: random.Random):
+    started = datetime(2024, 1, 1, 9, 30)
+    recipients = ['Ozon', 'Starbucks', 'Мария Петрова', 'Зарплата', '+79001234567', '4532 •••• •••• 8901']
+    for index in range(count):
+        yield (index + 1, rng.randint(1, 1000), rng.randint(1, 1000), rng.choice(['incoming', 'outgoing']),
+               Decimal(rng.randint(1, 5_000_000)) / 100, rng.choice(recipients), 'completed',
+               started + timedelta(seconds=index * 37, microseconds=rng.randint(0, 999999)))
+
+
+def describe(columns):
+    return [(name, None, None, None, None, None, None) for name in columns]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--number', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    datasets = {
+        'cards': (describe(CARD_COLUMNS), list(card_rows(args.rows, rng))),
+        'transactions': (describe(TRANSACTION_COLUMNS), list(transaction_rows(args.rows, rng))),
+    }
+
+    table = []
+    for key, (description, rows) in datasets.items():
+        columns = [column[0] for column in description]
+
+        def baseline() -> str:
+            return json.dumps({key: [dict(zip(columns, row)) for row in rows]}, default=str)
+
+        def fast() -> str:
+            return encoder.dumps({key: encoder.rows(description, rows)})
+
+        if baseline() != fast():
+            raise SystemExit(f'{key}: encoder output differs from json.dumps')
+
+        modes = [('json.dumps', baseline), ('encoder', fast)]
+        if encoder.orjson is not None:
+            def fast_orjson() -> str:
+                encoder.USE_ORJSON = True
+                try:
+                    return encoder.dumps({key: encoder.rows(description, rows)})
+                finally:
+                    encoder.USE_ORJSON = False
+
+            if json.loads(fast_orjson()) != json.loads(baseline()):
+                raise SystemExit(f'{key}: orjson output is not equivalent')
+            modes.append(('encoder+orjson', fast_orjson))
+
+        reference = None
+        for name, fn in modes:
+            seconds = min(timeit.repeat(fn, number=args.number, repeat=5)) / args.number
+            reference = reference or seconds
+            table.append({
+                'rows': key,
+                'mode': name,
+                'ms_per_response': seconds * 1000,
+                'rows_per_s': int(len(rows) / seconds),
+                'speed_up': reference / seconds,
+            })
+
+    common.print_table(table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+'''
+Business: In-process load test of the cloud function handlers
+Imports every function's handler directly and drives it from concurrent
+threads, either with the scenarios in backend/*/tests.json (--suite) or with a
+synthetic traffic mix against seeded users (--mix list=70,transactions=20,transfer=10).
+Reports per action: throughput, p50/p95/p99 latency, status mismatches and
+database round trips (statements plus commits/rollbacks of open transactions)
+per request. --save writes the results as a baseline; --compare checks a run
+against one and exits with status 1 when p95, throughput or round trips
+regress beyond --tolerance.
+
+Mix actions: list, requests, transactions, transfer, transfer_batch,
+resolve_recipient, login, admin_users, admin_cards.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/load_test.py --suite --iterations 50
+       BENCH_DATABASE_URL=postgresql://... python benchmarks/load_test.py \\
+           --mix list=70,transactions=20,transfer=10 --requests 5000 --concurrency 4 --save baseline.json
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Any, Dict, List, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import psycopg2
+import psycopg2.extensions
+
+import common
+
+FUNCTIONS = ('auth', 'cards', 'admin')
+
+_round_trips = threading.local()
+_cursor_classes: Dict[type, type] = {}
+
+
+def _count() -> None:
+    _round_trips.count = getattr(_round_trips, 'count', 0) + 1
+
+
+def _counting_cursor(base: type) -> type:
+    counting = _cursor_classes.get(base)
+    if counting is None:
+        def execute(self, *args, **kwargs):
+            _count()
+            return base.execute(self, *args, **kwargs)
+
+        def executemany(self, *args, **kwargs):
+            _count()
+            return base.executemany(self, *args, **kwargs)
+
+        counting = type('Counting' + base.__name__, (base,), {'execute': execute, 'executemany': executemany})
+        _cursor_classes[base] = counting
+    return counting
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    '''
+    Business: psycopg2 connection that counts round trips of the calling thread
+    '''
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _counting_cursor(base)
+        return super().cursor(*args, **kwargs)
+
+    def _in_transaction(self) -> bool:
+        return self.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def commit(self):
+        if self._in_transaction():
+            _count()
+        return super().commit()
+
+    def rollback(self):
+        if self._in_transaction():
+            _count()
+        return super().rollback()
+
+
+def load_handlers() -> Dict[str, Any]:
+    '''
+    Business: Import each function's index module the way its container would
+    Returns: dict function name -> index module
+    '''
+    modules = {}
+    for name in FUNCTIONS:
+        common.use_function(name)
+        import db
+        import index
+        db.connection_factory = CountingConnection
+        modules[name] = index
+    return modules
+
+
+def suite_requests(iterations: int) -> List[Tuple[str, str, Dict[str, Any], int]]:
+    '''
+    Business: Events built from the tests.json scenarios of every function
+    Returns: list of (action label, function, event, expected status)
+    '''
+    requests = []
+    for name in FUNCTIONS:
+        path = os.path.join(common.BACKEND_DIR, name, 'tests.json')
+        with open(path, encoding='utf-8') as suite:
+            tests = json.load(suite)['tests']
+        for test in tests:
+            url = urlsplit(test.get('path', '/'))
+            event = common.make_event(test.get('method', 'GET'), test.get('body'), test.get('headers'),
+                                      dict(parse_qsl(url.query)))
+            requests.append((f"{name}: {test['name']}", name, event, test.get('expectedStatus', 200)))
+    return requests * iterations
+
+
+class Mix:
+    '''
+    Business: Synthetic traffic against users seeded by common.seed_cards
+    Args: users - seeded users; user N owns card N
+          sessions_module - sessions module of the cards function, used for tokens
+                            when SESSION_KEYS is set
+    '''
+
+    def __init__(self, users: int, sessions_module: Any) -> None:
+        self.users = users
+        self.sessions = sessions_module
+
+    def headers(self, user_id: int, admin: bool = False) -> Dict[str, str]:
+        if self.sessions.KEYS:
+            token, _ = self.sessions.issue(user_id, admin)
+            return {'Authorization': 'Bearer ' + token}
+        if admin:
+            return {'X-Is-Admin': 'true'}
+        return {'X-User-Id': str(user_id)}
+
+    def build(self, action: str, rng: random.Random) -> Tuple[str, Dict[str, Any], int]:
+        user_id = rng.randint(1, self.users)
+        other = rng.randint(1, self.users - 1)
+        other = other + 1 if other >= user_id else other
+        if action in ('list', 'requests', 'transactions'):
+            return 'cards', common.make_event('GET', headers=self.headers(user_id), query={'action': action}), 200
+        if action == 'transfer':
+            body = {'action': 'transfer', 'from_card_id': user_id, 'to_identifier': common.card_number(other),
+                    'amount': '1.00'}
+            return 'cards', common.make_event('POST', body, self.headers(user_id)), 200
+        if action == 'transfer_batch':
+            items = [{'to_identifier': common.card_number(rng.randint(1, self.users)), 'amount': '0.10'}
+                     for _ in range(10)]
+            items = [item for item in items if item['to_identifier'] != common.card_number(user_id)] or [
+                {'to_identifier': common.card_number(other), 'amount': '0.10'}]
+            body = {'action': 'transfer_batch', 'from_card_id': user_id, 'items': items}
+            return 'cards', common.make_event('POST', body, self.headers(user_id)), 200
+        if action == 'resolve_recipient':
+            query = {'action': 'resolve_recipient', 'to_identifier': common.card_number(other)}
+            return 'cards', common.make_event('GET', headers=self.headers(user_id), query=query), 200
+        if action == 'login':
+            body = {'action': 'login', 'username': f'bench{user_id}', 'password': 'x'}
+            return 'auth', common.make_event('POST', body), 200
+        if action == 'admin_users':
+            return 'admin', common.make_event('GET', headers=self.headers(user_id, True), query={'action': 'users'}), 200
+        if action == 'admin_cards':
+            query = {'action': 'all_cards'}
+            return 'admin', common.make_event('GET', headers=self.headers(user_id, True), query=query), 200
+        raise SystemExit(f'Unknown mix action: {action}')
+
+
+def parse_mix(spec: str) -> List[Tuple[str, float]]:
+    weights = []
+    for part in spec.split(','):
+        action, _, weight = part.partition('=')
+        weights.append((action.strip(), float(weight or 1)))
+    return weights
+
+
+def seed_history(dsn: str, users: int, per_user: int) -> None:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status, created_at)
+               SELECT u, u, CASE WHEN k %% 2 = 0 THEN 'incoming' ELSE 'outgoing' END, (k %% 500) + 1,
+                      'History ' || k, 'completed', CURRENT_TIMESTAMP - make_interval(hours => k)
+               FROM generate_series(1, %s) u, generate_series(1, %s) k""",
+            (users, per_user)
+        )
+    conn.commit()
+    conn.close()
+
+
+def run(handlers: Dict[str, Any], requests: List[Tuple[str, str, Dict[str, Any], int]],
+        concurrency: int) -> Tuple[Dict[str, Dict[str, Any]], float]:
+    '''
+    Business: Replay requests from concurrent threads and collect per-action samples
+    Returns: (per-action results, wall-clock seconds)
+    '''
+    samples: Dict[str, List[Tuple[float, int, bool]]] = {}
+    lock = threading.Lock()
+    queue = iter(requests)
+
+    def worker() -> None:
+        while True:
+            with lock:
+                item = next(queue, None)
+            if item is None:
+                return
+            label, function, event, expected = item
+            _round_trips.count = 0
+            started = time.perf_counter()
+            try:
+                status = handlers[function].handler(event, common.Context())['statusCode']
+            except Exception as e:
+                print(f'{label}: {type(e).__name__}: {e}', file=sys.stderr)
+                status = 599
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                samples.setdefault(label, []).append((elapsed, _round_trips.count, status == expected))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    wall = time.perf_counter() - started
+
+    results = {}
+    for label, rows in sorted(samples.items()):
+        latency = common.percentiles([row[0] for row in rows])
+        results[label] = {
+            'requests': len(rows),
+            'mismatches': sum(1 for row in rows if not row[2]),
+            'per_s': len(rows) / wall,
+            'p50_ms': latency['p50'],
+            'p95_ms': latency['p95'],
+            'p99_ms': latency['p99'],
+            'round_trips': sum(row[1] for row in rows) / len(rows),
+        }
+    return results, wall
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], tolerance: float) -> bool:
+    '''
+    Business: Print deltas against a saved baseline
+    Returns: True when some action regressed beyond tolerance
+    '''
+    table = []
+    regressed = False
+    for label, current in results.items():
+        before = baseline['actions'].get(label)
+        if not before:
+            continue
+        p95_delta = current['p95_ms'] / before['p95_ms'] - 1 if before['p95_ms'] else 0.0
+        rate_delta = current['per_s'] / before['per_s'] - 1 if before['per_s'] else 0.0
+        bad = (p95_delta > tolerance or rate_delta < -tolerance
+               or current['round_trips'] > before['round_trips'] * (1 + tolerance))
+        regressed = regressed or bad
+        table.append({
+            'action': label,
+            'p95_delta_%': p95_delta * 100,
+            'per_s_delta_%': rate_delta * 100,
+            'round_trips': f"{before['round_trips']:.1f} -> {current['round_trips']:.1f}",
+            'regressed': 'YES' if bad else '',
+        })
+    common.print_table(table)
+    return regressed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suite', action='store_true', help='replay backend/*/tests.json scenarios')
+    parser.add_argument('--mix', help='weighted actions, e.g. list=70,transactions=20,transfer=10')
+    parser.add_argument('--iterations', type=int, default=20, help='suite repetitions')
+    parser.add_argument('--requests', type=int, default=2000, help='mix requests')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--history', type=int, default=50, help='seeded transactions per user')
+    parser.add_argument('--seed', type=int, default=13)
+    parser.add_argument('--save', help='write results to this baseline JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    if not args.suite and not args.mix:
+        parser.error('pass --suite and/or --mix')
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.concurrency))
+    os.environ.setdefault('PASSWORD_SCRYPT_N', '16384')
+    common.prepare_database(dsn)
+    handlers = load_handlers()
+
+    results: Dict[str, Dict[str, Any]] = {}
+    if args.suite:
+        suite, _ = run(handlers, suite_requests(args.iterations), args.concurrency)
+        results.update(suite)
+    if args.mix:
+        common.seed_cards(dsn, args.users, Decimal('1000000'))
+        seed_history(dsn, args.users, args.history)
+        rng = random.Random(args.seed)
+        mix = Mix(args.users, handlers['cards'].runtime.sessions)
+        actions, weights = zip(*parse_mix(args.mix))
+        requests = []
+        for action in rng.choices(actions, weights, k=args.requests):
+            function, event, expected = mix.build(action, rng)
+            requests.append((action, function, event, expected))
+        mixed, wall = run(handlers, requests, args.concurrency)
+        results.update(mixed)
+        print(f'mix: {args.requests} requests in {wall:.2f}s, {args.requests / wall:.1f} req/s '
+              f'at concurrency {args.concurrency}')
+
+    common.print_table([dict(action=label, **values) for label, values in results.items()])
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as out:
+            json.dump({
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'args': {key: value for key, value in vars(args).items() if key not in ('save', 'compare')},
+                'actions': results,
+            }, out, indent=2)
+        print(f'baseline saved to {args.save}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as source:
+            baseline = json.load(source)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+'''
+Business: Monthly statements for all cards with statements.generate()
+Seeds --cards cards with history over --months months: transfers between
+cards (transactions rows and their ledger entries, as transfers.py books
+them), a balance adjustment for every 50th card and an opening entry in the
+middle of the month for every 70th, then writes the last full month's
+statements with pools of --workers processes, in CSV and once in JSON.
+Reports wall time, cards and lines per second, per-worker throughput and the
+peak memory of a worker, checks that no card got two statements and that
+every closing balance equals card_balance_at() at the end of the month
+(exits with status 1 otherwise), and times the same statements built with
+two queries per card, the way a loop over the card history would
+(--baseline-cards of them, extrapolated to all cards).
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/monthly_statements.py --cards 100000 --transfers 2000000
+'''
+import argparse
+import csv
+import glob
+import os
+import resource
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+from typing import Any, Dict, List
+
+import psycopg2
+import psycopg2.extras
+
+import common
+
+common.use_function('admin')
+import statements  # noqa: E402
+
+BASELINE_SQL = """SELECT id, transaction_type, amount, recipient, status, created_at FROM transactions
+                  WHERE card_id = %s AND created_at >= %s AND created_at < %s
+                  ORDER BY created_at, id"""
+
+
+def seed(dsn: str, args: argparse.Namespace) -> None:
+    common.seed_cards(dsn, args.cards, Decimal('1000.00'))
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT transactions_create_partitions(
+                   date_trunc('month', LOCALTIMESTAMP) - make_interval(months => %s), LOCALTIMESTAMP)""",
+            (args.months,)
+        )
+        # opening balances are booked before the history starts
+        cursor.execute(
+            """UPDATE ledger_entries
+               SET created_at = date_trunc('month', LOCALTIMESTAMP) - make_interval(months => %s) - INTERVAL '1 day'""",
+            (args.months,)
+        )
+        cursor.execute(
+            """CREATE TEMP TABLE moves AS
+               SELECT g, g %% %(cards)s + 1 AS from_card,
+                      (g::BIGINT * 7919 + g / %(cards)s) %% %(cards)s + 1 AS to_card,
+                      (g %% 5000) / 100.0 + 1 AS amount,
+                      history.start + (g::FLOAT / %(transfers)s) * (LOCALTIMESTAMP - history.start) AS created_at,
+                      nextval(pg_get_serial_sequence('transactions', 'id'))::INTEGER AS outgoing_id,
+                      nextval(pg_get_serial_sequence('transactions', 'id'))::INTEGER AS incoming_id,
+                      nextval('ledger_posting_id_seq') AS posting_id
+               FROM generate_series(1, %(transfers)s) g,
+                    (SELECT date_trunc('month', LOCALTIMESTAMP) - make_interval(months => %(months)s) AS start) history""",
+            {'cards': args.cards, 'months': args.months, 'transfers': args.transfers}
+        )
+        cursor.execute('DELETE FROM moves WHERE from_card = to_card')
+        cursor.execute(
+            """INSERT INTO transactions (id, card_id, user_id, transaction_type, amount, recipient, status, created_at)
+               SELECT outgoing_id, from_card, from_card, 'outgoing', amount, '4000 •••• •••• ' || lpad((to_card % 10000)::text, 4, '0'),
+                      'completed', created_at FROM moves
+               UNION ALL
+               SELECT incoming_id, to_card, to_card, 'incoming', amount, '4000 •••• •••• ' || lpad((from_card % 10000)::text, 4, '0'),
+                      'completed', created_at FROM moves"""
+        )
+        cursor.execute(
+            """CREATE TEMP TABLE entries AS
+               SELECT posting_id, from_card AS card_id, -amount AS amount, 'transfer' AS entry_type,
+                      outgoing_id AS transaction_id, created_at FROM moves
+               UNION ALL
+               SELECT posting_id, to_card, amount, 'transfer', incoming_id, created_at FROM moves
+               UNION ALL
+               SELECT nextval('ledger_posting_id_seq'), id, 25.00, 'adjustment', NULL,
+                      date_trunc('month', LOCALTIMESTAMP) - INTERVAL '1 month' + (id % 28) * INTERVAL '1 day'
+               FROM cards WHERE id % 50 = 0
+               UNION ALL
+               -- opening balances booked in the middle of the month, e.g. cards migrated from another system
+               SELECT nextval('ledger_posting_id_seq'), id, 10.00, 'opening', NULL,
+                      date_trunc('month', LOCALTIMESTAMP) - INTERVAL '1 month' + (id % 28) * INTERVAL '1 day'
+               FROM cards WHERE id % 70 = 0"""
+        )
+        cursor.execute(
+            """INSERT INTO ledger_entries (posting_id, card_id, card_seq, amount, entry_type, transaction_id, created_at)
+               SELECT posting_id, card_id, 1 + ROW_NUMBER() OVER (PARTITION BY card_id ORDER BY created_at, transaction_id),
+                      amount, entry_type, transaction_id, created_at
+               FROM entries
+               UNION ALL
+               SELECT nextval('ledger_posting_id_seq'), NULL, NULL, -amount, entry_type, NULL, created_at
+               FROM entries WHERE entry_type <> 'transfer'"""
+        )
+        cursor.execute(
+            """UPDATE cards c SET balance = c.balance + e.total, ledger_seq = 1 + e.entries
+               FROM (SELECT card_id, SUM(amount) AS total, COUNT(*) AS entries FROM entries GROUP BY card_id) e
+               WHERE e.card_id = c.id"""
+        )
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('VACUUM ANALYZE transactions, ledger_entries, cards')
+    conn.close()
+
+
+def mismatches(dsn: str, out_dir: str, period: str) -> int:
+    rows = []
+    for path in glob.glob(os.path.join(out_dir, period, '*', 'manifest.csv')):
+        with open(path, encoding='utf-8', newline='') as manifest:
+            rows += [(int(row['card_id']), Decimal(row['closing_balance'])) for row in csv.DictReader(manifest)]
+    _, end = statements.parse_period(period)
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('CREATE TEMP TABLE written (card_id INTEGER, closing DECIMAL(15, 2))')
+        psycopg2.extras.execute_values(cursor, 'INSERT INTO written VALUES %s', rows, page_size=10000)
+        cursor.execute(
+            """SELECT COUNT(*) FROM cards c
+               LEFT JOIN written w ON w.card_id = c.id
+               WHERE COALESCE(w.closing, 0) <> card_balance_at(c.id, %s::TIMESTAMP - INTERVAL '1 microsecond')""",
+            (end,)
+        )
+        count = cursor.fetchone()[0]
+        # a card split into two statements would be listed twice
+        cursor.execute('SELECT COUNT(*) - COUNT(DISTINCT card_id) FROM written')
+        count += cursor.fetchone()[0]
+    conn.close()
+    return count
+
+
+def baseline(dsn: str, period: str, cards: int, sample: int) -> Dict[str, Any]:
+    start, end = statements.parse_period(period)
+    out_dir = tempfile.mkdtemp(prefix='statements-baseline-')
+    conn = psycopg2.connect(dsn)
+    started = time.perf_counter()
+    lines = 0
+    with conn.cursor() as cursor:
+        for card_id in range(1, sample + 1):
+            cursor.execute("SELECT card_balance_at(%s, %s::TIMESTAMP - INTERVAL '1 microsecond')", (card_id, start))
+            balance = cursor.fetchone()[0]
+            cursor.execute(BASELINE_SQL, (card_id, start, end))
+            statement = statements.CsvStatement(os.path.join(out_dir, f'{card_id}.csv'), card_id, '', period, balance)
+            history = cursor.fetchall()
+            for transaction_id, transaction_type, amount, recipient, _, created_at in history:
+                amount = -amount if transaction_type == 'outgoing' else amount
+                balance += amount
+                statement.line(created_at, transaction_type, amount, balance, recipient, transaction_id)
+            statement.close(balance, len(history))
+            lines += len(history)
+    seconds = time.perf_counter() - started
+    conn.close()
+    shutil.rmtree(out_dir)
+    return {
+        'run': f'query per card, {sample} cards',
+        'cards_per_s': sample / seconds,
+        'lines_per_s': lines / seconds,
+        'est_all_cards_s': cards / (sample / seconds),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cards', type=int, default=100_000)
+    parser.add_argument('--transfers', type=int, default=2_000_000)
+    parser.add_argument('--months', type=int, default=3)
+    parser.add_argument('--workers', default='1,2,4')
+    parser.add_argument('--range-cards', type=int, default=statements.RANGE_CARDS)
+    parser.add_argument('--baseline-cards', type=int, default=2000)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    common.prepare_database(dsn)
+    seed(dsn, args)
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_char(date_trunc('month', LOCALTIMESTAMP) - INTERVAL '1 month', 'YYYY-MM')")
+        period = cursor.fetchone()[0]
+    conn.close()
+
+    out_dir = tempfile.mkdtemp(prefix='statements-')
+    rows: List[Dict[str, Any]] = []
+    worker_rows: List[Dict[str, Any]] = []
+    try:
+        runs = [(int(workers), 'csv') for workers in args.workers.split(',')]
+        runs.append((runs[-1][0], 'json'))
+        for workers, fmt in runs:
+            summary = statements.generate(dsn, period, out_dir, fmt, workers=workers, range_cards=args.range_cards)
+            rows.append({
+                'run': f'{fmt}, {workers} workers',
+                'ranges': summary['ranges'],
+                'statements': summary['statements'],
+                'lines': summary['lines'],
+                'seconds': summary['seconds'],
+                'cards_per_s': summary['cards'] / summary['seconds'],
+                'lines_per_s': summary['lines'] / summary['seconds'],
+                'mismatches': mismatches(dsn, out_dir, period),
+            })
+            worker_rows += [{'run': rows[-1]['run'], **worker} for worker in summary['workers']]
+            shutil.rmtree(os.path.join(out_dir, period))
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    print(f'period {period}')
+    common.print_table(rows)
+    common.print_table(worker_rows)
+    common.print_table([baseline(dsn, period, args.cards, args.baseline_cards)])
+    print(f'peak worker RSS: {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.1f} MB')
+    if any(row.get('mismatches') for row in rows):
+        raise SystemExit('a card got two statements or a closing balance differs from the ledger')
+
+
+if __name__ == '__main__':
+    main()
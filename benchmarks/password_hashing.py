@@ -0,0 +1,83 @@
+'''
+Business: Login throughput through the auth handler at several scrypt cost settings
+Each setting seeds users hashed with that work factor and replays logins from
+concurrent callers; the password worker pool (PASSWORD_WORKERS) bounds how many
+hashes run at once, and callers beyond DB_POOL_MAX_SIZE queue for a connection.
+A row for legacy plaintext rows shows the one-off rehash cost.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/password_hashing.py --logins 200 --concurrency 4
+'''
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import psycopg2
+
+import common
+
+common.use_function('auth')
+import index  # noqa: E402
+import passwords  # noqa: E402
+
+PASSWORD = 'correct horse battery staple'
+
+
+def store_hashes(dsn: str, users: int, stored: str) -> None:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('UPDATE users SET password_hash = %s WHERE id <= %s', (stored, users))
+    conn.commit()
+    conn.close()
+
+
+def run(users: int, logins: int, concurrency: int) -> dict:
+    def login(number: int) -> float:
+        started = time.perf_counter()
+        body = {'action': 'login', 'username': f'bench{number % users + 1}', 'password': PASSWORD}
+        response = index.handler(common.make_event('POST', body), common.Context())
+        if response['statusCode'] != 200:
+            raise SystemExit(f'login failed: {response["body"]}')
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as callers:
+        samples = list(callers.map(login, range(logins)))
+    elapsed = time.perf_counter() - started
+    latency = common.percentiles(samples)
+    return {'logins_per_s': logins / elapsed, 'p50_ms': latency['p50'], 'p95_ms': latency['p95']}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--costs', default='4096,16384,32768,65536')
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    common.prepare_database(dsn)
+    common.seed_cards(dsn, args.users, Decimal('0'))
+    calibrated = passwords.work_factor()
+    print(f'work factor n={calibrated} ({"calibrated" if passwords.TARGET_MS else "PASSWORD_SCRYPT_N"}), '
+          f'memory cap n={passwords.MEMORY_N}, {passwords.WORKERS} hashing workers')
+
+    table = []
+    for n in [int(cost) for cost in args.costs.split(',')]:
+        passwords.WORK_FACTOR = n
+        store_hashes(dsn, args.users, passwords.hash_password(PASSWORD, n))
+        table.append(dict(n=n, mode='hashed', **run(args.users, args.logins, args.concurrency)))
+
+    passwords.WORK_FACTOR = calibrated
+    store_hashes(dsn, args.users, PASSWORD)
+    table.append(dict(n=calibrated, mode='legacy + rehash', **run(args.users, args.users, args.concurrency)))
+    table.append(dict(n=calibrated, mode='after rehash', **run(args.users, args.logins, args.concurrency)))
+
+    common.print_table(table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+'''
+Business: Read routing to a streaming replica, read-your-writes and failover
+Runs the cards handler against a primary (BENCH_DATABASE_URL) and a streaming
+replica of it, either one given in BENCH_REPLICA_URL or a local one this script
+creates with pg_basebackup and recovery_min_apply_delay, so that the replica
+lags by --apply-delay. Phases:
+  reads       GET actions of users who wrote nothing go to the replica
+  writes      each user transfers and reads right away: the payer and the
+              recipient must both see the transfer although the replica does
+              not have it yet, so their reads stay on the primary
+  caught_up   once the replica has replayed the writes, reads return to it
+  failover    the replica is stopped (or its URL broken): reads keep
+              answering from the primary
+  recovered   the replica is back after DB_REPLICA_RETRY_INTERVAL
+Exits 1 if a read failed or returned data older than the user's own write.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/replica_routing.py --replica-dir /tmp/replica
+       BENCH_DATABASE_URL=... BENCH_REPLICA_URL=... python benchmarks/replica_routing.py
+'''
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import time
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+import common
+
+common.use_function('cards')
+import db  # noqa: E402
+
+
+class LocalReplica:
+    '''
+    Business: Streaming replica of the primary in a local data directory
+    Args: primary_dsn - connection string pg_basebackup copies from (needs replication rights)
+          data_dir - replica data directory; the socket is created next to it
+          port - port of the replica's socket
+          apply_delay - recovery_min_apply_delay, e.g. '1s'
+          pg_bin - directory with pg_basebackup and pg_ctl, or None for PATH
+          run_as - OS user to run the server as (PostgreSQL refuses root)
+    '''
+
+    def __init__(self, primary_dsn: str, data_dir: str, port: int, apply_delay: str,
+                 pg_bin: Optional[str], run_as: Optional[str]) -> None:
+        self.primary_dsn = primary_dsn
+        self.data_dir = os.path.abspath(data_dir)
+        self.socket_dir = os.path.dirname(self.data_dir)
+        self.port = port
+        self.apply_delay = apply_delay
+        self.pg_bin = pg_bin
+        self.run_as = run_as
+
+    def _run(self, *command: str) -> None:
+        program = os.path.join(self.pg_bin, command[0]) if self.pg_bin else command[0]
+        prefix = ['runuser', '-u', self.run_as, '--'] if self.run_as else []
+        subprocess.run(prefix + [program, *command[1:]], check=True, stdout=subprocess.DEVNULL)
+
+    @property
+    def dsn(self) -> str:
+        return psycopg2.extensions.make_dsn(self.primary_dsn, host=self.socket_dir, port=self.port)
+
+    def create(self) -> None:
+        if os.path.exists(self.data_dir):
+            shutil.rmtree(self.data_dir)
+        os.makedirs(self.socket_dir, exist_ok=True)
+        os.makedirs(self.data_dir, mode=0o700)
+        if self.run_as:
+            shutil.chown(self.socket_dir, self.run_as)
+            shutil.chown(self.data_dir, self.run_as)
+        self._run('pg_basebackup', '-d', self.primary_dsn, '-D', self.data_dir, '-R', '-X', 'stream',
+                  '--checkpoint=fast')
+        with open(os.path.join(self.data_dir, 'postgresql.auto.conf'), 'a') as conf:
+            conf.write(f"recovery_min_apply_delay = '{self.apply_delay}'\n")
+
+    def start(self) -> None:
+        self._run('pg_ctl', '-D', self.data_dir, '-w', '-l', os.path.join(self.socket_dir, 'replica.log'),
+                  '-o', f"-c listen_addresses='' -k {self.socket_dir} -p {self.port}", 'start')
+
+    def stop(self) -> None:
+        self._run('pg_ctl', '-D', self.data_dir, '-w', '-m', 'fast', 'stop')
+
+
+def replayed(replica_dsn: str) -> int:
+    conn = psycopg2.connect(replica_dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT COALESCE(pg_last_wal_replay_lsn(), pg_current_wal_lsn())::text')
+        lsn = cursor.fetchone()[0]
+    conn.close()
+    return db.parse_lsn(lsn)
+
+
+def wait_for_replay(dsn: str, replica_dsn: str, timeout: float = 60) -> None:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT pg_current_wal_lsn()::text')
+        target = db.parse_lsn(cursor.fetchone()[0])
+    conn.close()
+    deadline = time.monotonic() + timeout
+    while replayed(replica_dsn) < target:
+        if time.monotonic() > deadline:
+            raise SystemExit('the replica did not catch up with the primary')
+        time.sleep(0.1)
+
+
+def balance(user_id: int) -> Optional[Decimal]:
+    import index
+    event = common.make_event('GET', headers={'X-User-Id': str(user_id)}, query={'action': 'list'})
+    response = index.handler(event, common.Context())
+    if response['statusCode'] != 200:
+        return None
+    return Decimal(str(json.loads(response['body'])['cards'][0]['balance']))
+
+
+def replica_balance(replica_dsn: str, user_id: int) -> Optional[Decimal]:
+    try:
+        conn = psycopg2.connect(replica_dsn)
+    except psycopg2.OperationalError:
+        return None
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT balance FROM cards WHERE user_id = %s', (user_id,))
+        value = cursor.fetchone()[0]
+    conn.close()
+    return value
+
+
+def phase(name: str, users: List[int], expected: Dict[int, Decimal], replica_dsn: str) -> Dict[str, Any]:
+    replica = db.get_replica(os.environ['DATABASE_REPLICA_URL'])
+    before = dict(replica.stats)
+    errors = stale = 0
+    for user_id in users:
+        value = balance(user_id)
+        if value is None:
+            errors += 1
+        elif value != expected[user_id]:
+            stale += 1
+    after = replica.stats
+    return {
+        'phase': name,
+        'reads': len(users),
+        'replica_reads': after['reads'] - before['reads'],
+        'primary_reads': len(users) - (after['reads'] - before['reads']),
+        'lagging': after['lagging'] - before['lagging'],
+        'failovers': after['failovers'] - before['failovers'],
+        'errors': errors,
+        'stale': stale,
+        'replica_behind': sum(1 for u in users if replica_balance(replica_dsn, u) not in (None, expected[u])),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--replica-dir', help='create and run a local replica in this data directory')
+    parser.add_argument('--replica-port', type=int, default=5433)
+    parser.add_argument('--apply-delay', default='2s', help='how far the local replica lags behind')
+    parser.add_argument('--pg-bin', help='directory with pg_basebackup and pg_ctl')
+    parser.add_argument('--run-as', help='OS user for the local replica server')
+    parser.add_argument('--retry-interval', type=float, default=1.0, help='DB_REPLICA_RETRY_INTERVAL')
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    local = None
+    if args.replica_dir:
+        local = LocalReplica(dsn, args.replica_dir, args.replica_port, args.apply_delay, args.pg_bin, args.run_as)
+        local.create()
+        local.start()
+        replica_dsn = local.dsn
+    else:
+        replica_dsn = os.environ.get('BENCH_REPLICA_URL')
+        if not replica_dsn:
+            raise SystemExit('Set BENCH_REPLICA_URL or pass --replica-dir')
+
+    os.environ['DATABASE_URL'] = dsn
+    os.environ['DATABASE_REPLICA_URL'] = replica_dsn
+    db.REPLICA_RETRY_INTERVAL = args.retry_interval
+    os.environ['CACHE_TTL'] = '0'
+
+    rows = []
+    try:
+        initial = Decimal('1000.00')
+        common.prepare_database(dsn)
+        common.seed_cards(dsn, args.users, initial)
+        wait_for_replay(dsn, replica_dsn)
+        import index
+
+        users = list(range(1, args.users + 1))
+        expected = {user_id: initial for user_id in users}
+        rows.append(phase('reads', users, expected, replica_dsn))
+
+        # even users pay the next odd user; both must see it at once
+        for payer in users[1::2]:
+            payee = payer % args.users + 1
+            event = common.make_event('POST', {
+                'action': 'transfer',
+                'from_card_id': payer,
+                'to_identifier': common.card_number(payee),
+                'amount': '1.00',
+                'async': False,
+            }, {'X-User-Id': str(payer)})
+            if index.handler(event, common.Context())['statusCode'] == 200:
+                expected[payer] -= 1
+                expected[payee] += 1
+        rows.append(phase('writes', users, expected, replica_dsn))
+
+        wait_for_replay(dsn, replica_dsn)
+        rows.append(phase('caught_up', users, expected, replica_dsn))
+
+        if local:
+            local.stop()
+        else:
+            os.environ['DATABASE_REPLICA_URL'] = psycopg2.extensions.make_dsn(replica_dsn, host='/nonexistent')
+        rows.append(phase('failover', users, expected, replica_dsn))
+
+        if local:
+            local.start()
+        else:
+            os.environ['DATABASE_REPLICA_URL'] = replica_dsn
+        wait_for_replay(dsn, replica_dsn)
+        time.sleep(args.retry_interval)
+        rows.append(phase('recovered', users, expected, replica_dsn))
+    finally:
+        if local:
+            try:
+                local.stop()
+            except subprocess.CalledProcessError:
+                pass
+
+    common.print_table(rows)
+    routed = {row['phase']: row for row in rows}
+    failed = (
+        any(row['errors'] or row['stale'] for row in rows)
+        or routed['reads']['replica_reads'] != len(users)
+        or routed['writes']['replica_behind'] == 0
+        or routed['caught_up']['replica_reads'] != len(users)
+        or routed['failover']['failovers'] == 0
+        or routed['recovered']['replica_reads'] == 0
+    )
+    if failed:
+        raise SystemExit('replica routing check failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+Business: Cost of authenticating a request with a signed session token
+Times sessions.verify() alone, the full authenticate() path with a warm
+revocation list, and, when BENCH_DATABASE_URL is set, the users-table lookup
+per request that tokens replace. With a database it also checks blocking
+through the admin and auth handlers: a blocked user's login gets 403 and no
+token of theirs, old or new, is accepted until the block is lifted (exits
+with status 1 otherwise).
+
+Usage: python benchmarks/session_tokens.py --number 100000
+'''
+import argparse
+import json
+import os
+import timeit
+from typing import Any, Dict, List
+
+import psycopg2
+
+import common
+
+os.environ.setdefault('SESSION_KEYS', 'bench-2:' + 'b' * 32 + ',bench-1:' + 'a' * 32)
+common.use_function('cards')
+import db  # noqa: E402
+import sessions  # noqa: E402
+
+
+def check_blocking(dsn: str) -> List[str]:
+    os.environ['DATABASE_URL'] = dsn
+    common.use_function('auth')
+    import index as auth
+    import passwords
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('UPDATE users SET password_hash = %s WHERE id = 2', (passwords.hash_password('secret'),))
+    conn.commit()
+    conn.close()
+    common.use_function('admin')
+    import index as admin
+    import sessions as admin_sessions
+    admin_headers = {'Authorization': 'Bearer ' + admin_sessions.issue(1, True)[0]}
+
+    def login() -> Dict[str, Any]:
+        event = common.make_event('POST', {'action': 'login', 'username': 'bench2', 'password': 'secret'})
+        return auth.handler(event, common.Context())
+
+    def block(blocked: bool) -> int:
+        event = common.make_event('POST', {'action': 'block_user', 'user_id': 2, 'blocked': blocked}, admin_headers)
+        return admin.handler(event, common.Context())['statusCode']
+
+    def accepted(token: str) -> bool:
+        # this function's own cache, refreshed by the admin action, and one read afresh
+        other = sessions.RevocationList()
+        other.refresh(dsn, force=True)
+        claims = admin_sessions.authenticate({'Authorization': 'Bearer ' + token}, dsn)
+        return claims is not None and not other.is_revoked(sessions.verify(token))
+
+    problems = []
+    before = json.loads(login()['body']).get('token', '')
+    if not accepted(before):
+        problems.append('a token from a normal login was rejected')
+    if block(True) != 200:
+        problems.append('block_user failed')
+    if login()['statusCode'] != 403:
+        problems.append('a blocked user could log in')
+    if accepted(before):
+        problems.append('a token issued before the block was accepted')
+    if accepted(admin_sessions.issue(2, False)[0]):
+        problems.append('a token issued during the block was accepted')
+    if block(False) != 200:
+        problems.append('lifting the block failed')
+    after = login()
+    if after['statusCode'] != 200 or not accepted(json.loads(after['body']).get('token', '')):
+        problems.append('the user could not sign in after the block was lifted')
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=100000)
+    parser.add_argument('--revoked', type=int, default=10000, help='revoked tokens held in the cached list')
+    args = parser.parse_args()
+
+    token, claims = sessions.issue(1, False)
+    headers = {'Authorization': 'Bearer ' + token}
+    sessions.revocations.tokens.update(f'revoked-{index}' for index in range(args.revoked))
+    sessions.revocations.refresh_interval = float('inf')
+    sessions.revocations.checked_at = 0.0
+
+    modes = [
+        ('verify', lambda: sessions.verify(token)),
+        ('authenticate', lambda: sessions.authenticate(headers, '')),
+    ]
+
+    dsn = os.environ.get('BENCH_DATABASE_URL')
+    if dsn:
+        common.prepare_database(dsn)
+        common.seed_cards(dsn, 1000, 0)
+
+        def lookup() -> None:
+            conn = db.acquire(dsn)
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT id, is_admin FROM users WHERE id = %s', (claims.user_id,))
+                    cursor.fetchone()
+                conn.rollback()
+            finally:
+                db.release(dsn, conn)
+
+        modes.append(('users lookup', lookup))
+        problems = check_blocking(dsn)
+
+    table = []
+    for name, fn in modes:
+        number = args.number if name != 'users lookup' else max(1, args.number // 50)
+        seconds = min(timeit.repeat(fn, number=number, repeat=5)) / number
+        table.append({'mode': name, 'us_per_request': seconds * 1e6, 'requests_per_s': int(1 / seconds)})
+
+    common.print_table(table)
+    if dsn:
+        print('blocking:', '; '.join(problems) if problems else 'ok')
+        if problems:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
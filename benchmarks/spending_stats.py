@@ -0,0 +1,167 @@
+'''
+Business: Spending report from the daily rollups versus aggregating raw transactions
+Fills the scratch database with synthetic history (2M rows over 24 months by
+default), backfills card_daily_stats with stats.rebuild() (timed), checks the
+rollups against a direct aggregate and then times, for one user and several
+ranges, stats.summary() against the aggregate over transactions the same
+report would need without rollups (totals, the previous month and the top
+recipients). Finally detaches the oldest month and checks that rebuilding
+the whole range again leaves that month's rollups in place.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/spending_stats.py --rows 2000000
+'''
+import argparse
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Any, Dict
+
+import psycopg2
+
+import common
+
+common.use_function('cards')
+import stats  # noqa: E402
+
+RAW_SQL = """SELECT
+                 SUM(amount) FILTER (WHERE transaction_type = 'incoming' AND created_at >= %(start)s),
+                 SUM(amount) FILTER (WHERE transaction_type = 'outgoing' AND created_at >= %(start)s),
+                 SUM(amount) FILTER (WHERE transaction_type = 'incoming' AND created_at < %(previous_end)s),
+                 SUM(amount) FILTER (WHERE transaction_type = 'outgoing' AND created_at < %(previous_end)s)
+             FROM transactions
+             WHERE user_id = %(user_id)s AND status = 'completed'
+               AND created_at >= %(previous_start)s AND created_at < %(end)s"""
+RAW_TOP_SQL = """SELECT recipient, SUM(amount) FROM transactions
+                 WHERE user_id = %(user_id)s AND status = 'completed' AND transaction_type = 'outgoing'
+                   AND created_at >= %(start)s AND created_at < %(end)s
+                 GROUP BY recipient ORDER BY 2 DESC LIMIT 5"""
+
+
+def fill(dsn: str, args: argparse.Namespace) -> None:
+    common.seed_cards(dsn, args.users, Decimal('0'))
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT transactions_create_partitions(
+                   date_trunc('month', LOCALTIMESTAMP) - make_interval(months => %s), LOCALTIMESTAMP)""",
+            (args.months,)
+        )
+        cursor.execute(
+            """INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status, created_at)
+               SELECT g %% %s + 1, g %% %s + 1,
+                      CASE WHEN g %% 3 = 0 THEN 'incoming' ELSE 'outgoing' END,
+                      (g %% 10000) / 100.0 + 1,
+                      'shop ' || (g / 7) %% 40,
+                      'completed',
+                      LOCALTIMESTAMP - (g %% (%s * 30 * 24)) * INTERVAL '1 hour'
+               FROM generate_series(1, %s) g""",
+            (args.users, args.users, args.months, args.rows)
+        )
+    conn.commit()
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('VACUUM ANALYZE transactions')
+    conn.close()
+
+
+def best_ms(fn: Any, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def kept_after_detach(conn: Any, args: argparse.Namespace, today: date) -> bool:
+    '''
+    Business: Detach the oldest month, rebuild every day again and compare that month's rollups
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT transactions_oldest_partition() + INTERVAL '1 month'")
+        cutoff = cursor.fetchone()[0]
+        snapshot = 'SELECT COUNT(*), SUM(outgoing_amount) FROM card_daily_stats WHERE day < %s'
+        cursor.execute(snapshot, (cutoff,))
+        before = cursor.fetchone()
+        cursor.execute('SELECT transactions_detach_partitions(%s)', (cutoff,))
+    conn.commit()
+    stats.rebuild(conn, today - timedelta(days=args.months * 31 + 1), today)
+    with conn.cursor() as cursor:
+        cursor.execute(snapshot, (cutoff,))
+        after = cursor.fetchone()
+    conn.rollback()
+    return before[0] > 0 and before == after
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    common.prepare_database(dsn)
+    fill(dsn, args)
+
+    conn = psycopg2.connect(dsn)
+    today = date.today()
+    started = time.perf_counter()
+    rollup_rows = stats.rebuild(conn, today - timedelta(days=args.months * 31 + 1), today)
+    rebuild_s = time.perf_counter() - started
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT (SELECT SUM(incoming_amount) - SUM(outgoing_amount) FROM card_daily_stats)
+                    = (SELECT SUM(CASE WHEN transaction_type = 'incoming' THEN amount ELSE -amount END)
+                       FROM transactions WHERE status = 'completed')"""
+        )
+        consistent = cursor.fetchone()[0]
+    conn.rollback()
+
+    rows = []
+    for label, days in (('month', None), ('quarter', 91), ('year', 365)):
+        start = today.replace(day=1) if days is None else today - timedelta(days=days)
+        params = {'from_date': start.isoformat(), 'to_date': today.isoformat()}
+        values: Dict[str, Any] = {
+            'user_id': 1,
+            'start': start,
+            'end': today + timedelta(days=1),
+            'previous_start': stats.shift_month(start, -1),
+            'previous_end': stats.shift_month(today, -1) + timedelta(days=1),
+        }
+
+        def raw() -> None:
+            with conn.cursor() as cursor:
+                cursor.execute(RAW_SQL, values)
+                cursor.fetchall()
+                cursor.execute(RAW_TOP_SQL, values)
+                cursor.fetchall()
+            conn.rollback()
+
+        def rollup() -> None:
+            stats.summary(conn, 1, params, today)
+            conn.rollback()
+
+        rows.append({
+            'range': label,
+            'raw_ms': best_ms(raw, args.repeat),
+            'rollup_ms': best_ms(rollup, args.repeat),
+            'rebuild_s': rebuild_s,
+            'rollup_rows': rollup_rows,
+            'consistent': consistent,
+        })
+    archived_kept = kept_after_detach(conn, args, today)
+    conn.close()
+    for row in rows:
+        row['archived_kept'] = archived_kept
+    common.print_table(rows)
+    if not consistent:
+        raise SystemExit('rollups do not match transactions')
+    if not archived_kept:
+        raise SystemExit('rebuilding deleted the rollups of a detached month')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''
+Business: Overhead of the tracing layer on the cards handler
+Times the same GET list / transactions invocations with TRACE unset, with
+TRACE=1 (trace lines written to /dev/null) and the cost of a span() call
+outside a trace, which is all the disabled path adds to db.acquire() and the
+encoder.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/tracing_overhead.py --number 2000
+'''
+import argparse
+import contextlib
+import importlib
+import os
+import timeit
+
+import common
+
+
+def load_cards(trace: bool):
+    if trace:
+        os.environ['TRACE'] = '1'
+    else:
+        os.environ.pop('TRACE', None)
+    common.use_function('cards')
+    return importlib.import_module('index'), importlib.import_module('tracing')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    os.environ['CACHE_TTL'] = '0'
+    common.prepare_database(dsn)
+    common.seed_cards(dsn, args.users, 1000)
+
+    events = {
+        action: common.make_event('GET', headers={'X-User-Id': '1'}, query={'action': action})
+        for action in ('list', 'transactions')
+    }
+    context = common.Context()
+
+    handlers = {mode: load_cards(mode == 'on') for mode in ('off', 'on')}
+    best = {}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # alternate the modes so drift in the database affects both alike
+        for _ in range(5):
+            for mode, (index, _) in handlers.items():
+                for action, event in events.items():
+                    seconds = timeit.timeit(lambda: index.handler(event, context), number=args.number) / args.number
+                    best[mode, action] = min(best.get((mode, action), seconds), seconds)
+
+    table = [{
+        'mode': f'TRACE {mode}',
+        'action': action,
+        'us_per_request': seconds * 1e6,
+        'overhead_%': (seconds / best['off', action] - 1) * 100,
+    } for (mode, action), seconds in best.items()]
+
+    tracing = handlers['off'][1]
+    number = args.number * 100
+    seconds = min(timeit.repeat(lambda: tracing.span('acquire'), number=number, repeat=5)) / number
+    table.append({'mode': 'TRACE off', 'action': 'span()', 'us_per_request': seconds * 1e6, 'overhead_%': 0.0})
+
+    common.print_table(table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+'''
+Business: transactions as one heap versus monthly partitions
+Builds the schema twice in the scratch database, once with the migrations
+before V0012 (single table) and once with all of them (monthly partitions),
+fills each with the same synthetic history (50M rows over 36 months by
+default) and times:
+  first_page    newest history page of a user
+  month_page    a page filtered to one month a year ago
+  deep_page     a page behind a cursor 18 months back
+  month_scan    an admin-style aggregate over last month
+  drop_month    removing the oldest month (DELETE versus DETACH; rolled back)
+and reports table plus index size. The heap is queried with the single
+statement the history endpoint issued before V0012; the partitioned schema
+goes through history.fetch_page(), which scans time-bounded windows.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/transactions_partitioning.py --rows 50000000
+'''
+import argparse
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Callable, Dict, List
+
+import psycopg2
+
+import common
+
+common.use_function('cards')
+import history  # noqa: E402
+
+LEGACY_PAGE_SQL = """SELECT t.* FROM transactions t
+                     WHERE t.user_id = %s {extra}
+                     ORDER BY t.created_at DESC, t.id DESC
+                     LIMIT %s"""
+BATCH_ROWS = 1_000_000
+
+
+def month_start(months_back: int) -> datetime:
+    now = datetime.now()
+    year, month = divmod(now.year * 12 + now.month - 1 - months_back, 12)
+    return datetime(year, month + 1, 1)
+
+
+def fill(dsn: str, args: argparse.Namespace, partitioned: bool) -> None:
+    common.seed_cards(dsn, args.users, Decimal('0'))
+    start = month_start(args.months)
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        if partitioned:
+            cursor.execute('SELECT transactions_create_partitions(%s, LOCALTIMESTAMP)', (start,))
+        cursor.execute('SELECT EXTRACT(EPOCH FROM LOCALTIMESTAMP - %s)', (start,))
+        span = float(cursor.fetchone()[0])
+        for first in range(0, args.rows, BATCH_ROWS):
+            cursor.execute(
+                """INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status, created_at)
+                   SELECT g %% %s + 1, g %% %s + 1,
+                          CASE WHEN g %% 2 = 0 THEN 'incoming' ELSE 'outgoing' END,
+                          (g %% 100000) / 100.0 + 1,
+                          'bench',
+                          'completed',
+                          %s + (g * %s / %s) * INTERVAL '1 second'
+                   FROM generate_series(%s, %s) g""",
+                (args.users, args.users, start, span, args.rows, first, min(first + BATCH_ROWS, args.rows) - 1)
+            )
+            conn.commit()
+            print(f'{"partitioned" if partitioned else "heap"}: {min(first + BATCH_ROWS, args.rows)} rows',
+                  file=sys.stderr)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute('VACUUM ANALYZE transactions')
+    conn.close()
+
+
+def best_ms(fn: Callable[[], Any], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def page(conn: Any, partitioned: bool, params: Dict[str, Any], limit: int) -> List[Any]:
+    if partitioned:
+        rows = history.fetch_page(conn, 1, {**params, 'limit': limit})['rows']
+        conn.rollback()
+        return rows
+    extra: List[str] = []
+    values: List[Any] = [1]
+    if params.get('from_date'):
+        extra.append('AND t.created_at >= %s')
+        values.append(params['from_date'])
+    if params.get('to_date'):
+        extra.append('AND t.created_at < %s')
+        values.append(params['to_date'])
+    if params.get('cursor'):
+        created_at, transaction_id = history.decode_cursor(params['cursor'])
+        extra.append('AND (t.created_at, t.id) < (%s, %s)')
+        values.extend([created_at, transaction_id])
+    with conn.cursor() as cursor:
+        cursor.execute(LEGACY_PAGE_SQL.format(extra=' '.join(extra)), values + [limit + 1])
+        rows = cursor.fetchall()
+    conn.rollback()
+    return rows
+
+
+def measure(dsn: str, args: argparse.Namespace, partitioned: bool) -> Dict[str, Any]:
+    conn = psycopg2.connect(dsn)
+    cursor = conn.cursor()
+    cursor.execute(
+        'SELECT created_at, id FROM transactions WHERE user_id = 1 AND created_at < %s ORDER BY created_at DESC, id DESC LIMIT 1',
+        (month_start(18),)
+    )
+    deep = cursor.fetchone()
+    deep_cursor = history.encode_cursor(deep[0], deep[1])
+    conn.rollback()
+
+    year_ago = {'from_date': month_start(12).isoformat(), 'to_date': month_start(11).isoformat()}
+
+    def month_scan() -> None:
+        cursor.execute(
+            """SELECT transaction_type, COUNT(*), SUM(amount) FROM transactions
+               WHERE created_at >= %s AND created_at < %s
+               GROUP BY transaction_type""",
+            (month_start(1), month_start(0))
+        )
+        cursor.fetchall()
+        conn.rollback()
+
+    def drop_month() -> None:
+        if partitioned:
+            cursor.execute('SELECT transactions_detach_partitions(%s)', (month_start(args.months - 1),))
+        else:
+            cursor.execute('DELETE FROM transactions WHERE created_at < %s', (month_start(args.months - 1),))
+        conn.rollback()
+
+    result = {
+        'schema': 'partitioned' if partitioned else 'heap',
+        'rows': args.rows,
+        'first_page_ms': best_ms(lambda: page(conn, partitioned, {}, args.page_size), args.repeat),
+        'month_page_ms': best_ms(lambda: page(conn, partitioned, year_ago, args.page_size), args.repeat),
+        'deep_page_ms': best_ms(lambda: page(conn, partitioned, {'cursor': deep_cursor}, args.page_size), args.repeat),
+        'month_scan_ms': best_ms(month_scan, args.repeat),
+        'drop_month_ms': best_ms(drop_month, 1),
+    }
+    cursor.execute(
+        """SELECT COALESCE(SUM(pg_total_relation_size(c.oid)), 0)
+           FROM pg_class c
+           WHERE c.relkind = 'r' AND c.relname ~ '^transactions(_\\d{4}_\\d{2}|_default)?$'"""
+    )
+    result['size_mb'] = cursor.fetchone()[0] / 1024 / 1024
+    conn.close()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50_000_000)
+    parser.add_argument('--months', type=int, default=36, help='months of history the rows are spread over')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    table = []
+    for partitioned, until in ((False, 'V0011'), (True, None)):
+        common.prepare_database(dsn, until)
+        fill(dsn, args, partitioned)
+        table.append(measure(dsn, args, partitioned))
+    common.print_table(table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+'''
+Business: Compare N single transfers with one N-item transfer_batch call
+Both paths go through the cards handler with a warm connection pool, so the
+difference is invocations, statements and commits per payout.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/transfer_batch.py --recipients 10000
+'''
+import argparse
+import json
+import os
+import time
+from decimal import Decimal
+
+import psycopg2
+
+import common
+
+common.use_function('cards')
+import index  # noqa: E402
+
+
+def check(dsn: str, expected_total: Decimal) -> bool:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT SUM(balance), MIN(balance) FROM cards')
+        total, lowest = cursor.fetchone()
+    conn.close()
+    return total == expected_total and lowest >= 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recipients', type=int, default=10000)
+    parser.add_argument('--amount', default='12.34')
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    common.prepare_database(dsn)
+
+    amount = Decimal(args.amount)
+    payer_balance = amount * args.recipients * 2
+    cards = args.recipients + 1
+    items = []
+    for card_id in range(2, cards + 1):
+        if card_id % 2:
+            items.append({'to_identifier': '+7900' + str(card_id).zfill(7), 'amount': args.amount})
+        else:
+            items.append({'to_identifier': common.card_number(card_id), 'amount': args.amount})
+    headers = {'X-User-Id': '1'}
+    rows = []
+
+    common.seed_cards(dsn, cards, Decimal('0'))
+    _fund_payer(dsn, payer_balance)
+    started = time.perf_counter()
+    failed = 0
+    for item in items:
+        event = common.make_event('POST', dict(item, action='transfer', from_card_id=1), headers)
+        if index.handler(event, common.Context())['statusCode'] != 200:
+            failed += 1
+    elapsed = time.perf_counter() - started
+    rows.append({
+        'mode': 'single x%d' % len(items),
+        'seconds': elapsed,
+        'payouts_per_s': len(items) / elapsed,
+        'failed': failed,
+        'conserved': check(dsn, payer_balance),
+    })
+
+    common.seed_cards(dsn, cards, Decimal('0'))
+    _fund_payer(dsn, payer_balance)
+    started = time.perf_counter()
+    event = common.make_event('POST', {'action': 'transfer_batch', 'from_card_id': 1, 'items': items}, headers)
+    response = index.handler(event, common.Context())
+    elapsed = time.perf_counter() - started
+    body = json.loads(response['body'])
+    rows.append({
+        'mode': 'batch x%d' % len(items),
+        'seconds': elapsed,
+        'payouts_per_s': len(items) / elapsed,
+        'failed': body.get('failed', len(items)),
+        'conserved': check(dsn, payer_balance),
+    })
+
+    common.print_table(rows)
+    print('speed-up: %.1fx' % (rows[0]['seconds'] / rows[1]['seconds']))
+
+
+def _fund_payer(dsn: str, balance: Decimal) -> None:
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('UPDATE cards SET balance = %s WHERE id = 1', (balance,))
+    conn.commit()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+'''
+Business: Synchronous transfers versus the async queue with group-commit workers
+Replays the same plan of card-to-card transfers, a share of them paying a
+handful of hot merchant cards, through the cards handler twice: once with
+the default synchronous path (one transaction and one commit per transfer,
+each locking the merchant card) and once with "async": true, where the
+handler only enqueues and transfer_worker threads apply the queue in
+batches. Reports request latency, end-to-end throughput (until the queue is
+empty), commits per transfer, and checks that money was conserved and the
+ledger reconciles.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/transfer_queue.py --transfers 5000 --concurrency 16
+'''
+import argparse
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from typing import Any, Dict, List, Tuple
+
+import psycopg2
+
+import common
+
+common.use_function('cards')
+
+
+def plan_transfers(args: argparse.Namespace) -> List[Tuple[int, int]]:
+    rng = random.Random(args.seed)
+    payers = range(1, args.cards - args.merchants + 1)
+    merchants = range(args.cards - args.merchants + 1, args.cards + 1)
+    plan = []
+    for _ in range(args.transfers):
+        source = rng.choice(payers)
+        target = rng.choice(merchants) if rng.random() < args.hot_ratio else rng.choice(payers)
+        if target == source:
+            target = source % (args.cards - args.merchants) + 1
+        plan.append((source, target))
+    return plan
+
+
+def run(dsn: str, mode: str, plan: List[Tuple[int, int]], args: argparse.Namespace) -> Dict[str, Any]:
+    import index
+    import transfer_worker
+
+    initial = Decimal(args.balance)
+    common.seed_cards(dsn, args.cards, initial)
+    async_mode = mode == 'async'
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    lock = threading.Lock()
+
+    def send(transfer: Tuple[int, int]) -> None:
+        source, target = transfer
+        event = common.make_event('POST', {
+            'action': 'transfer',
+            'from_card_id': source,
+            'to_identifier': common.card_number(target),
+            'amount': args.amount,
+            'async': async_mode,
+        }, {'X-User-Id': str(source)})
+        started = time.perf_counter()
+        status = index.handler(event, common.Context())['statusCode']
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    stop = threading.Event()
+    totals: List[Dict[str, int]] = []
+    workers = []
+    if async_mode:
+        def drain() -> None:
+            totals.append(transfer_worker.run(dsn, args.batch_size, idle_sleep=0.005, stop=stop))
+
+        workers = [threading.Thread(target=drain) for _ in range(args.workers)]
+        for thread in workers:
+            thread.start()
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(send, plan))
+    accepted = time.perf_counter() - started
+    with conn.cursor() as cursor:
+        while async_mode:
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM transfer_queue)')
+            if not cursor.fetchone()[0]:
+                break
+            time.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for thread in workers:
+        thread.join()
+
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT COALESCE(SUM(balance), 0), COALESCE(MIN(balance), 0) FROM cards')
+        total, lowest = cursor.fetchone()
+        cursor.execute("SELECT COUNT(*) FROM transactions WHERE transaction_type = 'outgoing' AND status = 'completed'")
+        completed = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM ledger_reconcile(INTERVAL '0')")
+        problems = cursor.fetchone()[0]
+    conn.close()
+
+    batches = sum(worker['batches'] for worker in totals)
+    commits = len(plan) + batches
+    latency = common.percentiles(latencies)
+    return {
+        'mode': mode,
+        'transfers': len(plan),
+        'completed': completed,
+        'statuses': ','.join(f'{status}x{count}' for status, count in sorted(statuses.items())),
+        'p50_ms': latency['p50'],
+        'p95_ms': latency['p95'],
+        'accept_per_s': len(plan) / accepted,
+        'settled_per_s': completed / elapsed,
+        'commits': commits,
+        'transfers_per_batch': completed / batches if batches else 1.0,
+        'conserved': total == initial * args.cards and lowest >= 0,
+        'reconciled': problems == 0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transfers', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=16, help='parallel handler invocations')
+    parser.add_argument('--workers', type=int, default=2, help='transfer_worker threads in async mode')
+    parser.add_argument('--batch-size', type=int, default=500, help='transfers per worker commit')
+    parser.add_argument('--cards', type=int, default=2000)
+    parser.add_argument('--merchants', type=int, default=5, help='hot recipient cards')
+    parser.add_argument('--hot-ratio', type=float, default=0.8, help='share of transfers paying a merchant')
+    parser.add_argument('--balance', default='100000.00')
+    parser.add_argument('--amount', default='1.00')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    os.environ['DATABASE_URL'] = dsn
+    os.environ['DB_POOL_MAX_SIZE'] = str(args.concurrency + args.workers)
+    common.prepare_database(dsn)
+
+    plan = plan_transfers(args)
+    rows = [run(dsn, mode, plan, args) for mode in ('sync', 'async')]
+    common.print_table(rows)
+
+    if not all(row['conserved'] and row['reconciled'] and row['completed'] == len(plan) for row in rows):
+        raise SystemExit('a transfer mode lost money or left transfers unsettled')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+'''
+Business: Concurrency stress benchmark for card-to-card transfers
+Runs thousands of parallel transfers with the legacy multi-statement sequence
+and with transfer_funds(), then checks that money was conserved and no card
+went negative.
+
+Usage: BENCH_DATABASE_URL=postgresql://... python benchmarks/transfer_stress.py --transfers 5000 --threads 32
+'''
+import argparse
+import random
+import threading
+import time
+from decimal import Decimal
+from typing import Any, Callable, Dict
+
+import psycopg2
+
+import common
+
+common.use_function('cards')
+import transfers  # noqa: E402
+
+
+def legacy_transfer(conn: Any, user_id: int, from_card_id: int, to_card_id: int, amount: Decimal) -> str:
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT balance, masked_number FROM cards WHERE id = %s AND user_id = %s AND status = 'active'",
+            (from_card_id, user_id)
+        )
+        from_card = cursor.fetchone()
+        if not from_card or float(from_card[0]) < float(amount):
+            conn.rollback()
+            return 'insufficient_funds'
+        cursor.execute("SELECT id, user_id FROM cards WHERE id = %s AND status = 'active' LIMIT 1", (to_card_id,))
+        to_card = cursor.fetchone()
+        cursor.execute("UPDATE cards SET balance = balance - %s WHERE id = %s", (float(amount), from_card_id))
+        cursor.execute("UPDATE cards SET balance = balance + %s WHERE id = %s", (float(amount), to_card[0]))
+        cursor.execute(
+            """INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+               VALUES (%s, %s, 'outgoing', %s, %s, 'completed')""",
+            (from_card_id, user_id, float(amount), str(to_card_id))
+        )
+        cursor.execute(
+            """INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+               VALUES (%s, %s, 'incoming', %s, %s, 'completed')""",
+            (to_card[0], to_card[1], float(amount), from_card[1])
+        )
+    conn.commit()
+    return 'completed'
+
+
+def engine_transfer(conn: Any, user_id: int, from_card_id: int, to_card_id: int, amount: Decimal) -> str:
+    with conn.cursor() as cursor:
+        outcome = transfers.execute_transfer(cursor, user_id, from_card_id, to_card_id, amount, str(to_card_id))
+    if outcome['result'] == 'completed':
+        conn.commit()
+    else:
+        conn.rollback()
+    return outcome['result']
+
+
+def run(dsn: str, name: str, transfer: Callable[..., str], args: argparse.Namespace) -> Dict[str, Any]:
+    initial = Decimal(args.balance)
+    card_ids = common.seed_cards(dsn, args.cards, initial)
+    rng = random.Random(args.seed)
+    hot = card_ids[:max(1, args.cards // 100)]
+    plan = []
+    for _ in range(args.transfers):
+        source = rng.choice(card_ids)
+        target = rng.choice(hot) if rng.random() < args.hot_ratio else rng.choice(card_ids)
+        if target == source:
+            target = card_ids[(card_ids.index(source) + 1) % len(card_ids)]
+        amount = Decimal(rng.randint(1, int(initial * 100) // 4)) / 100
+        plan.append((source, target, amount))
+
+    results: Dict[str, int] = {}
+    lock = threading.Lock()
+    cursor_position = [0]
+
+    def worker() -> None:
+        conn = psycopg2.connect(dsn)
+        while True:
+            with lock:
+                index = cursor_position[0]
+                cursor_position[0] += 1
+            if index >= len(plan):
+                break
+            source, target, amount = plan[index]
+            try:
+                result = transfer(conn, source, source, target, amount)
+            except psycopg2.errors.DeadlockDetected:
+                conn.rollback()
+                result = 'deadlock'
+            except psycopg2.Error:
+                conn.rollback()
+                result = 'error'
+            with lock:
+                results[result] = results.get(result, 0) + 1
+        conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT COALESCE(SUM(balance), 0), COALESCE(MIN(balance), 0) FROM cards')
+        total, lowest = cursor.fetchone()
+        cursor.execute('SELECT COUNT(*) FROM transactions')
+        rows = cursor.fetchone()[0]
+    conn.close()
+
+    completed = results.get('completed', 0)
+    return {
+        'engine': name,
+        'transfers': args.transfers,
+        'completed': completed,
+        'rejected': results.get('insufficient_funds', 0),
+        'deadlocks': results.get('deadlock', 0),
+        'errors': results.get('error', 0),
+        'tps': completed / elapsed if elapsed else 0.0,
+        'conserved': total == initial * args.cards,
+        'non_negative': lowest >= 0,
+        'ledger_rows_ok': rows == completed * 2,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--transfers', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--cards', type=int, default=200)
+    parser.add_argument('--balance', default='1000.00')
+    parser.add_argument('--hot-ratio', type=float, default=0.3, help='share of transfers aimed at the hottest 1%% of cards')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-legacy', action='store_true')
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    common.prepare_database(dsn)
+
+    rows = []
+    if not args.skip_legacy:
+        rows.append(run(dsn, 'legacy', legacy_transfer, args))
+    rows.append(run(dsn, 'transfer_funds', engine_transfer, args))
+    common.print_table(rows)
+
+    engine = rows[-1]
+    if not (engine['conserved'] and engine['non_negative'] and engine['ledger_rows_ok'] and engine['deadlocks'] == 0):
+        raise SystemExit('transfer_funds violated an invariant')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+-- Перевод между картами за один вызов: проверка баланса, списание, зачисление
+-- и две записи в transactions выполняются на стороне сервера.
+-- Строки карт блокируются в порядке возрастания id, поэтому встречные
+-- переводы не могут попасть во взаимную блокировку.
+CREATE OR REPLACE FUNCTION transfer_funds(
+    p_user_id INTEGER,
+    p_from_card_id INTEGER,
+    p_to_card_id INTEGER,
+    p_amount DECIMAL(15, 2),
+    p_recipient VARCHAR(255)
+) RETURNS TABLE (
+    result VARCHAR(32),
+    from_balance DECIMAL(15, 2),
+    outgoing_id INTEGER,
+    incoming_id INTEGER
+) AS $$
+DECLARE
+    v_from cards%ROWTYPE;
+    v_to cards%ROWTYPE;
+BEGIN
+    IF p_amount IS NULL OR p_amount <= 0 THEN
+        RETURN QUERY SELECT 'invalid_amount'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    IF p_from_card_id = p_to_card_id THEN
+        RETURN QUERY SELECT 'same_card'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    PERFORM 1 FROM cards
+    WHERE id IN (p_from_card_id, p_to_card_id)
+    ORDER BY id
+    FOR UPDATE;
+
+    SELECT * INTO v_from FROM cards WHERE id = p_from_card_id;
+    IF NOT FOUND OR v_from.user_id <> p_user_id OR v_from.status <> 'active' THEN
+        RETURN QUERY SELECT 'invalid_card'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    IF v_from.balance < p_amount THEN
+        RETURN QUERY SELECT 'insufficient_funds'::VARCHAR(32), v_from.balance, NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    SELECT * INTO v_to FROM cards WHERE id = p_to_card_id;
+    IF NOT FOUND OR v_to.status <> 'active' THEN
+        RETURN QUERY SELECT 'recipient_not_found'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    UPDATE cards
+    SET balance = balance + CASE WHEN id = p_from_card_id THEN -p_amount ELSE p_amount END,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id IN (p_from_card_id, p_to_card_id);
+
+    INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+    VALUES (p_from_card_id, p_user_id, 'outgoing', p_amount, p_recipient, 'completed')
+    RETURNING id INTO outgoing_id;
+
+    INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+    VALUES (p_to_card_id, v_to.user_id, 'incoming', p_amount, v_from.masked_number, 'completed')
+    RETURNING id INTO incoming_id;
+
+    result := 'completed';
+    from_balance := v_from.balance - p_amount;
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,13 @@
+-- Составные индексы для постраничной выдачи истории по ключу (created_at, id).
+-- Они покрывают прежние одноколоночные индексы по user_id и card_id.
+CREATE INDEX IF NOT EXISTS idx_transactions_user_created
+    ON transactions (user_id, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_card_created
+    ON transactions (card_id, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_user_type_created
+    ON transactions (user_id, transaction_type, created_at DESC, id DESC);
+
+DROP INDEX IF EXISTS idx_transactions_user_id;
+DROP INDEX IF EXISTS idx_transactions_card_id;
@@ -0,0 +1,15 @@
+-- Индексы для постраничных админских списков по ключу (created_at, id)
+CREATE INDEX IF NOT EXISTS idx_users_created
+    ON users (created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_card_requests_created
+    ON card_requests (created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_card_requests_status_created
+    ON card_requests (status, created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_cards_created
+    ON cards (created_at DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS idx_cards_status_created
+    ON cards (status, created_at DESC, id DESC);
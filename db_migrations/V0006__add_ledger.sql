@@ -0,0 +1,248 @@
+-- Журнал двойной записи: каждое движение денег добавляет проводку из записей,
+-- сумма которых равна нулю. card_id = NULL означает внешний счёт банка
+-- (пополнения и начальные остатки). cards.balance остаётся материализованным
+-- балансом, а ledger_seq — номером последней записи по карте.
+ALTER TABLE cards ADD COLUMN IF NOT EXISTS ledger_seq BIGINT NOT NULL DEFAULT 0;
+
+CREATE SEQUENCE IF NOT EXISTS ledger_posting_id_seq;
+
+CREATE TABLE IF NOT EXISTS ledger_entries (
+    id BIGSERIAL PRIMARY KEY,
+    posting_id BIGINT NOT NULL,
+    card_id INTEGER REFERENCES cards(id),
+    card_seq BIGINT,
+    amount DECIMAL(15, 2) NOT NULL,
+    entry_type VARCHAR(20) NOT NULL CHECK (entry_type IN ('opening', 'transfer', 'adjustment')),
+    transaction_id INTEGER REFERENCES transactions(id),
+    created_at TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_ledger_entries_card_seq ON ledger_entries (card_id, card_seq);
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_posting ON ledger_entries (posting_id);
+
+-- Снимки баланса карты через каждые ledger_snapshot_interval() записей
+CREATE TABLE IF NOT EXISTS ledger_snapshots (
+    card_id INTEGER NOT NULL REFERENCES cards(id),
+    ledger_seq BIGINT NOT NULL,
+    last_entry_id BIGINT NOT NULL,
+    balance DECIMAL(15, 2) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT clock_timestamp(),
+    PRIMARY KEY (card_id, ledger_seq)
+);
+
+-- Отметка, до какой записи журнал уже сверен с cards.balance
+CREATE TABLE IF NOT EXISTS ledger_reconciliation (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    last_entry_id BIGINT NOT NULL DEFAULT 0,
+    checked_at TIMESTAMP
+);
+INSERT INTO ledger_reconciliation (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION ledger_snapshot_interval() RETURNS INTEGER AS $$
+    SELECT 100;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Проводит набор записей: обновляет cards.balance и ledger_seq, добавляет записи
+-- в журнал и снимки. Записи с одинаковым ключом проводки образуют одну проводку.
+-- Вызывающий код должен заранее заблокировать карты в порядке возрастания id.
+CREATE OR REPLACE FUNCTION ledger_apply(
+    p_posting_keys INTEGER[],
+    p_card_ids INTEGER[],
+    p_amounts DECIMAL(15, 2)[],
+    p_entry_type VARCHAR(20),
+    p_transaction_ids INTEGER[]
+) RETURNS VOID AS $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM unnest(p_posting_keys, p_amounts) AS x(posting_key, amount)
+        GROUP BY posting_key
+        HAVING SUM(amount) <> 0
+    ) THEN
+        RAISE EXCEPTION 'Unbalanced ledger posting';
+    END IF;
+
+    WITH e AS (
+        SELECT * FROM unnest(p_posting_keys, p_card_ids, p_amounts, p_transaction_ids)
+            WITH ORDINALITY AS e(posting_key, card_id, amount, transaction_id, ord)
+    ), postings AS (
+        SELECT posting_key, nextval('ledger_posting_id_seq') AS posting_id
+        FROM (SELECT DISTINCT posting_key FROM e) k
+    ), agg AS (
+        SELECT card_id, SUM(amount) AS delta, COUNT(*) AS n
+        FROM e WHERE card_id IS NOT NULL
+        GROUP BY card_id
+    ), upd AS (
+        UPDATE cards c
+        SET balance = c.balance + agg.delta,
+            ledger_seq = c.ledger_seq + agg.n,
+            updated_at = CURRENT_TIMESTAMP
+        FROM agg
+        WHERE c.id = agg.card_id
+        RETURNING c.id, c.balance, c.ledger_seq, agg.n
+    ), ins AS (
+        INSERT INTO ledger_entries (posting_id, card_id, card_seq, amount, entry_type, transaction_id)
+        SELECT p.posting_id,
+               e.card_id,
+               CASE WHEN e.card_id IS NULL THEN NULL
+                    ELSE upd.ledger_seq - upd.n + ROW_NUMBER() OVER (PARTITION BY e.card_id ORDER BY e.ord)
+               END,
+               e.amount,
+               p_entry_type,
+               e.transaction_id
+        FROM e
+        JOIN postings p ON p.posting_key = e.posting_key
+        LEFT JOIN upd ON upd.id = e.card_id
+        ORDER BY e.ord
+        RETURNING id, card_id
+    )
+    INSERT INTO ledger_snapshots (card_id, ledger_seq, last_entry_id, balance)
+    SELECT upd.id, upd.ledger_seq, (SELECT MAX(ins.id) FROM ins WHERE ins.card_id = upd.id), upd.balance
+    FROM upd
+    WHERE upd.ledger_seq / ledger_snapshot_interval() > (upd.ledger_seq - upd.n) / ledger_snapshot_interval();
+END;
+$$ LANGUAGE plpgsql;
+
+-- Баланс карты по журналу: последний снимок плюс короткий хвост записей
+CREATE OR REPLACE FUNCTION card_balance_at(p_card_id INTEGER, p_at TIMESTAMP DEFAULT NULL)
+RETURNS DECIMAL(15, 2) AS $$
+    WITH s AS (
+        SELECT ledger_seq, balance FROM ledger_snapshots
+        WHERE card_id = p_card_id AND (p_at IS NULL OR created_at <= p_at)
+        ORDER BY ledger_seq DESC
+        LIMIT 1
+    )
+    SELECT COALESCE((SELECT balance FROM s), 0) + COALESCE((
+        SELECT SUM(amount) FROM ledger_entries
+        WHERE card_id = p_card_id
+          AND card_seq > COALESCE((SELECT ledger_seq FROM s), 0)
+          AND (p_at IS NULL OR created_at <= p_at)
+    ), 0);
+$$ LANGUAGE sql STABLE;
+
+-- Инкрементальная сверка: проверяет только карты и проводки, затронутые
+-- записями после прошлой отметки. Отметка сдвигается лишь до записей старше
+-- p_grace, чтобы не пропустить ещё не зафиксированные транзакции.
+CREATE OR REPLACE FUNCTION ledger_reconcile(p_grace INTERVAL DEFAULT INTERVAL '1 minute')
+RETURNS TABLE (
+    problem VARCHAR(32),
+    card_id INTEGER,
+    posting_id BIGINT,
+    card_balance DECIMAL(15, 2),
+    ledger_balance DECIMAL(15, 2)
+) AS $$
+DECLARE
+    v_from BIGINT;
+    v_to BIGINT;
+BEGIN
+    SELECT r.last_entry_id INTO v_from FROM ledger_reconciliation r FOR UPDATE;
+
+    SELECT COALESCE(MAX(l.id), v_from) INTO v_to
+    FROM ledger_entries l
+    WHERE l.id > v_from AND l.created_at < clock_timestamp() - p_grace;
+
+    RETURN QUERY
+    WITH fresh AS (
+        SELECT l.card_id, l.posting_id FROM ledger_entries l WHERE l.id > v_from
+    ), cards_touched AS (
+        SELECT DISTINCT f.card_id FROM fresh f WHERE f.card_id IS NOT NULL
+    ), postings_touched AS (
+        SELECT DISTINCT f.posting_id FROM fresh f
+    )
+    SELECT 'balance_mismatch'::VARCHAR(32), c.id, NULL::BIGINT, c.balance, card_balance_at(c.id)
+    FROM cards c
+    JOIN cards_touched t ON t.card_id = c.id
+    WHERE c.balance <> card_balance_at(c.id)
+    UNION ALL
+    SELECT 'unbalanced_posting'::VARCHAR(32), NULL::INTEGER, l.posting_id, NULL::DECIMAL(15, 2), SUM(l.amount)
+    FROM ledger_entries l
+    WHERE l.posting_id IN (SELECT p.posting_id FROM postings_touched p)
+    GROUP BY l.posting_id
+    HAVING SUM(l.amount) <> 0;
+
+    UPDATE ledger_reconciliation SET last_entry_id = v_to, checked_at = CURRENT_TIMESTAMP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Начальные остатки существующих карт
+WITH opening AS (
+    SELECT id, balance, nextval('ledger_posting_id_seq') AS posting_id
+    FROM cards
+    WHERE balance <> 0 AND ledger_seq = 0
+)
+INSERT INTO ledger_entries (posting_id, card_id, card_seq, amount, entry_type)
+SELECT posting_id, id, 1, balance, 'opening' FROM opening
+UNION ALL
+SELECT posting_id, NULL, NULL, -balance, 'opening' FROM opening;
+
+UPDATE cards SET ledger_seq = 1 WHERE balance <> 0 AND ledger_seq = 0;
+
+-- Перевод теперь проводится через журнал
+CREATE OR REPLACE FUNCTION transfer_funds(
+    p_user_id INTEGER,
+    p_from_card_id INTEGER,
+    p_to_card_id INTEGER,
+    p_amount DECIMAL(15, 2),
+    p_recipient VARCHAR(255)
+) RETURNS TABLE (
+    result VARCHAR(32),
+    from_balance DECIMAL(15, 2),
+    outgoing_id INTEGER,
+    incoming_id INTEGER
+) AS $$
+DECLARE
+    v_from cards%ROWTYPE;
+    v_to cards%ROWTYPE;
+BEGIN
+    IF p_amount IS NULL OR p_amount <= 0 THEN
+        RETURN QUERY SELECT 'invalid_amount'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    IF p_from_card_id = p_to_card_id THEN
+        RETURN QUERY SELECT 'same_card'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    PERFORM 1 FROM cards
+    WHERE id IN (p_from_card_id, p_to_card_id)
+    ORDER BY id
+    FOR UPDATE;
+
+    SELECT * INTO v_from FROM cards WHERE id = p_from_card_id;
+    IF NOT FOUND OR v_from.user_id <> p_user_id OR v_from.status <> 'active' THEN
+        RETURN QUERY SELECT 'invalid_card'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    IF v_from.balance < p_amount THEN
+        RETURN QUERY SELECT 'insufficient_funds'::VARCHAR(32), v_from.balance, NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    SELECT * INTO v_to FROM cards WHERE id = p_to_card_id;
+    IF NOT FOUND OR v_to.status <> 'active' THEN
+        RETURN QUERY SELECT 'recipient_not_found'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+    VALUES (p_from_card_id, p_user_id, 'outgoing', p_amount, p_recipient, 'completed')
+    RETURNING id INTO outgoing_id;
+
+    INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+    VALUES (p_to_card_id, v_to.user_id, 'incoming', p_amount, v_from.masked_number, 'completed')
+    RETURNING id INTO incoming_id;
+
+    PERFORM ledger_apply(
+        ARRAY[0, 0],
+        ARRAY[p_from_card_id, p_to_card_id],
+        ARRAY[-p_amount, p_amount]::DECIMAL(15, 2)[],
+        'transfer',
+        ARRAY[outgoing_id, incoming_id]
+    );
+
+    result := 'completed';
+    from_balance := v_from.balance - p_amount;
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,3 @@
+-- Номер карты уникален: массовый выпуск генерирует номера на сервере и
+-- повторяет вставку только для совпавших номеров (ON CONFLICT DO NOTHING)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_cards_card_number ON cards (card_number);
@@ -0,0 +1,22 @@
+-- Номер карты без пробелов, точек маски и дефисов — так его ищет перевод
+CREATE OR REPLACE FUNCTION normalize_card_number(p_card_number TEXT) RETURNS TEXT AS $$
+    SELECT regexp_replace(p_card_number, '[^0-9]', '', 'g');
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+-- Поиск получателя по номеру карты среди активных карт
+CREATE INDEX IF NOT EXISTS idx_cards_active_normalized_number
+    ON cards (normalize_card_number(card_number))
+    WHERE status = 'active';
+
+-- Телефон в виде '+' и цифр, независимо от того, как его ввели при регистрации
+CREATE OR REPLACE FUNCTION normalize_phone(p_phone TEXT) RETURNS TEXT AS $$
+    SELECT '+' || regexp_replace(p_phone, '[^0-9]', '', 'g');
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+CREATE INDEX IF NOT EXISTS idx_users_normalized_phone
+    ON users (normalize_phone(phone));
+
+-- Основная карта пользователя для перевода по телефону: самая ранняя активная
+CREATE INDEX IF NOT EXISTS idx_cards_active_primary
+    ON cards (user_id, id)
+    WHERE status = 'active';
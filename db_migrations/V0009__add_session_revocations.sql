@@ -0,0 +1,12 @@
+-- Отозванные сессии: token_id — выход из одной сессии, NULL — все токены
+-- пользователя, выпущенные до revoked_at (блокировка). Строку можно удалить
+-- после expires_at: к этому времени отозванные токены истекут сами.
+CREATE TABLE IF NOT EXISTS session_revocations (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    token_id VARCHAR(32),
+    revoked_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_session_revocations_expires ON session_revocations (expires_at);
@@ -0,0 +1,16 @@
+-- Ключи идемпотентности (заголовок Idempotency-Key): scope — действие и id
+-- пользователя, request_hash — отпечаток тела запроса. Строка вставляется в
+-- той же транзакции, что и операция, и хранит её ответ; status_code NULL —
+-- запрос ещё выполняется. Просроченные строки удаляются пачками.
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope VARCHAR(64) NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    request_hash CHAR(64) NOT NULL,
+    status_code INTEGER,
+    response_body TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    expires_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (scope, idempotency_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at);
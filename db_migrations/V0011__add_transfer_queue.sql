@@ -0,0 +1,16 @@
+-- Очередь асинхронных переводов: обработчик добавляет строку вместе с исходящей
+-- транзакцией в статусе pending, воркер забирает пачки (FOR UPDATE SKIP LOCKED),
+-- проводит их одной транзакцией и удаляет строки. Внешних ключей на cards нет,
+-- чтобы постановка в очередь не блокировалась на картах, которые держит воркер.
+CREATE TABLE IF NOT EXISTS transfer_queue (
+    id BIGSERIAL PRIMARY KEY,
+    transaction_id INTEGER NOT NULL REFERENCES transactions(id),
+    user_id INTEGER NOT NULL,
+    from_card_id INTEGER NOT NULL,
+    to_card_id INTEGER NOT NULL,
+    amount DECIMAL(15, 2) NOT NULL CHECK (amount > 0),
+    enqueued_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- Причина отказа для переводов, которые воркер отклонил (status = 'failed')
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS failure_reason VARCHAR(32);
@@ -0,0 +1,197 @@
+-- Таблица transactions секционируется по месяцам created_at. Первичный ключ
+-- секционированной таблицы обязан включать ключ секционирования, поэтому он
+-- становится (id, created_at), а внешние ключи на transactions(id) из
+-- ledger_entries и transfer_queue удаляются (id по-прежнему уникален: его
+-- выдаёт одна последовательность).
+ALTER TABLE ledger_entries DROP CONSTRAINT IF EXISTS ledger_entries_transaction_id_fkey;
+ALTER TABLE transfer_queue DROP CONSTRAINT IF EXISTS transfer_queue_transaction_id_fkey;
+
+ALTER TABLE transactions RENAME TO transactions_unpartitioned;
+ALTER SEQUENCE transactions_id_seq OWNED BY NONE;
+DROP INDEX IF EXISTS idx_transactions_user_created;
+DROP INDEX IF EXISTS idx_transactions_card_created;
+DROP INDEX IF EXISTS idx_transactions_user_type_created;
+
+CREATE TABLE transactions (
+    id INTEGER NOT NULL DEFAULT nextval('transactions_id_seq'),
+    card_id INTEGER NOT NULL REFERENCES cards(id),
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    transaction_type VARCHAR(20) NOT NULL CHECK (transaction_type IN ('incoming', 'outgoing')),
+    amount DECIMAL(15, 2) NOT NULL,
+    recipient VARCHAR(255) NOT NULL,
+    status VARCHAR(20) DEFAULT 'completed' CHECK (status IN ('completed', 'pending', 'failed')),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    failure_reason VARCHAR(32),
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id;
+
+-- Страховка на случай, если месячные секции не созданы заранее
+CREATE TABLE transactions_default PARTITION OF transactions DEFAULT;
+
+CREATE INDEX idx_transactions_user_created ON transactions (user_id, created_at DESC, id DESC);
+CREATE INDEX idx_transactions_card_created ON transactions (card_id, created_at DESC, id DESC);
+CREATE INDEX idx_transactions_user_type_created ON transactions (user_id, transaction_type, created_at DESC, id DESC);
+
+-- Создаёт месячные секции transactions_ГГГГ_ММ для месяцев из [p_from, p_to).
+-- Секция создаётся отдельной таблицей и подключается через ATTACH PARTITION:
+-- в отличие от CREATE TABLE ... PARTITION OF это не блокирует вставки.
+-- Строки этого месяца, попавшие в секцию по умолчанию, переносятся в новую.
+CREATE OR REPLACE FUNCTION transactions_create_partitions(p_from TIMESTAMP, p_to TIMESTAMP)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    v_month TIMESTAMP := date_trunc('month', p_from);
+    v_next TIMESTAMP;
+    v_name TEXT;
+BEGIN
+    WHILE v_month < p_to LOOP
+        v_next := v_month + INTERVAL '1 month';
+        v_name := 'transactions_' || to_char(v_month, 'YYYY_MM');
+        IF to_regclass(v_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I (LIKE transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', v_name
+            );
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM transactions_default WHERE created_at >= %L AND created_at < %L RETURNING *)
+                 INSERT INTO %I SELECT * FROM moved',
+                v_month, v_next, v_name
+            );
+            EXECUTE format(
+                'ALTER TABLE transactions ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                v_name, v_month, v_next
+            );
+            RETURN NEXT v_name;
+        END IF;
+        v_month := v_next;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Секции на текущий месяц и p_months_ahead месяцев вперёд
+CREATE OR REPLACE FUNCTION transactions_ensure_partitions(p_months_ahead INTEGER DEFAULT 3)
+RETURNS SETOF TEXT AS $$
+    SELECT transactions_create_partitions(
+        date_trunc('month', LOCALTIMESTAMP),
+        date_trunc('month', LOCALTIMESTAMP) + make_interval(months => p_months_ahead + 1)
+    );
+$$ LANGUAGE sql;
+
+-- Начало самой старой подключённой месячной секции: нижняя граница, до
+-- которой история имеет смысл искать
+CREATE OR REPLACE FUNCTION transactions_oldest_partition() RETURNS TIMESTAMP AS $$
+    SELECT MIN(to_date(right(c.relname, 7), 'YYYY_MM')::TIMESTAMP)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'transactions'::regclass
+      AND c.relname ~ '^transactions_\d{4}_\d{2}$';
+$$ LANGUAGE sql STABLE;
+
+-- Архив отключённых секций: строки хранятся пачками в JSONB, который TOAST
+-- сжимает (lz4, если сервер собран с ним). jsonb переживает добавление
+-- колонок в transactions, в отличие от текстового представления строки.
+CREATE TABLE IF NOT EXISTS transactions_archive (
+    partition_name VARCHAR(64) NOT NULL,
+    chunk_no INTEGER NOT NULL,
+    row_count INTEGER NOT NULL,
+    first_created_at TIMESTAMP NOT NULL,
+    last_created_at TIMESTAMP NOT NULL,
+    rows JSONB NOT NULL,
+    archived_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (partition_name, chunk_no)
+);
+
+DO $$
+BEGIN
+    ALTER TABLE transactions_archive ALTER COLUMN rows SET COMPRESSION lz4;
+EXCEPTION WHEN feature_not_supported THEN
+    NULL;
+END;
+$$;
+
+-- Отключает месячные секции, целиком лежащие раньше p_before, и
+-- переименовывает их в transactions_detached_ГГГГ_ММ. Отключение берёт
+-- короткую эксклюзивную блокировку родительской таблицы, поэтому само сжатие
+-- выполняется отдельно, в transactions_archive_table().
+CREATE OR REPLACE FUNCTION transactions_detach_partitions(p_before TIMESTAMP)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    v_name TEXT;
+BEGIN
+    FOR v_name IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'transactions'::regclass
+          AND c.relname ~ '^transactions_\d{4}_\d{2}$'
+          AND to_date(right(c.relname, 7), 'YYYY_MM')::TIMESTAMP + INTERVAL '1 month' <= p_before
+        ORDER BY c.relname
+    LOOP
+        EXECUTE format('ALTER TABLE transactions DETACH PARTITION %I', v_name);
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', v_name, replace(v_name, 'transactions_', 'transactions_detached_'));
+        RETURN NEXT replace(v_name, 'transactions_', 'transactions_detached_');
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Отключённые, но ещё не заархивированные секции
+CREATE OR REPLACE FUNCTION transactions_detached_tables() RETURNS SETOF TEXT AS $$
+    SELECT relname::TEXT FROM pg_class
+    WHERE relkind = 'r' AND relname ~ '^transactions_detached_\d{4}_\d{2}$'
+    ORDER BY relname;
+$$ LANGUAGE sql STABLE;
+
+-- Переносит отключённую секцию в transactions_archive пачками по p_chunk_rows
+-- строк и удаляет её. Возвращает число заархивированных строк.
+CREATE OR REPLACE FUNCTION transactions_archive_table(p_name TEXT, p_chunk_rows INTEGER DEFAULT 10000)
+RETURNS BIGINT AS $$
+DECLARE
+    v_partition TEXT := replace(p_name, 'transactions_detached_', 'transactions_');
+    v_rows BIGINT;
+BEGIN
+    EXECUTE format(
+        'INSERT INTO transactions_archive (partition_name, chunk_no, row_count, first_created_at, last_created_at, rows)
+         SELECT %L, chunk_no, COUNT(*), MIN(created_at), MAX(created_at), jsonb_agg(to_jsonb(t) - %L ORDER BY id)
+         FROM (SELECT *, (row_number() OVER (ORDER BY id) - 1) / %s AS chunk_no FROM %I) t
+         GROUP BY chunk_no
+         ON CONFLICT (partition_name, chunk_no) DO NOTHING',
+        v_partition, 'chunk_no', p_chunk_rows, p_name
+    );
+    SELECT COALESCE(SUM(row_count), 0) INTO v_rows FROM transactions_archive WHERE partition_name = v_partition;
+    EXECUTE format('DROP TABLE %I', p_name);
+    RETURN v_rows;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Возвращает заархивированный месяц обратно в transactions
+CREATE OR REPLACE FUNCTION transactions_restore_partition(p_partition TEXT) RETURNS BIGINT AS $$
+DECLARE
+    v_month TIMESTAMP := to_date(right(p_partition, 7), 'YYYY_MM')::TIMESTAMP;
+    v_rows BIGINT;
+BEGIN
+    PERFORM transactions_create_partitions(v_month, v_month + INTERVAL '1 month');
+    INSERT INTO transactions
+    SELECT r.*
+    FROM transactions_archive a
+    CROSS JOIN LATERAL jsonb_populate_recordset(NULL::transactions, a.rows) r
+    WHERE a.partition_name = p_partition;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+    DELETE FROM transactions_archive WHERE partition_name = p_partition;
+    RETURN v_rows;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Секции для уже накопленной истории и трёх месяцев вперёд, затем перенос строк
+SELECT transactions_create_partitions(
+    COALESCE((SELECT MIN(created_at) FROM transactions_unpartitioned), LOCALTIMESTAMP),
+    date_trunc('month', LOCALTIMESTAMP) + INTERVAL '4 months'
+);
+
+INSERT INTO transactions (id, card_id, user_id, transaction_type, amount, recipient, status, created_at, failure_reason)
+SELECT id, card_id, user_id, transaction_type, amount, recipient, status,
+       COALESCE(created_at, CURRENT_TIMESTAMP), failure_reason
+FROM transactions_unpartitioned;
+
+DROP TABLE transactions_unpartitioned;
+
+ANALYZE transactions;
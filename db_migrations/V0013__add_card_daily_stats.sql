@@ -0,0 +1,195 @@
+-- Дневная статистика по картам: суммы и число входящих и исходящих
+-- операций за день и суммы по получателям за день. Таблицы обновляются
+-- в той же транзакции, что и перевод (card_stats_apply), поэтому отчёт за
+-- любой период читает не больше одной строки на карту и день, а не историю.
+-- День операции — дата transactions.created_at; учитываются только
+-- выполненные операции.
+CREATE TABLE IF NOT EXISTS card_daily_stats (
+    card_id INTEGER NOT NULL REFERENCES cards(id),
+    day DATE NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    incoming_amount DECIMAL(15, 2) NOT NULL DEFAULT 0,
+    incoming_count INTEGER NOT NULL DEFAULT 0,
+    outgoing_amount DECIMAL(15, 2) NOT NULL DEFAULT 0,
+    outgoing_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (card_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS idx_card_daily_stats_user_day ON card_daily_stats (user_id, day);
+
+-- Исходящие суммы по получателю (подписи recipient исходящей транзакции)
+CREATE TABLE IF NOT EXISTS card_daily_recipients (
+    card_id INTEGER NOT NULL REFERENCES cards(id),
+    day DATE NOT NULL,
+    recipient VARCHAR(255) NOT NULL,
+    amount DECIMAL(15, 2) NOT NULL DEFAULT 0,
+    transfer_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (card_id, day, recipient)
+);
+
+-- Добавляет выполненные операции в дневную статистику. Массивы описывают
+-- операции построчно; p_days = NULL означает сегодняшний день (created_at
+-- по умолчанию). Вызывающий код уже держит блокировки карт, поэтому строки
+-- статистики одной карты не обновляются конкурентно.
+CREATE OR REPLACE FUNCTION card_stats_apply(
+    p_card_ids INTEGER[],
+    p_user_ids INTEGER[],
+    p_types VARCHAR(20)[],
+    p_amounts DECIMAL(15, 2)[],
+    p_recipients VARCHAR(255)[],
+    p_days DATE[] DEFAULT NULL
+) RETURNS VOID AS $$
+BEGIN
+    WITH r AS (
+        SELECT card_id, user_id, transaction_type, amount, recipient, COALESCE(day, CURRENT_DATE) AS day
+        FROM unnest(p_card_ids, p_user_ids, p_types, p_amounts, p_recipients, p_days)
+            AS r(card_id, user_id, transaction_type, amount, recipient, day)
+        WHERE card_id IS NOT NULL
+    ), per_day AS (
+        INSERT INTO card_daily_stats AS s (card_id, day, user_id, incoming_amount, incoming_count, outgoing_amount, outgoing_count)
+        SELECT card_id, day, MIN(user_id),
+               COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'incoming'), 0),
+               COUNT(*) FILTER (WHERE transaction_type = 'incoming'),
+               COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'outgoing'), 0),
+               COUNT(*) FILTER (WHERE transaction_type = 'outgoing')
+        FROM r
+        GROUP BY card_id, day
+        ORDER BY card_id, day
+        ON CONFLICT (card_id, day) DO UPDATE
+        SET incoming_amount = s.incoming_amount + EXCLUDED.incoming_amount,
+            incoming_count = s.incoming_count + EXCLUDED.incoming_count,
+            outgoing_amount = s.outgoing_amount + EXCLUDED.outgoing_amount,
+            outgoing_count = s.outgoing_count + EXCLUDED.outgoing_count
+    )
+    INSERT INTO card_daily_recipients AS d (card_id, day, recipient, amount, transfer_count)
+    SELECT card_id, day, recipient, SUM(amount), COUNT(*)
+    FROM r
+    WHERE transaction_type = 'outgoing'
+    GROUP BY card_id, day, recipient
+    ORDER BY card_id, day, recipient
+    ON CONFLICT (card_id, day, recipient) DO UPDATE
+    SET amount = d.amount + EXCLUDED.amount,
+        transfer_count = d.transfer_count + EXCLUDED.transfer_count;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Пересчитывает статистику за дни [p_from, p_to] из transactions (догрузка
+-- истории, исправления). Блокировка SHARE ROW EXCLUSIVE ждёт завершения
+-- переводов, уже обновивших статистику, и не даёт начаться новым до конца
+-- транзакции, так что пересчёт не теряет их суммы. Вызывайте короткими
+-- диапазонами и фиксируйте каждый. Возвращает число строк card_daily_stats.
+CREATE OR REPLACE FUNCTION card_stats_rebuild(p_from DATE, p_to DATE) RETURNS BIGINT AS $$
+DECLARE
+    v_rows BIGINT;
+BEGIN
+    LOCK TABLE card_daily_stats, card_daily_recipients IN SHARE ROW EXCLUSIVE MODE;
+
+    DELETE FROM card_daily_stats WHERE day BETWEEN p_from AND p_to;
+    DELETE FROM card_daily_recipients WHERE day BETWEEN p_from AND p_to;
+
+    INSERT INTO card_daily_stats (card_id, day, user_id, incoming_amount, incoming_count, outgoing_amount, outgoing_count)
+    SELECT card_id, created_at::DATE, MIN(user_id),
+           COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'incoming'), 0),
+           COUNT(*) FILTER (WHERE transaction_type = 'incoming'),
+           COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'outgoing'), 0),
+           COUNT(*) FILTER (WHERE transaction_type = 'outgoing')
+    FROM transactions
+    WHERE created_at >= p_from AND created_at < p_to + 1 AND status = 'completed'
+    GROUP BY card_id, created_at::DATE;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+
+    INSERT INTO card_daily_recipients (card_id, day, recipient, amount, transfer_count)
+    SELECT card_id, created_at::DATE, recipient, SUM(amount), COUNT(*)
+    FROM transactions
+    WHERE created_at >= p_from AND created_at < p_to + 1 AND status = 'completed'
+      AND transaction_type = 'outgoing'
+    GROUP BY card_id, created_at::DATE, recipient;
+
+    RETURN v_rows;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Выполненный перевод сразу попадает в дневную статистику
+CREATE OR REPLACE FUNCTION transfer_funds(
+    p_user_id INTEGER,
+    p_from_card_id INTEGER,
+    p_to_card_id INTEGER,
+    p_amount DECIMAL(15, 2),
+    p_recipient VARCHAR(255)
+) RETURNS TABLE (
+    result VARCHAR(32),
+    from_balance DECIMAL(15, 2),
+    outgoing_id INTEGER,
+    incoming_id INTEGER
+) AS $$
+DECLARE
+    v_from cards%ROWTYPE;
+    v_to cards%ROWTYPE;
+BEGIN
+    IF p_amount IS NULL OR p_amount <= 0 THEN
+        RETURN QUERY SELECT 'invalid_amount'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    IF p_from_card_id = p_to_card_id THEN
+        RETURN QUERY SELECT 'same_card'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    PERFORM 1 FROM cards
+    WHERE id IN (p_from_card_id, p_to_card_id)
+    ORDER BY id
+    FOR UPDATE;
+
+    SELECT * INTO v_from FROM cards WHERE id = p_from_card_id;
+    IF NOT FOUND OR v_from.user_id <> p_user_id OR v_from.status <> 'active' THEN
+        RETURN QUERY SELECT 'invalid_card'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    IF v_from.balance < p_amount THEN
+        RETURN QUERY SELECT 'insufficient_funds'::VARCHAR(32), v_from.balance, NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    SELECT * INTO v_to FROM cards WHERE id = p_to_card_id;
+    IF NOT FOUND OR v_to.status <> 'active' THEN
+        RETURN QUERY SELECT 'recipient_not_found'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+    VALUES (p_from_card_id, p_user_id, 'outgoing', p_amount, p_recipient, 'completed')
+    RETURNING id INTO outgoing_id;
+
+    INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+    VALUES (p_to_card_id, v_to.user_id, 'incoming', p_amount, v_from.masked_number, 'completed')
+    RETURNING id INTO incoming_id;
+
+    PERFORM ledger_apply(
+        ARRAY[0, 0],
+        ARRAY[p_from_card_id, p_to_card_id],
+        ARRAY[-p_amount, p_amount]::DECIMAL(15, 2)[],
+        'transfer',
+        ARRAY[outgoing_id, incoming_id]
+    );
+
+    PERFORM card_stats_apply(
+        ARRAY[p_from_card_id, p_to_card_id],
+        ARRAY[p_user_id, v_to.user_id],
+        ARRAY['outgoing', 'incoming']::VARCHAR(20)[],
+        ARRAY[p_amount, p_amount]::DECIMAL(15, 2)[],
+        ARRAY[p_recipient, v_from.masked_number]::VARCHAR(255)[]
+    );
+
+    result := 'completed';
+    from_balance := v_from.balance - p_amount;
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Статистика для уже накопленной истории
+SELECT card_stats_rebuild(
+    COALESCE((SELECT MIN(created_at)::DATE FROM transactions), CURRENT_DATE),
+    CURRENT_DATE
+);
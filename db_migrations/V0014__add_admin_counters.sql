@@ -0,0 +1,277 @@
+-- Счётчики для обзора в админке: число и сумма балансов карт по статусу и
+-- категории, заявки по статусу и категории, пользователи. Их ведут
+-- триггеры уровня оператора по таблицам переходов, поэтому обзор читает
+-- несколько десятков строк при любом размере таблиц. Каждое изменение
+-- пишется в одну из admin_counters_slots() строк (по номеру процесса), чтобы
+-- параллельные транзакции не ждали друг друга на одной строке счётчика.
+-- Перевод не меняет сумм: дельты оператора взаимно гасятся, и он ничего
+-- не пишет.
+CREATE TABLE IF NOT EXISTS admin_counters (
+    metric VARCHAR(20) NOT NULL CHECK (metric IN ('cards', 'card_requests', 'users')),
+    status VARCHAR(20) NOT NULL,
+    category VARCHAR(20) NOT NULL,
+    slot SMALLINT NOT NULL,
+    items BIGINT NOT NULL DEFAULT 0,
+    amount DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (metric, status, category, slot)
+);
+
+-- Ожидающие заявки по часу создания: из этой гистограммы считаются
+-- процентили возраста очереди заявок
+CREATE TABLE IF NOT EXISTS card_requests_pending_hours (
+    hour TIMESTAMP NOT NULL,
+    slot SMALLINT NOT NULL,
+    items BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour, slot)
+);
+
+CREATE OR REPLACE FUNCTION admin_counters_slots() RETURNS INTEGER AS $$
+    SELECT 16;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Статус карты для счётчиков: удалённые (is_active = FALSE) считаются отдельно
+CREATE OR REPLACE FUNCTION card_counter_status(p_is_active BOOLEAN, p_status VARCHAR) RETURNS VARCHAR AS $$
+    SELECT CASE WHEN p_is_active IS FALSE THEN 'deleted' ELSE COALESCE(p_status, 'pending') END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Прибавляет дельты к счётчикам metric; нулевые итоги по ключу не пишутся
+CREATE OR REPLACE FUNCTION admin_counters_apply(
+    p_metric VARCHAR(20),
+    p_statuses VARCHAR[],
+    p_categories VARCHAR[],
+    p_items BIGINT[],
+    p_amounts DECIMAL(18, 2)[]
+) RETURNS VOID AS $$
+    INSERT INTO admin_counters AS c (metric, status, category, slot, items, amount)
+    SELECT p_metric, status, category, pg_backend_pid() % admin_counters_slots(), SUM(items), SUM(amount)
+    FROM unnest(p_statuses, p_categories, p_items, p_amounts) AS d(status, category, items, amount)
+    GROUP BY status, category
+    HAVING SUM(items) <> 0 OR SUM(amount) <> 0
+    ORDER BY status, category
+    ON CONFLICT (metric, status, category, slot) DO UPDATE
+    SET items = c.items + EXCLUDED.items,
+        amount = c.amount + EXCLUDED.amount;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION cards_counters() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM admin_counters_apply('cards', array_agg(card_counter_status(is_active, status)),
+                                     array_agg(COALESCE(card_category, 'debit')), array_agg(1::BIGINT),
+                                     array_agg(COALESCE(balance, 0)))
+        FROM new_rows;
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM admin_counters_apply('cards', array_agg(status), array_agg(category), array_agg(items), array_agg(amount))
+        FROM (
+            SELECT card_counter_status(is_active, status) AS status, COALESCE(card_category, 'debit') AS category,
+                   1::BIGINT AS items, COALESCE(balance, 0) AS amount
+            FROM new_rows
+            UNION ALL
+            SELECT card_counter_status(is_active, status), COALESCE(card_category, 'debit'),
+                   -1, -COALESCE(balance, 0)
+            FROM old_rows
+        ) d;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM admin_counters_apply('cards', array_agg(card_counter_status(is_active, status)),
+                                     array_agg(COALESCE(card_category, 'debit')), array_agg(-1::BIGINT),
+                                     array_agg(-COALESCE(balance, 0)))
+        FROM old_rows;
+    ELSE
+        DELETE FROM admin_counters WHERE metric = 'cards';
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Гистограмма ожидающих заявок: +1 за появившуюся, -1 за ушедшую из pending
+CREATE OR REPLACE FUNCTION card_requests_pending_apply(p_created TIMESTAMP[], p_items BIGINT[]) RETURNS VOID AS $$
+    WITH upserted AS (
+        INSERT INTO card_requests_pending_hours AS h (hour, slot, items)
+        SELECT date_trunc('hour', created_at), pg_backend_pid() % admin_counters_slots(), SUM(items)
+        FROM unnest(p_created, p_items) AS d(created_at, items)
+        GROUP BY 1
+        HAVING SUM(items) <> 0
+        ORDER BY 1
+        ON CONFLICT (hour, slot) DO UPDATE
+        SET items = h.items + EXCLUDED.items
+        RETURNING hour, slot, items
+    )
+    DELETE FROM card_requests_pending_hours h
+    USING upserted u
+    WHERE h.hour = u.hour AND h.slot = u.slot AND u.items = 0;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION card_requests_counters() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM admin_counters_apply('card_requests', array_agg(COALESCE(status, 'pending')),
+                                     array_agg(card_category), array_agg(1::BIGINT), array_agg(0::DECIMAL))
+        FROM new_rows;
+        PERFORM card_requests_pending_apply(array_agg(COALESCE(created_at, LOCALTIMESTAMP)), array_agg(1::BIGINT))
+        FROM new_rows
+        WHERE COALESCE(status, 'pending') = 'pending';
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM admin_counters_apply('card_requests', array_agg(status), array_agg(category), array_agg(items),
+                                     array_agg(0::DECIMAL))
+        FROM (
+            SELECT COALESCE(status, 'pending') AS status, card_category AS category, 1::BIGINT AS items FROM new_rows
+            UNION ALL
+            SELECT COALESCE(status, 'pending'), card_category, -1 FROM old_rows
+        ) d;
+        PERFORM card_requests_pending_apply(array_agg(created_at), array_agg(items))
+        FROM (
+            SELECT COALESCE(created_at, LOCALTIMESTAMP) AS created_at, 1::BIGINT AS items
+            FROM new_rows WHERE COALESCE(status, 'pending') = 'pending'
+            UNION ALL
+            SELECT COALESCE(created_at, LOCALTIMESTAMP), -1
+            FROM old_rows WHERE COALESCE(status, 'pending') = 'pending'
+        ) d;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM admin_counters_apply('card_requests', array_agg(COALESCE(status, 'pending')),
+                                     array_agg(card_category), array_agg(-1::BIGINT), array_agg(0::DECIMAL))
+        FROM old_rows;
+        PERFORM card_requests_pending_apply(array_agg(COALESCE(created_at, LOCALTIMESTAMP)), array_agg(-1::BIGINT))
+        FROM old_rows
+        WHERE COALESCE(status, 'pending') = 'pending';
+    ELSE
+        DELETE FROM admin_counters WHERE metric = 'card_requests';
+        DELETE FROM card_requests_pending_hours;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION users_counters() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM admin_counters_apply('users', array_agg(CASE WHEN is_admin THEN 'admin' ELSE 'user' END),
+                                     array_agg(''::VARCHAR), array_agg(1::BIGINT), array_agg(0::DECIMAL))
+        FROM new_rows;
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM admin_counters_apply('users', array_agg(status), array_agg(''::VARCHAR), array_agg(items),
+                                     array_agg(0::DECIMAL))
+        FROM (
+            SELECT CASE WHEN is_admin THEN 'admin' ELSE 'user' END AS status, 1::BIGINT AS items FROM new_rows
+            UNION ALL
+            SELECT CASE WHEN is_admin THEN 'admin' ELSE 'user' END, -1 FROM old_rows
+        ) d;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM admin_counters_apply('users', array_agg(CASE WHEN is_admin THEN 'admin' ELSE 'user' END),
+                                     array_agg(''::VARCHAR), array_agg(-1::BIGINT), array_agg(0::DECIMAL))
+        FROM old_rows;
+    ELSE
+        DELETE FROM admin_counters WHERE metric = 'users';
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER cards_counters_insert AFTER INSERT ON cards
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION cards_counters();
+CREATE TRIGGER cards_counters_update AFTER UPDATE ON cards
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION cards_counters();
+CREATE TRIGGER cards_counters_delete AFTER DELETE ON cards
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION cards_counters();
+CREATE TRIGGER cards_counters_truncate AFTER TRUNCATE ON cards
+    FOR EACH STATEMENT EXECUTE FUNCTION cards_counters();
+
+CREATE TRIGGER card_requests_counters_insert AFTER INSERT ON card_requests
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION card_requests_counters();
+CREATE TRIGGER card_requests_counters_update AFTER UPDATE ON card_requests
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION card_requests_counters();
+CREATE TRIGGER card_requests_counters_delete AFTER DELETE ON card_requests
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION card_requests_counters();
+CREATE TRIGGER card_requests_counters_truncate AFTER TRUNCATE ON card_requests
+    FOR EACH STATEMENT EXECUTE FUNCTION card_requests_counters();
+
+CREATE TRIGGER users_counters_insert AFTER INSERT ON users
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION users_counters();
+CREATE TRIGGER users_counters_update AFTER UPDATE ON users
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION users_counters();
+CREATE TRIGGER users_counters_delete AFTER DELETE ON users
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION users_counters();
+CREATE TRIGGER users_counters_truncate AFTER TRUNCATE ON users
+    FOR EACH STATEMENT EXECUTE FUNCTION users_counters();
+
+-- Расхождения счётчиков с фактическими данными. Счётчики меняются в той же
+-- транзакции, что и таблицы, поэтому один снимок видит их согласованными, и
+-- проверка не требует блокировок.
+CREATE OR REPLACE FUNCTION admin_counters_check()
+RETURNS TABLE (
+    metric VARCHAR,
+    status VARCHAR,
+    category VARCHAR,
+    counted_items BIGINT,
+    actual_items BIGINT,
+    counted_amount DECIMAL(18, 2),
+    actual_amount DECIMAL(18, 2)
+) AS $$
+    WITH counted AS (
+        SELECT c.metric, c.status, c.category, SUM(c.items)::BIGINT AS items, SUM(c.amount) AS amount
+        FROM admin_counters c
+        GROUP BY 1, 2, 3
+        UNION ALL
+        SELECT 'pending_hours', to_char(h.hour, 'YYYY-MM-DD"T"HH24'), '', SUM(h.items)::BIGINT, 0
+        FROM card_requests_pending_hours h
+        GROUP BY h.hour
+    ), actual AS (
+        SELECT 'cards'::VARCHAR AS metric, card_counter_status(is_active, c.status) AS status,
+               COALESCE(card_category, 'debit')::VARCHAR AS category, COUNT(*) AS items,
+               SUM(COALESCE(balance, 0)) AS amount
+        FROM cards c
+        GROUP BY 1, 2, 3
+        UNION ALL
+        SELECT 'card_requests', COALESCE(r.status, 'pending'), r.card_category, COUNT(*), 0
+        FROM card_requests r
+        GROUP BY 1, 2, 3
+        UNION ALL
+        SELECT 'users', CASE WHEN is_admin THEN 'admin' ELSE 'user' END, '', COUNT(*), 0
+        FROM users
+        GROUP BY 1, 2, 3
+        UNION ALL
+        SELECT 'pending_hours', to_char(date_trunc('hour', COALESCE(r.created_at, LOCALTIMESTAMP)), 'YYYY-MM-DD"T"HH24'),
+               '', COUNT(*), 0
+        FROM card_requests r
+        WHERE COALESCE(r.status, 'pending') = 'pending'
+        GROUP BY 1, 2, 3
+    )
+    SELECT metric, status, category, COALESCE(counted.items, 0), COALESCE(actual.items, 0),
+           COALESCE(counted.amount, 0), COALESCE(actual.amount, 0)
+    FROM counted
+    FULL JOIN actual USING (metric, status, category)
+    WHERE COALESCE(counted.items, 0) <> COALESCE(actual.items, 0)
+       OR COALESCE(counted.amount, 0) <> COALESCE(actual.amount, 0)
+    ORDER BY 1, 2, 3;
+$$ LANGUAGE sql STABLE;
+
+-- Пересчитывает счётчики с нуля. SHARE-блокировка ждёт завершения текущих
+-- изменений карт, заявок и пользователей и не пускает новые до фиксации.
+CREATE OR REPLACE FUNCTION admin_counters_rebuild() RETURNS VOID AS $$
+BEGIN
+    LOCK TABLE cards, card_requests, users IN SHARE MODE;
+    DELETE FROM admin_counters;
+    DELETE FROM card_requests_pending_hours;
+
+    INSERT INTO admin_counters (metric, status, category, slot, items, amount)
+    SELECT 'cards', card_counter_status(is_active, status), COALESCE(card_category, 'debit'), 0,
+           COUNT(*), SUM(COALESCE(balance, 0))
+    FROM cards
+    GROUP BY 2, 3
+    UNION ALL
+    SELECT 'card_requests', COALESCE(status, 'pending'), card_category, 0, COUNT(*), 0
+    FROM card_requests
+    GROUP BY 2, 3
+    UNION ALL
+    SELECT 'users', CASE WHEN is_admin THEN 'admin' ELSE 'user' END, '', 0, COUNT(*), 0
+    FROM users
+    GROUP BY 2, 3;
+
+    INSERT INTO card_requests_pending_hours (hour, slot, items)
+    SELECT date_trunc('hour', COALESCE(created_at, LOCALTIMESTAMP)), 0, COUNT(*)
+    FROM card_requests
+    WHERE COALESCE(status, 'pending') = 'pending'
+    GROUP BY 1;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT admin_counters_rebuild();
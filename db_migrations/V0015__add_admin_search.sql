@@ -0,0 +1,49 @@
+-- Поиск клиентов в админке по имени, логину, почте, телефону и последним
+-- цифрам карты. Текст для поиска нормализуется один раз при записи:
+-- нижний регистр, ё → е, части почты до '@' отдельными словами, телефон
+-- цифрами с кодом страны и без него.
+CREATE OR REPLACE FUNCTION search_normalize(p_text TEXT) RETURNS TEXT AS $$
+    SELECT translate(lower(p_text), 'ё', 'е');
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+CREATE OR REPLACE FUNCTION user_search_text(
+    p_username TEXT,
+    p_email TEXT,
+    p_first_name TEXT,
+    p_last_name TEXT,
+    p_full_name TEXT,
+    p_phone TEXT
+) RETURNS TEXT AS $$
+    SELECT search_normalize(
+        COALESCE(p_username, '') || ' ' ||
+        COALESCE(p_email, '') || ' ' ||
+        COALESCE(regexp_replace(split_part(p_email, '@', 1), '[._+-]+', ' ', 'g'), '') || ' ' ||
+        COALESCE(p_first_name, '') || ' ' ||
+        COALESCE(p_last_name, '') || ' ' ||
+        COALESCE(p_full_name, '') || ' ' ||
+        COALESCE(regexp_replace(p_phone, '[^0-9]', '', 'g'), '') || ' ' ||
+        COALESCE(substr(regexp_replace(p_phone, '[^0-9]', '', 'g'), 2), '')
+    );
+$$ LANGUAGE sql IMMUTABLE;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS search_text TEXT
+    GENERATED ALWAYS AS (user_search_text(username, email, first_name, last_name, full_name, phone)) STORED;
+
+-- Поиск по началу любого слова: 'иван' находит 'Иванов', '900123' — телефон
+CREATE INDEX IF NOT EXISTS idx_users_search_words
+    ON users USING gin (to_tsvector('simple', search_text));
+
+-- Последние четыре цифры карты
+CREATE INDEX IF NOT EXISTS idx_cards_last4
+    ON cards (right(normalize_card_number(card_number), 4));
+
+-- Нечёткий поиск (опечатки) по триграммам, если на сервере есть pg_trgm;
+-- без него поиск остаётся точным и по началу слова
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXECUTE 'CREATE INDEX IF NOT EXISTS idx_users_search_trgm ON users USING gin (search_text gin_trgm_ops)';
+    END IF;
+END;
+$$;
@@ -0,0 +1,7 @@
+-- Ежемесячные выписки (backend/admin/statements.py) читают, кроме
+-- transactions, проводки журнала без строки в transactions: начальные остатки
+-- и корректировки баланса из админки. Их немного, поэтому частичный индекс
+-- мал, а без него выписка просматривала бы весь журнал карт диапазона.
+CREATE INDEX IF NOT EXISTS idx_ledger_entries_card_created_untracked
+    ON ledger_entries (card_id, created_at)
+    WHERE card_id IS NOT NULL AND entry_type <> 'transfer';
@@ -0,0 +1,4 @@
+-- Кэш отзывов в функциях перечитывает строки, отозванные после прошлого
+-- чтения с запасом (REVOCATION_OVERLAP), а не строки с id больше
+-- последнего: id и revoked_at становятся видны не в порядке фиксации.
+CREATE INDEX IF NOT EXISTS idx_session_revocations_revoked ON session_revocations (revoked_at);
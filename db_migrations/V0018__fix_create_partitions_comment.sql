@@ -0,0 +1,41 @@
+-- Исправление комментария к transactions_create_partitions из V0012.
+-- ATTACH PARTITION берёт на transactions лишь SHARE UPDATE EXCLUSIVE, и
+-- вставки в другие секции идут, но при наличии секции по умолчанию
+-- подключение берёт на transactions_default ACCESS EXCLUSIVE и просматривает
+-- её целиком, чтобы убедиться, что там нет строк нового месяца. Всё это время
+-- ждут вставки, попадающие в секцию по умолчанию. Поэтому секции нужно
+-- создавать заранее (admin: POST maintain_partitions или
+-- python partitions.py по расписанию), пока секция по умолчанию пуста и
+-- просмотр мгновенный. Тело функции не меняется.
+--
+-- Создаёт месячные секции transactions_ГГГГ_ММ для месяцев из [p_from, p_to).
+-- Строки этого месяца, попавшие в секцию по умолчанию, переносятся в новую.
+CREATE OR REPLACE FUNCTION transactions_create_partitions(p_from TIMESTAMP, p_to TIMESTAMP)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    v_month TIMESTAMP := date_trunc('month', p_from);
+    v_next TIMESTAMP;
+    v_name TEXT;
+BEGIN
+    WHILE v_month < p_to LOOP
+        v_next := v_month + INTERVAL '1 month';
+        v_name := 'transactions_' || to_char(v_month, 'YYYY_MM');
+        IF to_regclass(v_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I (LIKE transactions INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', v_name
+            );
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM transactions_default WHERE created_at >= %L AND created_at < %L RETURNING *)
+                 INSERT INTO %I SELECT * FROM moved',
+                v_month, v_next, v_name
+            );
+            EXECUTE format(
+                'ALTER TABLE transactions ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                v_name, v_month, v_next
+            );
+            RETURN NEXT v_name;
+        END IF;
+        v_month := v_next;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,17 @@
+-- Постраничные списки (админка, история операций) идут по ключу
+-- (created_at, id), а строка с created_at = NULL выпадает из сравнения
+-- (created_at, id) < (курсор) и ломает выдачу курсора. В transactions
+-- created_at обязателен с V0012; здесь то же для остальных таблиц со
+-- списками. Строки без даты получают самую раннюю дату своей таблицы и
+-- оказываются в конце списков.
+UPDATE users SET created_at = (SELECT COALESCE(MIN(created_at), CURRENT_TIMESTAMP) FROM users)
+WHERE created_at IS NULL;
+ALTER TABLE users ALTER COLUMN created_at SET NOT NULL;
+
+UPDATE cards SET created_at = (SELECT COALESCE(MIN(created_at), CURRENT_TIMESTAMP) FROM cards)
+WHERE created_at IS NULL;
+ALTER TABLE cards ALTER COLUMN created_at SET NOT NULL;
+
+UPDATE card_requests SET created_at = (SELECT COALESCE(MIN(created_at), CURRENT_TIMESTAMP) FROM card_requests)
+WHERE created_at IS NULL;
+ALTER TABLE card_requests ALTER COLUMN created_at SET NOT NULL;
@@ -0,0 +1,5 @@
+-- Счётчик попыток задания очереди переводов. Воркер увеличивает его перед
+-- проведением пачки и сохраняет даже при ошибке; задание, не прошедшее
+-- TRANSFER_QUEUE_MAX_ATTEMPTS попыток, отклоняется (failure_reason
+-- 'too_many_attempts'), а не блокирует очередь.
+ALTER TABLE transfer_queue ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,5 @@
+-- Поиск в админке находит карту по полному номеру в любом статусе и в любой
+-- записи номера (с пробелами или без): индекс V0008 охватывает только
+-- активные карты.
+CREATE INDEX IF NOT EXISTS idx_cards_normalized_number
+    ON cards (normalize_card_number(card_number));
@@ -0,0 +1,8 @@
+-- Блокировка пользователя: вход запрещён, пока флаг установлен. В
+-- session_revocations блокировка — строка с blocked = TRUE и бессрочным
+-- expires_at: кэши отзывов в функциях отклоняют все токены пользователя, в
+-- том числе выпущенные позже. Снятие блокировки закрывает эту строку и
+-- добавляет строку с blocked = FALSE для кэшей, уже прочитавших блокировку.
+-- У обычных отзывов blocked = NULL.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE session_revocations ADD COLUMN IF NOT EXISTS blocked BOOLEAN;
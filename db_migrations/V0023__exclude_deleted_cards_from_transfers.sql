@@ -0,0 +1,93 @@
+-- Удалённая из админки карта (is_active = FALSE) остаётся со статусом
+-- 'active', поэтому поиск получателя и проведение переводов проверяют оба
+-- признака: такая карта не находится по телефону или номеру и не принимает
+-- и не отправляет деньги. Частичные индексы V0008 пересоздаются с тем же
+-- условием, что и в запросах.
+DROP INDEX IF EXISTS idx_cards_active_normalized_number;
+CREATE INDEX idx_cards_active_normalized_number
+    ON cards (normalize_card_number(card_number))
+    WHERE status = 'active' AND is_active;
+
+DROP INDEX IF EXISTS idx_cards_active_primary;
+CREATE INDEX idx_cards_active_primary
+    ON cards (user_id, id)
+    WHERE status = 'active' AND is_active;
+
+-- transfer_funds() из V0013 с проверкой is_active у обеих карт
+CREATE OR REPLACE FUNCTION transfer_funds(
+    p_user_id INTEGER,
+    p_from_card_id INTEGER,
+    p_to_card_id INTEGER,
+    p_amount DECIMAL(15, 2),
+    p_recipient VARCHAR(255)
+) RETURNS TABLE (
+    result VARCHAR(32),
+    from_balance DECIMAL(15, 2),
+    outgoing_id INTEGER,
+    incoming_id INTEGER
+) AS $$
+DECLARE
+    v_from cards%ROWTYPE;
+    v_to cards%ROWTYPE;
+BEGIN
+    IF p_amount IS NULL OR p_amount <= 0 THEN
+        RETURN QUERY SELECT 'invalid_amount'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    IF p_from_card_id = p_to_card_id THEN
+        RETURN QUERY SELECT 'same_card'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    PERFORM 1 FROM cards
+    WHERE id IN (p_from_card_id, p_to_card_id)
+    ORDER BY id
+    FOR UPDATE;
+
+    SELECT * INTO v_from FROM cards WHERE id = p_from_card_id;
+    IF NOT FOUND OR v_from.user_id <> p_user_id OR v_from.status <> 'active' OR v_from.is_active IS NOT TRUE THEN
+        RETURN QUERY SELECT 'invalid_card'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    IF v_from.balance < p_amount THEN
+        RETURN QUERY SELECT 'insufficient_funds'::VARCHAR(32), v_from.balance, NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    SELECT * INTO v_to FROM cards WHERE id = p_to_card_id;
+    IF NOT FOUND OR v_to.status <> 'active' OR v_to.is_active IS NOT TRUE THEN
+        RETURN QUERY SELECT 'recipient_not_found'::VARCHAR(32), NULL::DECIMAL(15, 2), NULL::INTEGER, NULL::INTEGER;
+        RETURN;
+    END IF;
+
+    INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+    VALUES (p_from_card_id, p_user_id, 'outgoing', p_amount, p_recipient, 'completed')
+    RETURNING id INTO outgoing_id;
+
+    INSERT INTO transactions (card_id, user_id, transaction_type, amount, recipient, status)
+    VALUES (p_to_card_id, v_to.user_id, 'incoming', p_amount, v_from.masked_number, 'completed')
+    RETURNING id INTO incoming_id;
+
+    PERFORM ledger_apply(
+        ARRAY[0, 0],
+        ARRAY[p_from_card_id, p_to_card_id],
+        ARRAY[-p_amount, p_amount]::DECIMAL(15, 2)[],
+        'transfer',
+        ARRAY[outgoing_id, incoming_id]
+    );
+
+    PERFORM card_stats_apply(
+        ARRAY[p_from_card_id, p_to_card_id],
+        ARRAY[p_user_id, v_to.user_id],
+        ARRAY['outgoing', 'incoming']::VARCHAR(20)[],
+        ARRAY[p_amount, p_amount]::DECIMAL(15, 2)[],
+        ARRAY[p_recipient, v_from.masked_number]::VARCHAR(255)[]
+    );
+
+    result := 'completed';
+    from_balance := v_from.balance - p_amount;
+    RETURN NEXT;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,48 @@
+-- Сжатие гистограммы ожидающих заявок. Триггер пишет +1 и -1 в слот своего
+-- процесса, поэтому появление заявки и её одобрение обычно попадают в разные
+-- слоты, и строки часа не обнуляются сами. Функция сворачивает слоты каждого
+-- часа в слот 0 и удаляет часы с нулевой суммой; её вызывает check_overview.
+-- Строки, которые триггер меняет одновременно, DELETE дожидается и удаляет в
+-- новой версии, а вставка триггера после удаления просто создаёт строку заново.
+CREATE OR REPLACE FUNCTION card_requests_pending_compact() RETURNS INTEGER AS $$
+DECLARE
+    v_hours TIMESTAMP[];
+    v_items BIGINT[];
+    v_removed INTEGER;
+BEGIN
+    WITH folded AS (
+        DELETE FROM card_requests_pending_hours
+        WHERE hour IN (
+            SELECT hour FROM card_requests_pending_hours
+            GROUP BY hour
+            HAVING COUNT(*) > 1 OR SUM(items) = 0
+        )
+        RETURNING hour, items
+    ), totals AS (
+        SELECT hour, SUM(items)::BIGINT AS items, COUNT(*) AS slots
+        FROM folded
+        GROUP BY hour
+    )
+    SELECT array_agg(hour ORDER BY hour) FILTER (WHERE items <> 0),
+           array_agg(items ORDER BY hour) FILTER (WHERE items <> 0),
+           COALESCE(SUM(slots), 0)
+    INTO v_hours, v_items, v_removed
+    FROM totals;
+
+    WITH upserted AS (
+        INSERT INTO card_requests_pending_hours AS h (hour, slot, items)
+        SELECT hour, 0, items
+        FROM unnest(v_hours, v_items) AS d(hour, items)
+        ON CONFLICT (hour, slot) DO UPDATE
+        SET items = h.items + EXCLUDED.items
+        RETURNING hour, slot, items
+    )
+    DELETE FROM card_requests_pending_hours h
+    USING upserted u
+    WHERE h.hour = u.hour AND h.slot = u.slot AND u.items = 0;
+
+    RETURN v_removed - COALESCE(array_length(v_hours, 1), 0);
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT card_requests_pending_compact();
@@ -0,0 +1,41 @@
+-- Пересчёт дневной статистики не трогает месяцы, секции которых уже
+-- отключены и ушли в архив (V0012): их строк в transactions больше нет, и
+-- прежняя card_stats_rebuild из V0013 удаляла статистику таких месяцев, не
+-- имея из чего её пересчитать. Теперь начало диапазона поднимается до
+-- transactions_oldest_partition(); если месячных секций нет, диапазон не
+-- меняется.
+CREATE OR REPLACE FUNCTION card_stats_rebuild(p_from DATE, p_to DATE) RETURNS BIGINT AS $$
+DECLARE
+    v_rows BIGINT;
+BEGIN
+    p_from := GREATEST(p_from, transactions_oldest_partition()::DATE);
+    IF p_from > p_to THEN
+        RETURN 0;
+    END IF;
+
+    LOCK TABLE card_daily_stats, card_daily_recipients IN SHARE ROW EXCLUSIVE MODE;
+
+    DELETE FROM card_daily_stats WHERE day BETWEEN p_from AND p_to;
+    DELETE FROM card_daily_recipients WHERE day BETWEEN p_from AND p_to;
+
+    INSERT INTO card_daily_stats (card_id, day, user_id, incoming_amount, incoming_count, outgoing_amount, outgoing_count)
+    SELECT card_id, created_at::DATE, MIN(user_id),
+           COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'incoming'), 0),
+           COUNT(*) FILTER (WHERE transaction_type = 'incoming'),
+           COALESCE(SUM(amount) FILTER (WHERE transaction_type = 'outgoing'), 0),
+           COUNT(*) FILTER (WHERE transaction_type = 'outgoing')
+    FROM transactions
+    WHERE created_at >= p_from AND created_at < p_to + 1 AND status = 'completed'
+    GROUP BY card_id, created_at::DATE;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+
+    INSERT INTO card_daily_recipients (card_id, day, recipient, amount, transfer_count)
+    SELECT card_id, created_at::DATE, recipient, SUM(amount), COUNT(*)
+    FROM transactions
+    WHERE created_at >= p_from AND created_at < p_to + 1 AND status = 'completed'
+      AND transaction_type = 'outgoing'
+    GROUP BY card_id, created_at::DATE, recipient;
+
+    RETURN v_rows;
+END;
+$$ LANGUAGE plpgsql;